@@ -1,13 +1,29 @@
-import subprocess, os
+import os, socket, threading, logging
+from queue import Queue, Empty
+from time import time, perf_counter
 from shutil import make_archive, copytree, rmtree
-from typing import List
+from typing import List, Iterator
 from datetime import datetime, timedelta
 from pydicom.dataset import Dataset
-from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelFind
+from pydicom.multival import MultiValue
+from pynetdicom import AE, build_context, DEFAULT_TRANSFER_SYNTAXES
+from pynetdicom.pdu_primitives import SOPClassExtendedNegotiation
+from pynetdicom.sop_class import (StudyRootQueryRetrieveInformationModelFind, Verification, CTImageStorage, MRImageStorage,
+                                  ComputedRadiographyImageStorage, DigitalXRayImageStorageForPresentation,
+                                  UltrasoundImageStorage, SecondaryCaptureImageStorage)
+from pydicom.uid import JPEGBaseline8Bit, JPEGLosslessSV1, JPEG2000Lossless, JPEG2000, RLELossless
 
-from app_pkg import application
-from app_pkg.db_models import Device
-from services.dicom_interface import DicomInterface
+from services.interface_registry import shared_interface
+
+logger = logging.getLogger('__main__')
+
+# Date ranges where find_imgs_in_field searches studies, in days back from today (None: any date)
+CAPABILITY_SEARCH_DAYS = [1, 7, 31, None]
+
+# Storage SOP classes and transfer syntaxes proposed to a device to find the transfer syntaxes it accepts
+PROBED_STORAGE_CLASSES = [CTImageStorage, MRImageStorage, ComputedRadiographyImageStorage,
+                          DigitalXRayImageStorageForPresentation, UltrasoundImageStorage, SecondaryCaptureImageStorage]
+PROBED_TRANSFER_SYNTAXES = DEFAULT_TRANSFER_SYNTAXES + [JPEGBaseline8Bit, JPEGLosslessSV1, JPEG2000Lossless, JPEG2000, RLELossless]
 
 def read_dataset(ds:Dataset, fields_to_read:List[str], field_names:dict = {},
                  default_values = {}, fallback_value = None,
@@ -64,7 +80,58 @@ def read_dataset(ds:Dataset, fields_to_read:List[str], field_names:dict = {},
 
     return output
 
-def find_imgs_in_field(device: dict) -> dict:
+def probe_capabilities(device: dict) -> dict:
+
+    """
+
+        Requests an association with a peer AE to find its capabilities. The contexts negotiated are recorded
+        in the context cache, so later associations with the device are built from them.
+
+        Args: device: a dictionary with the ae_title, address and port of the peer device.
+
+        Returns: None if the association could not be established (or the device is known to be down), or a
+        dict with the following keys
+            "relational_queries": True if the device accepts relational queries (SOP Class Extended Negotiation
+            of the Study Root C-FIND), False otherwise
+            "transfer_syntaxes": a sorted list with the transfer syntaxes accepted for at least one of the
+            PROBED_STORAGE_CLASSES (each transfer syntax is proposed in its own presentation context)
+
+    """
+
+    ae = shared_interface.get()
+    if not ae.device_monitor.allow(device):
+        return None
+
+    contexts = [build_context(Verification), build_context(StudyRootQueryRetrieveInformationModelFind)]
+    for uid in PROBED_STORAGE_CLASSES:
+        contexts.extend(build_context(uid, transfer_syntax) for transfer_syntax in PROBED_TRANSFER_SYNTAXES)
+    relational = SOPClassExtendedNegotiation()
+    relational.sop_class_uid = StudyRootQueryRetrieveInformationModelFind
+    relational.service_class_application_information = b'\x01'
+
+    try:
+        assoc = ae.associate(device['address'], int(device['port']), contexts, ae_title = device['ae_title'], ext_neg = [relational])
+    except Exception:
+        assoc = None
+    if assoc is None or not assoc.is_established:
+        ae.device_monitor.record_failure(device, 'association could not be established')
+        return None
+    ae.device_monitor.record_success(device)
+
+    try:
+        ae.context_cache.record(device, assoc)
+        info = assoc.acceptor.sop_class_extended.get(StudyRootQueryRetrieveInformationModelFind)
+        capabilities = {
+            "relational_queries": bool(info) and info[0] == 1,
+            "transfer_syntaxes": sorted({cx.transfer_syntax[0] for cx in assoc.accepted_contexts
+                                         if cx.abstract_syntax in PROBED_STORAGE_CLASSES}),
+        }
+    finally:
+        assoc.release()
+
+    return capabilities
+
+def find_imgs_in_field(device: dict, max_results: int = 5) -> dict:
 
     """    
 
@@ -75,6 +142,10 @@ def find_imgs_in_field(device: dict) -> dict:
             · NumberOfSeriesRelatedInstances (for series) 
             · ImagesInAcquisition (for series)
 
+        The studies are searched in expanding date ranges back from today (see CAPABILITY_SEARCH_DAYS), until
+        one range has studies. Each query is cancelled after max_results responses. The other capabilities of
+        the device are found with probe_capabilities.
+
         Args: device: a dictionary with at least following keys:
                         ae_title: string with the AE title of the peer device.
                         address: string with the IP of the peer device.
@@ -83,105 +154,247 @@ def find_imgs_in_field(device: dict) -> dict:
         Returns: a dict with the following keys
             "imgs_series": the field where the device inform the number of instances in a series ("Unknown" if not found)
             "imgs_study": the field where the device inform the number of instances in a study ("Unknown" if not found)
+            "relational_queries", "transfer_syntaxes": see probe_capabilities (None if the association failed)
                 
     """
 
-    # Query the device by date backwards, until at least one study is found, the C-FIND returns fail or
-    # the association fails
+    result = {"imgs_study": 'Unknown', "imgs_series": 'Unknown', "relational_queries": None, "transfer_syntaxes": None}
+
+    # Don't query a device that can't be associated with
+    capabilities = probe_capabilities(device)
+    if capabilities is None:
+        return result
+    result.update(capabilities)
+
+    # Search studies in expanding date ranges, until at least one study is found
+    ae = shared_interface.get()
+    today = datetime.today()
+    studies = []
+    for days in CAPABILITY_SEARCH_DAYS:
+        ds = Dataset()
+        ds.QueryRetrieveLevel = 'STUDY'
+        ds.StudyInstanceUID = ''
+        ds.NumberOfStudyRelatedInstances = ''
+        if days is None:
+            ds.StudyDate = ''
+        elif days == 1:
+            ds.StudyDate = today.strftime('%Y%m%d')
+        else:
+            ds.StudyDate = (today - timedelta(days = days - 1)).strftime('%Y%m%d') + '-' + today.strftime('%Y%m%d')
+        studies = ae.query_device(device, ds, max_results = max_results)
+        if studies:
+            break
+    if not studies:
+        return result
+
+    # Prefer a study that informs the number of instances to look for the series fields
+    counted = [study for study in studies if study.get('NumberOfStudyRelatedInstances') not in [None, '']]
+    if counted:
+        result['imgs_study'] = 'NumberOfStudyRelatedInstances'
 
     ds = Dataset()
-    ds.QueryRetrieveLevel = 'STUDY'    
-    ds.StudyInstanceUID = ''
-    ds.NumberOfStudyRelatedInstances = ''
-    
-    try:
-        with application.app_context():
-            ae = DicomInterface(ae_title = Device.query.get('__local_store_SCP__').ae_title)
-        assoc = ae.get_association(device)
-    except:
-        return {"imgs_study": 'Unknown', "imgs_series": 'Unknown'}
-
-    studies_found = False
-    c_find_successful = True
-    studydate = datetime.today()
-
-    while not studies_found and assoc.is_established and c_find_successful:
-        
-        # Query device
-        ds.StudyDate = studydate.strftime('%Y%m%d')
-        c_find_results = assoc.send_c_find(ds, StudyRootQueryRetrieveInformationModelFind)
-        query_results = list(c_find_results)
-        
-        # Check if c_find was succesful
-        if query_results[-1][0]:
-            c_find_successful = query_results[-1][0].Status == 0
-        else:
-            c_find_successful = False       
+    ds.QueryRetrieveLevel = 'SERIES'
+    ds.StudyInstanceUID = (counted or studies)[0].StudyInstanceUID
+    ds.SeriesInstanceUID = ''
+    ds.NumberOfSeriesRelatedInstances = ''
+    ds.ImagesInAcquisition = ''
+    series = ae.query_device(device, ds, max_results = max_results)
+
+    for field in ['NumberOfSeriesRelatedInstances', 'ImagesInAcquisition']:
+        if any(s.get(field) not in [None, ''] for s in series):
+            result['imgs_series'] = field
+            break
+
+    return result
+
+def reprobe_devices(devices: dict, workers: int = 8) -> dict:
+
+    """
 
-        # Check if any studies were found
-        studies_found = len(query_results) > 1
+        Runs find_imgs_in_field for several devices in parallel, with up to workers devices at a time.
 
-        # Come back yesterday
-        studydate = studydate - timedelta(days=1)   
+        Args: devices: a dict with the name of each device as key and a dict with its ae_title, address and
+        port as value.
+
+        Returns: a dict with the name of each device as key and the result of find_imgs_in_field as value.
+
+    """
+
+    names = Queue()
+    for name in devices:
+        names.put(name)
+    results = {}
+
+    def worker():
+        while True:
+            try:
+                name = names.get_nowait()
+            except Empty:
+                return
+            try:
+                results[name] = find_imgs_in_field(devices[name])
+            except Exception as e:
+                logger.error(f'capabilities of {name} could not be found: {repr(e)}')
+                results[name] = {"imgs_study": 'Unknown', "imgs_series": 'Unknown', "relational_queries": None, "transfer_syntaxes": None}
+
+    threads = [threading.Thread(target = worker, daemon = True) for _ in range(max(1, min(workers, len(devices))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+def search_studies_events(devices: list, queries: dict, timeout, max_results: int = None,
+                          date_chunks: str = None) -> Iterator[dict]:
+
+    """
     
-    if not c_find_successful:
-        imgs_in_series = 'Unknown'
-        imgs_in_study = 'Unknown'
-    elif not assoc.is_established:
-        imgs_in_series = 'Unknown'
-        imgs_in_study = 'Unknown'
-    else:
-        # If at least one study was found, query series for it and try to find the
-        # field with the number of images in each series.
-        if 'NumberOfStudyRelatedInstances' in query_results[0][1]:
-            imgs_in_study = 'NumberOfStudyRelatedInstances'
-        else:
-            imgs_in_study = 'Unknown'
-
-        ds = Dataset()    
-        ds.QueryRetrieveLevel = 'SERIES'
-        ds.StudyInstanceUID = query_results[0][1].StudyInstanceUID
-        ds.SeriesInstanceUID = ''
-        ds.NumberOfSeriesRelatedInstances = ''
-        ds.ImagesInAcquisition = ''
-
-        c_find_results = assoc.send_c_find(ds, StudyRootQueryRetrieveInformationModelFind)
-        query_results = list(c_find_results)
-        
-        if 'NumberOfSeriesRelatedInstances' in query_results[0][1]:
-            imgs_in_series = 'NumberOfSeriesRelatedInstances'            
-        elif 'ImagesInAcquisition' in query_results[0][1]:
-            imgs_in_series = 'ImagesInAcquisition'
-        else:
-            imgs_in_series = 'Unknown'        
+    Runs the study queries of /search_studies on their devices (see DicomInterface.iter_query_devices, also for
+    date_chunks) and yields the results as they arrive:
+    · {'type': 'study', 'data': row} for each study, the first time it is found.
+    · {'type': 'source', 'StudyInstanceUID': uid, 'source': name} when a study is found in another device
+    (with 'ImgsStudy' if the first device didn't return the number of images).
+    · {'type': 'end', 'timed_out': names, 'truncated': names, 'max_results': max_results} at the end, with the
+    devices that didn't answer in time, and the devices that had more than max_results studies (their queries
+    are cancelled).
+    
+    """
+
+    devices = {device.name: device for device in devices}
+    completed = set()
+    # StudyInstanceUID -> True if the number of images of the study is known
+    studies = {}
+    # Studies received from each device. One more than max_results is requested to know if there are more
+    received = {name: 0 for name in devices}
+    truncated = set()
+    ae = shared_interface.get()
+    for name, study in ae.iter_query_devices(queries, timeout = timeout, max_results = max_results and max_results + 1,
+                                             date_chunks = date_chunks):
+
+        if study is None:
+            completed.add(name)
+            continue
+
+        received[name] += 1
+        if max_results and received[name] > max_results:
+            truncated.add(name)
+            continue
+
+        device = devices[name]
+        data = read_dataset(study, ['PatientName','PatientID','StudyDate','StudyTime','ModalitiesInStudy','StudyDescription',device.imgs_study,'StudyInstanceUID'],
+                             field_names = {device.imgs_study:'ImgsStudy'},
+                             fields_handlers = {'PatientName': lambda x: str(x.value),
+                                                'ModalitiesInStudy': lambda x: '/'.join(x.value) if type(x.value) == MultiValue else x.value},
+                             default_values={'StudyDescription':''})  
+
+        # Studies found in several devices are shown once, with the first device that answered as source
+        uid = data.get('StudyInstanceUID')
+        if uid and uid in studies:
+            event = {'type': 'source', 'StudyInstanceUID': uid, 'source': name}
+            if not studies[uid] and data.get('ImgsStudy') not in [None, '']:
+                event['ImgsStudy'] = data['ImgsStudy']
+                studies[uid] = True
+            yield event
+            continue
+
+        data['source'] = name
+        data['sources'] = [name]
+        data['level'] = 'STUDY'
+        studies[uid] = data.get('ImgsStudy') not in [None, '']
+        yield {'type': 'study', 'data': data}
+
+    yield {'type': 'end', 'timed_out': [name for name in devices if not name in completed], 'truncated': sorted(truncated),
+           'max_results': max_results}
+
+
+def probe_devices(devices: dict, timeout: float = 5, associate: bool = True) -> dict:
 
-    # Release association in case it is still active
-    assoc.release()
+    """
 
-    return {"imgs_study": imgs_in_study, "imgs_series": imgs_in_series}
+    Checks if the devices are reachable, all of them concurrently and within a single deadline, so that
+    checking many devices takes about as long as the slowest one.
 
+    A TCP connection to the address and port of each device is opened and closed and, if associate is True
+    and the connection succeeds, an association (with the Verification context) is requested and released.
 
-def ping(target_host, timeout = 100, count = 3):
+    Args:
+        · devices: a dict with the name of each device as key and a dict with its ae_title, address and port
+        as value.
+        · timeout: seconds for the whole check. The devices that didn't answer by then are reported as 'timeout'.
+        · associate: if False, only the TCP connection is checked.
 
-    if os.name == "nt":
-        command = ["ping", "-w", str(timeout), "-n", str(count), target_host]
-    elif os.name == "posix":
-        command = ["ping", "-W", str(timeout), "-c", str(count), target_host]
-    else:
-        return False
+    Returns: a dict with the name of each device as key and a dict with the following keys/values:
+        · status: 'ok', 'unreachable' (the TCP connection failed), 'rejected' (the association was rejected or
+        aborted) or 'timeout'.
+        · tcp_ms: milliseconds to open the TCP connection (None if it failed).
+        · association_ms: milliseconds to establish the association (None if it was not requested or failed).
+        · error: str with the reason of the failure, or None.
 
-    try:
-        completed_process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        stdout = completed_process.stdout
-        stderr = completed_process.stderr
+    """
+
+    deadline = time() + timeout
+    results = Queue()
+    interface = shared_interface.get()
+
+    def probe(name: str, device: dict):
 
-        if completed_process.returncode == 0:
-            return True
+        result = {'status': 'unreachable', 'tcp_ms': None, 'association_ms': None, 'error': None}
+        try:
+            start = perf_counter()
+            with socket.create_connection((device['address'], int(device['port'])), timeout = max(0.01, deadline - time())):
+                result['tcp_ms'] = round((perf_counter() - start) * 1000, 1)
+        except (OSError, ValueError) as e:
+            result['error'] = str(e) or repr(e)
+            results.put((name, result))
+            return
+
+        if not associate:
+            result['status'] = 'ok'
+            results.put((name, result))
+            return
+        if time() >= deadline:
+            return
+
+        # The associations take their timeouts from the AE when they are created: they are requested by an
+        # AE of their own (with the AE title of the shared interface), with its timeouts bounded by the time
+        # left until the deadline
+        ae = AE(ae_title = interface.ae_title)
+        ae.add_requested_context(Verification)
+        ae.acse_timeout = ae.dimse_timeout = ae.network_timeout = ae.connection_timeout = max(0.01, deadline - time())
+        start = perf_counter()
+        try:
+            assoc = ae.associate(device['address'], int(device['port']), ae_title = device['ae_title'])
+        except Exception as e:
+            assoc = None
+            result['error'] = repr(e)
+        if assoc is not None and assoc.is_established:
+            result['association_ms'] = round((perf_counter() - start) * 1000, 1)
+            result['status'] = 'ok'
+            assoc.release()
         else:
-            return False
-    except subprocess.CalledProcessError as e:
-        return False
-    
+            result['status'] = 'rejected'
+            if assoc is not None:
+                result['error'] = 'association rejected' if assoc.is_rejected else 'association aborted'
+        results.put((name, result))
+
+    for name, device in devices.items():
+        threading.Thread(target = probe, args = (name, device), daemon = True).start()
+
+    # Collect the results until the deadline
+    status = {}
+    while len(status) < len(devices):
+        try:
+            name, result = results.get(timeout = max(0, deadline - time()))
+        except Empty:
+            break
+        status[name] = result
+    for name in devices:
+        if name not in status:
+            status[name] = {'status': 'timeout', 'tcp_ms': None, 'association_ms': None, 'error': f'no answer in {timeout} s'}
+
+    return status
 
 def zip_files(items: List[dict]) -> str:
     
@@ -2,6 +2,7 @@ import os, logging
 from app_pkg import db
 from sqlalchemy import event
 import json, re
+from datetime import datetime
 
 logger = logging.getLogger('__main__')
 
@@ -24,6 +25,11 @@ class Study(db.Model):
     StudyDescription = db.Column(db.String(64), index=True)
     path = db.Column(db.String(256), index=True)
 
+    # Summaries maintained by the ingest path and by deletes (size in bytes)
+    NumberOfInstances = db.Column(db.Integer(), default=0)
+    ModalitiesInStudy = db.Column(db.String(64), index=True)
+    size = db.Column(db.BigInteger(), default=0)
+
     # Cross-references up
     PatientID = db.Column(db.String(64), db.ForeignKey('patient.PatientID'))
 
@@ -43,6 +49,10 @@ class Series(db.Model):
     Modality = db.Column(db.String(64), index=True)
     path = db.Column(db.String(256), index=True)
 
+    # Summaries maintained by the ingest path and by deletes (size in bytes)
+    NumberOfInstances = db.Column(db.Integer(), default=0)
+    size = db.Column(db.BigInteger(), default=0)
+
     # Cross-references up
     PatientID = db.Column(db.String(64), db.ForeignKey('patient.PatientID'))
     StudyInstanceUID = db.Column(db.String(64), db.ForeignKey('study.StudyInstanceUID'))
@@ -59,6 +69,13 @@ class Instance(db.Model):
     SOPClassUID = db.Column(db.String(64), index=True)   
     filename = db.Column(db.String(256), index=True)
 
+    # Encoding of the stored file: transfer syntax and byte offset of the dataset (after the file meta)
+    TransferSyntaxUID = db.Column(db.String(64))
+    dataset_offset = db.Column(db.Integer())
+
+    # Size of the stored file in bytes (to keep the size of the study and series when it is replaced)
+    size = db.Column(db.BigInteger())
+
     # Cross-references up
     PatientID = db.Column(db.String(64), db.ForeignKey('patient.PatientID'))
     StudyInstanceUID = db.Column(db.String(64), db.ForeignKey('study.StudyInstanceUID'))
@@ -83,12 +100,34 @@ class Device(db.Model):
     port = db.Column(db.Integer(), index=True)
     imgs_series = db.Column(db.String(64))
     imgs_study = db.Column(db.String(64))
+    # Default number of parallel associations for C-STORE operations to this device
+    store_associations = db.Column(db.Integer(), default=1)
+    # Seconds that the responses of the queries to this device are cached (None: the default, 0: not cached)
+    query_cache_ttl = db.Column(db.Integer())
+    # Capabilities found by find_imgs_in_field: support of relational queries (None: unknown), transfer syntaxes
+    # accepted for storage (a json list of UIDs) and time they were checked
+    relational_queries = db.Column(db.Boolean())
+    transfer_syntaxes = db.Column(db.Text())
+    capabilities_checked = db.Column(db.DateTime)
 
     # Cross-references down
     filters = db.relationship('Filter', backref='device', lazy='dynamic', cascade='all, delete-orphan')  
 
     def __repr__(self):
         return f'<Device {self.name}: {self.ae_title}@{self.address}>'
+
+    def update_capabilities(self, capabilities: dict) -> None:
+
+        """ Sets the capabilities found by find_imgs_in_field (the instance count fields that were not found are kept) """
+
+        for field in ['imgs_study', 'imgs_series']:
+            if capabilities.get(field, 'Unknown') != 'Unknown':
+                setattr(self, field, capabilities[field])
+        # The rest are only known if the association was established
+        if capabilities.get('transfer_syntaxes') is not None:
+            self.relational_queries = capabilities['relational_queries']
+            self.transfer_syntaxes = json.dumps(capabilities['transfer_syntaxes'])
+            self.capabilities_checked = datetime.now()
     
 
 class Filter(db.Model):
@@ -1,17 +1,23 @@
 import ipaddress, psutil, logging, os, json
 from shutil import copytree, rmtree, make_archive
 from datetime import datetime, timedelta
-from pydicom.multival import MultiValue
 
 from sqlalchemy.exc import OperationalError
 
-from flask import render_template, request, jsonify, send_file
+from flask import render_template, request, jsonify, send_file, Response, stream_with_context
 from app_pkg import application, db
-from app_pkg.aux_funcs import read_dataset, find_imgs_in_field, ping, zip_files
-from app_pkg.db_models import Study, Series, Device, Filter
-
-from services.dicom_interface import DicomInterface
-from services import task_manager, check_storage_manager, store_scp
+from app_pkg.aux_funcs import read_dataset, find_imgs_in_field, reprobe_devices, probe_devices, zip_files, search_studies_events
+from app_pkg.db_models import Patient, Study, Series, Instance, Device, Filter
+
+from services.dicom_interface import DicomInterface, study_query, DATE_CHUNKS
+from services import (task_manager, check_storage_manager, store_scp, ingest_writer, ingest_sessions,
+                      hierarchy_cache, ingest_pipeline, instance_index)
+from services.db_store_handler import join_modalities
+from services.association_pool import association_pool, AssociationError
+from services.context_cache import context_cache
+from services.query_cache import query_cache
+from services.device_monitor import device_monitor
+from services.interface_registry import shared_interface
 
 logger = logging.getLogger('__main__')
 
@@ -24,10 +30,11 @@ def query_retrieve():
 @application.route('/search_studies', methods = ['GET','POST'])
 def search_studies():
 
-    # Get device info from database
+    # Get devices info from database. A list of devices in 'devices' searches all of them (federated search)
+    names = request.json.get('devices') or [request.json['device']]
     try:
-        device = Device.query.get(request.json['device'])
-        assert device
+        devices = [Device.query.get(name) for name in names]
+        assert all(devices)
         logger.info('device found on database')
     except AssertionError:
         logger.info('device not found on database')
@@ -70,34 +77,49 @@ def search_studies():
             'PatientID': '',
             'StudyTime': '',
             'ModalitiesInStudy':  '',
-            'StudyDescription': '',
-            device.imgs_study: ''}
-
-    # Send the dicom query
-    device_dict = {attr:getattr(device, attr) for attr in ["ae_title","port","address"]}
-    ae = DicomInterface(ae_title = Device.query.get('__local_store_SCP__').ae_title, 
-                        address = Device.query.get('__local_store_SCP__').address,
-                        acse_timeout=120)    
-    responses = ae.query_studies_in_device(device_dict, qr, rs)
-    logger.debug(f'{len(responses)} studies found on {device.ae_title}')
-    
-    ae.release_connections()
-
-    # Extract data from datasets
+            'StudyDescription': ''}
+
+    # Send the dicom query to each device in parallel (the field with the number of images depends on the device)
+    queries = {device.name: ({attr:getattr(device, attr) for attr in ["ae_title","port","address","query_cache_ttl"]},
+                             study_query(qr, dict(rs, **{device.imgs_study: ''})))
+               for device in devices}
+    # The search deadline only applies to federated searches: a single device is waited for up to
+    # the DIMSE timeout of the interface (timeout None)
+    timeout = request.json.get('timeout')
+    if timeout is None and len(devices) > 1:
+        timeout = application.config['FEDERATED_SEARCH_TIMEOUT']
+    # The queries are cancelled after max_results studies in each device (0: no limit)
+    max_results = request.json.get('maxResults', application.config['SEARCH_MAX_RESULTS'])
+    # Date ranges can be split in days or weeks queried in parallel
+    date_chunks = request.json.get('dateChunks', application.config['SEARCH_DATE_CHUNKS'])
+    if date_chunks and not date_chunks in DATE_CHUNKS:
+        return jsonify(message = f"dateChunks debe ser uno de {DATE_CHUNKS}"), 500
+    events = search_studies_events(devices, queries, timeout, int(max_results or 0), date_chunks)
+
+    # Stream the results as they arrive, one JSON object per line
+    if 'application/x-ndjson' in request.headers.get('Accept', ''):
+        return Response(stream_with_context(application.json.dumps(event) + '\n' for event in events),
+                        mimetype = 'application/x-ndjson')
+
+    # Or return all of them at once
     full_data = []
-    for study in responses:
-
-        data = read_dataset(study, ['PatientName','PatientID','StudyDate','StudyTime','ModalitiesInStudy','StudyDescription',device.imgs_study,'StudyInstanceUID'],
-                             field_names = {device.imgs_study:'ImgsStudy'},
-                             fields_handlers = {'PatientName': lambda x: str(x.value),
-                                                'ModalitiesInStudy': lambda x: '/'.join(x.value) if type(x.value) == MultiValue else x.value},
-                             default_values={'StudyDescription':''})  
-        
-        data['source'] = request.json['device']
-        data['level'] = 'STUDY'
-        full_data.append(data)    
+    studies = {}
+    for event in events:
+        if event['type'] == 'study':
+            full_data.append(event['data'])
+            studies[event['data'].get('StudyInstanceUID')] = event['data']
+        elif event['type'] == 'source':
+            study = studies[event['StudyInstanceUID']]
+            study['sources'].append(event['source'])
+            if 'ImgsStudy' in event:
+                study['ImgsStudy'] = event['ImgsStudy']
+        else:
+            timed_out = event['timed_out']
+            truncated = event['truncated']
     data = {
-        "data": full_data
+        "data": full_data,
+        "timed_out": timed_out,
+        "truncated": truncated
     }
         
     return data
@@ -110,7 +132,8 @@ def local():
 def get_local_studies():
 
     try:
-        studies = Study.query.all()
+        # Counters and modalities are kept on the study rows: no series or instances are loaded
+        studies = db.session.query(Study, Patient).join(Patient, Study.PatientID == Patient.PatientID).all()
         logger.debug(f'{len(studies)} studies found on local database')
     except Exception as e:
         logger.error(f'An error ocurred during database query')
@@ -119,15 +142,16 @@ def get_local_studies():
 
     # Extract data from datasets
     full_data = []
-    for study in Study.query.all():
+    for study, patient in studies:
         data = {}
-        data['PatientName'] = study.patient.PatientName
-        data['PatientID'] = study.patient.PatientID
+        data['PatientName'] = patient.PatientName
+        data['PatientID'] = patient.PatientID
         data['StudyDate'] = study.StudyDate.strftime('%d/%m/%y')
         data['StudyTime'] = study.StudyDate.strftime('%H:%M:%S')
-        data['ModalitiesInStudy'] = '/'.join(set([ss.Modality for ss in study.series.all()]))
+        data['ModalitiesInStudy'] = study.ModalitiesInStudy or ''
         data['StudyDescription'] = study.StudyDescription
-        data['ImgsStudy'] = len(study.instances.all())
+        data['ImgsStudy'] = study.NumberOfInstances or 0
+        data['StudySize'] = study.size or 0
         data['StudyInstanceUID'] = study.StudyInstanceUID        
         data['source'] = 'local'
         data['level'] = 'STUDY'
@@ -158,7 +182,8 @@ def get_local_study_data():
             'SeriesTime': series.SeriesDate.strftime('%H:%M:%S'),
             'Modality': series.Modality,
             'SeriesDescription': series.SeriesDescription,
-            'ImgsSeries': len(series.instances.all()),
+            'ImgsSeries': series.NumberOfInstances or 0,
+            'SeriesSize': series.size or 0,
             'SeriesInstanceUID': series.SeriesInstanceUID,
         }           
             
@@ -182,13 +207,20 @@ def delete_studies():
     items = list(filter(lambda x: not (x['level'] == 'SERIES' and x['StudyInstanceUID'] in studies_uids), items))
 
     success = 0
+    deleted_instances = []
+    updated_studies = set()
     for item in items:
         try:
             if item['level'] == 'STUDY':
                 element = Study.query.get(item['StudyInstanceUID'])
             elif item['level'] == 'SERIES':
                 element = Series.query.get(item['SeriesInstanceUID'])            
+                # Remove the series from the counters of its study
+                element.study.NumberOfInstances = (element.study.NumberOfInstances or 0) - (element.NumberOfInstances or 0)
+                element.study.size = (element.study.size or 0) - (element.size or 0)
+                updated_studies.add(element.study)
             path = element.path
+            deleted_instances.extend(uid for (uid,) in element.instances.with_entities(Instance.SOPInstanceUID))
             db.session.delete(element)                
             logger.debug(f"deleted {element}")
             success += 1
@@ -197,7 +229,18 @@ def delete_studies():
             logger.error(repr(e))
 
     try:
+        # Recompute the modalities of the studies that lost series
+        db.session.flush()
+        for study in updated_studies:
+            study.ModalitiesInStudy = join_modalities(*[m for (m,) in study.series.with_entities(Series.Modality)])
         db.session.commit()     
+        # Forget the deleted rows in the ingest cache and index
+        instance_index.discard(deleted_instances)
+        for item in items:
+            if item['level'] == 'STUDY':
+                hierarchy_cache.discard_study(item['StudyInstanceUID'])
+            elif item['level'] == 'SERIES':
+                hierarchy_cache.discard_series(item['SeriesInstanceUID'])
         rmtree(path)       
         return jsonify(message = f"{success} deleted succesfully"), 200
     except Exception as e:
@@ -252,13 +295,10 @@ def get_study_data():
           device.imgs_series: ''}
           
     # Send the dicom query
-    device_dict = {attr:getattr(device, attr) for attr in ["ae_title","port","address"]}
-    ae = DicomInterface(ae_title = Device.query.get('__local_store_SCP__').ae_title, 
-                        address = Device.query.get('__local_store_SCP__').address,
-                        acse_timeout=120)
+    device_dict = {attr:getattr(device, attr) for attr in ["ae_title","port","address","query_cache_ttl"]}
+    ae = shared_interface.get()
     responses = ae.query_series_in_study(device_dict, request.json['StudyInstanceUID'], responses = rs)
     logger.debug(f'{len(responses)} studies found on {device.ae_title}')
-    ae.release_connections()
     
     # Extract data from datasets
     full_data = []
@@ -288,7 +328,13 @@ def get_devices():
         return jsonify(message = "Error al leer la base de datos"), 500
 
     devices = [{"name":d.name, "ae_title":d.ae_title, "address":d.address + ":" + str(d.port),
-                "imgs_series": d.imgs_series, "imgs_study": d.imgs_study,                
+                "imgs_series": d.imgs_series, "imgs_study": d.imgs_study,
+                "store_associations": d.store_associations or 1,
+                "query_cache_ttl": d.query_cache_ttl,
+                "relational_queries": d.relational_queries,
+                "transfer_syntaxes": json.loads(d.transfer_syntaxes) if d.transfer_syntaxes else None,
+                "capabilities_checked": d.capabilities_checked.strftime('%d/%m/%Y %H:%M:%S') if d.capabilities_checked else None,
+                "health": device_monitor.get_state({"ae_title": d.ae_title, "address": d.address, "port": d.port}),
                 "filters" : [[key + item for key, item in json.loads(f.conditions).items()] for f in d.filters.all()]} 
                for d in devices if d.name!="__local_store_SCP__"]
     data = {
@@ -335,7 +381,19 @@ def find_missing_series():
         studydate = start_date.strftime('%Y%m%d')+'-'+end_date.strftime('%Y%m%d')
     
     # Find missing series
-    missing_series, archived_series, ignored_series = check_storage_manager.find_missing_series(request.json['device'], studydate)
+    date_chunks = request.json.get('dateChunks', application.config['SEARCH_DATE_CHUNKS'])
+    if date_chunks and not date_chunks in DATE_CHUNKS:
+        return jsonify(message = f"dateChunks debe ser uno de {DATE_CHUNKS}"), 500
+    try:
+        missing_series, archived_series, ignored_series = check_storage_manager.find_missing_series(request.json['device'], studydate, date_chunks)
+    except AssociationError as e:
+        # One of the devices is down: every series would look missing
+        logger.error(repr(e))
+        return jsonify(message = f"No se pudo conectar con el dispositivo: {e}"), 500
+    except RuntimeError as e:
+        # The query of a date range failed: its series would look missing
+        logger.error(repr(e))
+        return jsonify(message = f"Falló la consulta al dispositivo: {e}"), 500
 
     # Extract missing series data from datasets
     source = request.json['device']
@@ -396,6 +454,28 @@ def check_storage_progress():
         "progress": f"{100*check_storage_manager.progress:.0f}%"
     }}
 
+@application.route('/get_association_stats')
+def get_association_stats():
+
+    data = store_scp.get_association_stats()
+    data['pool'] = association_pool.get_stats()
+    data['contexts'] = context_cache.get_stats()
+    data['queries'] = query_cache.get_stats()
+    data['devices'] = device_monitor.get_stats()
+
+    return {"data": data}
+
+@application.route('/get_ingest_stats')
+def get_ingest_stats():
+
+    data = ingest_writer.get_stats()
+    data['cache'] = hierarchy_cache.get_stats()
+    data['pipeline'] = ingest_pipeline.get_stats()
+    data['sessions'] = ingest_sessions.get_stats()
+    data['indexed_instances'] = len(instance_index)
+
+    return {"data": data}
+
 @application.route('/empty_table', methods = ['GET','POST'])
 def empty_table():
     
@@ -473,6 +553,8 @@ def send():
         task_data['destination'] = request.json['destination']
         task_data['type'] = 'SEND'
         task_data['datasets'] = datasets        
+        # Parallel associations for this send (if not set, the destination default)
+        task_data['associations'] = request.json.get('associations')
         task_manager.manage_task(action = 'new', task_data = task_data)
 
     return {"message": f"Se agregaron {len(datasets)} trabajos a la cola"}
@@ -505,6 +587,9 @@ def manage_devices():
         # Delete device 
         try:   
             assert d
+            context_cache.invalidate({'ae_title': d.ae_title, 'address': d.address, 'port': d.port})
+            query_cache.invalidate({'ae_title': d.ae_title, 'address': d.address, 'port': d.port})
+            device_monitor.forget({'ae_title': d.ae_title, 'address': d.address, 'port': d.port})
             db.session.delete(d)
             db.session.commit()
             logger.info(f'device {d} deleted')
@@ -534,6 +619,24 @@ def manage_devices():
     except:
         logger.info('invalid port')
         return {"message":"Error: el puerto no es válido"}    
+
+    # Check the number of parallel associations for C-STORE
+    store_associations = request.json.get("store_associations") or 1
+    try:
+        store_associations = int(store_associations)
+        assert store_associations >= 1
+    except:
+        logger.info('invalid number of store associations')
+        return {"message":"Error: el número de asociaciones no es válido"}
+
+    # Check the time the queries to the device are cached (empty: the default time)
+    query_cache_ttl = request.json.get("query_cache_ttl")
+    try:
+        query_cache_ttl = int(query_cache_ttl) if query_cache_ttl not in [None, ''] else None
+        assert query_cache_ttl is None or query_cache_ttl >= 0
+    except:
+        logger.info('invalid query cache ttl')
+        return {"message":"Error: el tiempo de caché de las consultas no es válido"}
             
     if action == "add":
         # Add new device        
@@ -544,7 +647,9 @@ def manage_devices():
             # Add device to database
             new_d = Device(name = device_name, ae_title = ae_title, address = address, port = port,
             imgs_series = request.json["imgs_series"] or "Unknown",
-            imgs_study = request.json["imgs_study"] or "Unknown")
+            imgs_study = request.json["imgs_study"] or "Unknown",
+            store_associations = store_associations,
+            query_cache_ttl = query_cache_ttl)
             db.session.add(new_d)
             db.session.commit()
             logger.info(f'device {new_d} created.') 
@@ -563,11 +668,18 @@ def manage_devices():
         
         # Edit device in database     
         try:       
+            # The contexts negotiated with the device may change, the cached queries may use the old ttl and
+            # the device may be up at its new address
+            context_cache.invalidate({'ae_title': d.ae_title, 'address': d.address, 'port': d.port})
+            query_cache.invalidate({'ae_title': d.ae_title, 'address': d.address, 'port': d.port})
+            device_monitor.forget({'ae_title': d.ae_title, 'address': d.address, 'port': d.port})
             d.ae_title = ae_title
             d.address = address
             d.port = port
             d.imgs_series = request.json["imgs_series"] or "Unknown"
             d.imgs_study = request.json["imgs_study"] or "Unknown"
+            d.store_associations = store_associations
+            d.query_cache_ttl = query_cache_ttl
             db.session.commit()
             logger.info('device edited')
             return {"message":"Dispositivo editado correctamente"}    
@@ -583,9 +695,35 @@ def query_imgs_field():
     device = request.json
     device["port"] = int(device["port"])
     field_names = find_imgs_in_field(device)
+
+    # Record the capabilities of the device, if it is configured with this AE title, address and port
+    d = Device.query.get(device.get("name") or '')
+    if d and (d.ae_title, d.address, d.port) == (device["ae_title"], device["address"], device["port"]):
+        d.update_capabilities(field_names)
+        db.session.commit()
     
     return field_names
 
+@application.route('/reprobe_devices', methods=['GET', 'POST'])
+def reprobe_all_devices():
+
+    # Find the capabilities of all the devices in parallel, and record them
+    try:
+        devices = Device.query.filter(Device.name != '__local_store_SCP__').all()
+    except Exception as e:
+        logger.error('Unknown error ocurred when searching devices in database')
+        logger.error(repr(e))
+        return jsonify(message = "Error al leer la base de datos"), 500
+
+    results = reprobe_devices({d.name: {attr:getattr(d, attr) for attr in ["ae_title","port","address","query_cache_ttl"]} for d in devices})
+    for d in devices:
+        d.update_capabilities(results[d.name])
+    db.session.commit()
+    failed = [name for name, result in results.items() if result['transfer_syntaxes'] is None]
+    logger.info(f'capabilities of {len(devices) - len(failed)} devices updated')
+
+    return {"data": results, "failed": failed}
+
 @application.route('/config')
 def render_config():
     return render_template('config.html')
@@ -639,8 +777,9 @@ def manage_local_device():
         store_scp.port = request.json['port']
         store_scp.address = request.json["address"]
         store_scp.start_store_scp()
-        # If succesful, commit changes to database
+        # If succesful, commit changes to database and rebuild the shared interface with the new AE title
         db.session.commit()
+        shared_interface.reset()
         return {"message":"Local DICOM interface configuration was updated successfully"} 
     except Exception as e:
         # If failed, rollback database changes and try to restart store scp with original attributes
@@ -672,8 +811,8 @@ def test_local_device():
 
 @application.route('/echo_remote_device', methods=['GET', 'POST'])
 def echo_remote_device():       
-    echo_response = store_scp.echo(request.json)
-    if echo_response == 0:
+    # Echo the device even if it is known to be down, and update its health
+    if device_monitor.check(request.json, shared_interface.get()):
         return jsonify(message = f"DICOM ECHO to {request.json['ae_title']}@{request.json['address']}:{request.json['port']} succesful"), 200
     else:
         return jsonify(message = f"DICOM ECHO to {request.json['ae_title']}@{request.json['address']}:{request.json['port']} failed"), 500  
@@ -682,11 +821,34 @@ def echo_remote_device():
 @application.route('/ping_remote_device', methods=['GET', 'POST'])
 def ping_remote_device():   
 
-    ping_result = ping(request.json['address'], count = 2)
-    if ping_result:
-        return jsonify(message = request.json['address'] + ' is reacheable!!!'), 200
+    # Check that the port of the device accepts TCP connections
+    result = probe_devices({'device': request.json}, timeout = application.config['PROBE_TIMEOUT'], associate = False)['device']
+    if result['status'] == 'ok':
+        return jsonify(message = f"{request.json['address']}:{request.json['port']} is reacheable!!!"), 200
     else:
-        return jsonify(message = request.json['address'] + ' is unreacheable!!!'), 500  
+        return jsonify(message = f"{request.json['address']}:{request.json['port']} is unreacheable!!! ({result['error']})"), 500  
+
+@application.route('/probe_devices', methods=['GET', 'POST'])
+def probe_remote_devices():
+
+    # Probe all the devices, or the selected ones, concurrently (see probe_devices)
+    args = request.get_json(silent = True) or {}
+    try:
+        names = args.get('devices')
+        timeout = float(args.get('timeout', application.config['PROBE_TIMEOUT']))
+        assert timeout > 0
+        devices = Device.query.filter(Device.name != '__local_store_SCP__')
+        if names:
+            devices = devices.filter(Device.name.in_(names))
+        devices = {d.name: {attr:getattr(d, attr) for attr in ["ae_title","port","address"]} for d in devices.all()}
+    except (AssertionError, ValueError, TypeError):
+        return jsonify(message = "Parámetros inválidos"), 500
+    except Exception as e:
+        logger.error('Unknown error ocurred when searching devices in database')
+        logger.error(repr(e))
+        return jsonify(message = "Error al leer la base de datos"), 500
+
+    return {"data": probe_devices(devices, timeout = timeout, associate = args.get('associate', True))}
 
 @application.route('/update_device_filters', methods=['GET', 'POST'])
 def update_device_filters():   
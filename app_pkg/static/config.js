@@ -27,7 +27,26 @@ $(document).ready(function () {
         columns: [            
             { data: 'name', title:'Nombre' },
             { data: 'ae_title', title: 'AE Title' },
-            { data: 'address', title: 'Dirección' }
+            { data: 'address', title: 'Dirección' },
+            { data: 'health', title: 'Estado', render: function(health) {
+                var states = {'up': 'Activo', 'failing': 'Con fallas', 'down': 'Caído', 'unknown': 'Desconocido'}
+                var state = states[health.state]
+                if (health.state == 'up' && health.echo_ms !== null) {
+                    state += ' (' + health.association_ms + ' / ' + health.echo_ms + ' ms)'
+                }
+                return state
+            } },
+            { data: 'probe', title: 'Conexión', defaultContent: '-', render: function(probe) {
+                if (!probe) {
+                    return '-'
+                }
+                var states = {'ok': 'OK', 'unreachable': 'Inalcanzable', 'rejected': 'Asociación rechazada', 'timeout': 'Sin respuesta'}
+                var state = states[probe.status]
+                if (probe.status == 'ok') {
+                    state += ' (' + probe.tcp_ms + ' / ' + probe.association_ms + ' ms)'
+                }
+                return state
+            } }
         ],
         searching: false,
         paging: false,
@@ -49,6 +68,60 @@ $(document).ready(function () {
         }
     });
         
+    // Probe all the devices at once
+    $("#probeDevices").on('click', function(event) {
+        var button = $(this)
+        button[0].innerHTML = `<span class="spinner-border spinner-border-sm"></span>`
+        button.prop('disabled', true);
+        $.ajax({
+            url: "/probe_devices",
+            method: "POST",
+            data:   JSON.stringify({}),
+            dataType: "json",
+            contentType: "application/json",
+            success: function(response) {
+                devices_table.rows().every(function() {
+                    var device = this.data()
+                    device.probe = response.data[device.name]
+                    this.invalidate()
+                })
+                devices_table.draw(false)
+            },
+            error: function(xhr, status, error) {
+                console.log(xhr.responseText);
+            },
+            complete: function() {
+                button[0].innerHTML = 'Probar'
+                button.prop('disabled', false)
+            }
+        });
+    });
+
+    // Find the capabilities of all the devices again
+    $("#reprobeDevices").on('click', function(event) {
+        var button = $(this)
+        button[0].innerHTML = `<span class="spinner-border spinner-border-sm"></span>`
+        button.prop('disabled', true);
+        $.ajax({
+            url: "/reprobe_devices",
+            method: "POST",
+            dataType: "json",
+            success: function(response) {
+                if (response.failed.length) {
+                    alert('No se pudo conectar con: ' + response.failed.join(', '))
+                }
+                devices_table.ajax.reload()
+            },
+            error: function(xhr, status, error) {
+                console.log(xhr.responseText);
+            },
+            complete: function() {
+                button[0].innerHTML = 'Re-detectar'
+                button.prop('disabled', false)
+            }
+        });
+    });
+
     //////////////////////////// Device manager //////////////////////////////
 
     // Local device manager
@@ -128,6 +201,8 @@ $(document).ready(function () {
         $('#deviceManagerPort').val(data.address.split(":")[1])
         $('#deviceManagerImgsSeries').val(data.imgs_series)  
         $('#deviceManagerImgsStudy').val(data.imgs_study)     
+        $('#deviceManagerStoreAssociations').val(data.store_associations)
+        $('#deviceManagerQueryCacheTtl').val(data.query_cache_ttl)
     })
 
     // Delete device
@@ -166,7 +241,9 @@ $(document).ready(function () {
             "address": $('#deviceManagerIP').val(),
             "port": $('#deviceManagerPort').val(),
             "imgs_series": $('#deviceManagerImgsSeries').val(),  
-            "imgs_study": $('#deviceManagerImgsStudy').val()  
+            "imgs_study": $('#deviceManagerImgsStudy').val(),
+            "store_associations": $('#deviceManagerStoreAssociations').val(),
+            "query_cache_ttl": $('#deviceManagerQueryCacheTtl').val()
         }
 
         $.ajax({
@@ -196,7 +273,8 @@ $(document).ready(function () {
         $(this).prop('disabled', true);
                 
         var ajax_data = {
-            "address": $('#deviceManagerIP').val()
+            "address": $('#deviceManagerIP').val(),
+            "port": parseInt($('#deviceManagerPort').val())
         }
         $.ajax({
             url: "/ping_remote_device",
@@ -271,6 +349,7 @@ $(document).ready(function () {
         })
         
         var ajax_data = {
+            "name": $('#deviceManagerName').val(),
             "ae_title":  $('#deviceManagerAET').val(),
             "address": $('#deviceManagerIP').val(),
             "port": $('#deviceManagerPort').val()
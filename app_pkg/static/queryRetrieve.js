@@ -14,9 +14,11 @@ $(document).ready(function () {
         info: false,
         initComplete: function() {
             
-            // Select last selected device
+            // Select last selected devices
             if (localStorage.getItem('sourceDevice') !== null) {
-                devices_table.row(localStorage.getItem("sourceDevice")).select()
+                localStorage.getItem("sourceDevice").split(",").forEach(function(idx) {
+                    devices_table.row(idx).select()
+                })
             } else {
                 devices_table.row().select()
             }
@@ -25,9 +27,15 @@ $(document).ready(function () {
         },            
     });
 
-    // Enable select behaviour for device table
-    $('#devices tbody').on('click', 'tr', function () {                
-        if (!$(this).hasClass('selected')) {                  
+    // Enable select behaviour for device table. Ctrl/Cmd + click selects several devices (federated search)
+    $('#devices tbody').on('click', 'tr', function (event) {                
+        if (event.ctrlKey || event.metaKey) {
+            if (!$(this).hasClass('selected')) {
+                devices_table.row($(this)).select()
+            } else if (devices_table.rows({ selected: true }).count() > 1) {
+                devices_table.row($(this)).deselect()
+            }
+        } else if (!$(this).hasClass('selected') || devices_table.rows({ selected: true }).count() > 1) {                  
             devices_table.rows().deselect()
             devices_table.row($(this)).select()
         }
@@ -93,25 +101,7 @@ function initStudiesTable() {
     
     var devices_table = $('#devices').DataTable()
     var table_studies = $('#studies').DataTable({
-        ajax: {
-            url: "/empty_table",
-            method: "POST",
-            data: function() {
-                    return JSON.stringify({
-                        'dateSelector':$("[name='date']:checked").val(),
-                        'startDate': $("#startDate").val(),
-                        'endDate': $("#endDate").val(),
-                        'device': devices_table.rows({ selected: true }).data()[0].name,
-                        'modalities': $("[name='modality']:checked").map(function() {
-                            return this.value
-                        }).get(),
-                        'searchField':$( "#search-field" ).val(),
-                        'searchValue':$("#search-value").val()
-                    })
-                },
-            contentType: 'application/json',
-            dataType: "json"
-          },              
+        data: [],
         columns: [
             {
                 className: 'dt-control',
@@ -125,7 +115,9 @@ function initStudiesTable() {
             { data: 'StudyTime', title: 'Hora' },
             { data: 'ModalitiesInStudy', title: 'Modalidades' },
             { data: 'StudyDescription', title: 'Descripcion' },
-            { data: 'ImgsStudy', title: 'Imgs' }
+            { data: 'ImgsStudy', title: 'Imgs' },
+            { data: 'sources', title: 'Origen', defaultContent: '',
+              render: function(data, type, row) { return (data || [row.source]).join(', ') } }
         ],
         order: [[3, 'asc'],[4, 'asc']],
         language: {
@@ -139,8 +131,6 @@ function initStudiesTable() {
         scrollY: '300px',
         filter: false,
         initComplete: function() {
-            // Change ajax target
-            table_studies.ajax.url('/search_studies')
             // Initialize table with data stored locally
             if (localStorage.getItem('studiesTable') !== null) {
                 data = JSON.parse(localStorage.getItem('studiesTable'))
@@ -167,9 +157,23 @@ function initStudiesTable() {
         endDate = $("#endDate").val()
         modalities = $("[name='modality']:checked").map(function() {
             return this.value
-        }).get(),
+        }).get()
         
-        table_studies.ajax.reload( function() {
+        var query = {
+            'dateSelector':$("[name='date']:checked").val(),
+            'startDate': $("#startDate").val(),
+            'endDate': $("#endDate").val(),
+            'devices': devices_table.rows({ selected: true }).data().toArray().map(function(device) {
+                return device.name
+            }),
+            'modalities': $("[name='modality']:checked").map(function() {
+                return this.value
+            }).get(),
+            'searchField':$( "#search-field" ).val(),
+            'searchValue':$("#search-value").val()
+        }
+
+        searchStudies(table_studies, query, function() {
             // Store the data locally to be shown after refreshing the page    
             localStorage.setItem("studiesTable",JSON.stringify(table_studies.rows().data().toArray()))
             localStorage.setItem("sourceDevice", sourceDevice)
@@ -231,6 +235,87 @@ function initStudiesTable() {
     });
 }
 
+// Search studies, adding the rows to the table as they arrive (the results are streamed, one JSON object per line)
+function searchStudies(table, query, callback) {
+
+    var rows = {}
+    var timedOut = []
+    var truncated = []
+    var maxResults = 0
+    var pending = ''
+    var lastDraw = 0
+    var decoder = new TextDecoder()
+    var button = $("#search_studies button[type='submit']")
+    button.prop('disabled', true)
+
+    function handle(line) {
+        if (!line.trim()) {
+            return
+        }
+        var event = JSON.parse(line)
+        if (event.type == 'study') {
+            rows[event.data.StudyInstanceUID] = table.row.add(event.data)
+        } else if (event.type == 'source') {
+            // Study already shown, found in another device
+            var row = rows[event.StudyInstanceUID]
+            var data = row.data()
+            data.sources.push(event.source)
+            if (event.ImgsStudy !== undefined) {
+                data.ImgsStudy = event.ImgsStudy
+            }
+            row.data(data)
+        } else if (event.type == 'end') {
+            timedOut = event.timed_out
+            truncated = event.truncated
+            maxResults = event.max_results
+        }
+    }
+
+    fetch('/search_studies', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json', 'Accept': 'application/x-ndjson' },
+        body: JSON.stringify(query)
+    }).then(function(response) {
+        if (!response.ok) {
+            return response.json().then(function(json) { alert(json.message) })
+        }
+        var reader = response.body.getReader()
+        function read() {
+            return reader.read().then(function(result) {
+                pending += decoder.decode(result.value || new Uint8Array(), { stream: !result.done })
+                var lines = pending.split('\n')
+                pending = lines.pop()
+                lines.forEach(handle)
+                if (result.done) {
+                    handle(pending)
+                    return
+                }
+                // Draw the rows received so far (at most twice per second, drawing is slow for large tables)
+                if (Date.now() - lastDraw > 500) {
+                    table.draw(false)
+                    lastDraw = Date.now()
+                }
+                return read()
+            })
+        }
+        return read()
+    }).catch(function(error) {
+        console.log(error)
+    }).finally(function() {
+        table.draw(false)
+        button.prop('disabled', false)
+        // Warn about the devices that didn't answer in time
+        if (timedOut.length > 0) {
+            alert(`Sin respuesta a tiempo de: ${timedOut.join(', ')}`)
+        }
+        // Warn about the devices with more results than shown
+        if (truncated.length > 0) {
+            alert(`Se muestran solo los primeros ${maxResults} estudios de: ${truncated.join(', ')}. Refine la búsqueda.`)
+        }
+        callback()
+    })
+}
+
 function initDestinations() {
     // Append local device
     $('#destinations').append($('<option>', { 'Local' : 'Local' }).text('Local'));
@@ -0,0 +1,171 @@
+"""
+
+    Benchmark of the study search over a wide date range, sent as a single C-FIND or split in day or week
+    ranges queried in parallel (see DicomInterface.iter_query_device_by_date).
+
+    Starts a simulated PACS on localhost (a C-FIND SCP with studies-per-day synthetic studies on each of the
+    last days, in its own process so that it doesn't share the GIL with the SCU) whose answers get slower with
+    the width of the date range: each query waits scan seconds per day of its range, plus latency seconds,
+    before the first response, and per-response seconds between responses.
+
+    Reports the time to the first study, the total time and the number of studies of each mode, and checks
+    that every mode returns the same studies in date order.
+
+    The benchmark runs in a temporary directory, with a temporary SQLite database.
+
+    Usage (from the repository root):
+        python benchmarks/date_chunk_search_benchmark.py --days 60 --studies-per-day 20 --associations 4
+        python benchmarks/date_chunk_search_benchmark.py --days 90 --scan 0.1 --modes single week day
+
+"""
+
+import os, sys, argparse, tempfile, json
+import multiprocessing as mp
+from datetime import datetime, timedelta
+from time import perf_counter, sleep
+
+from pydicom.dataset import Dataset
+from pynetdicom import AE, evt
+from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelFind, Verification
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def simulated_pacs(port: int, days: int, studies_per_day: int, latency: float, scan: float, per_response: float, ready, stop):
+
+    """ Runs the C-FIND SCP of the simulated PACS until stop is set (ready is set when it is listening) """
+
+    today = datetime.today()
+    studies = []
+    for day in range(days):
+        date = (today - timedelta(days = days - 1 - day)).strftime('%Y%m%d')
+        for idx in range(studies_per_day):
+            studies.append((date, f'{8 + idx % 12:02d}{idx % 60:02d}00', f'1.2.826.0.1.3680043.10.999.{day}.{idx}'))
+
+    def handle_find(event):
+        query = event.identifier
+        dates = str(query.get('StudyDate', '')) or '-'
+        start, _, end = dates.partition('-') if '-' in dates else (dates, '', dates)
+        start, end = start or '00000000', end or '99999999'
+        # Scanning a wider range takes longer
+        width = (datetime.strptime(min(end, today.strftime('%Y%m%d')), '%Y%m%d') -
+                 datetime.strptime(max(start, studies[0][0]), '%Y%m%d')).days + 1
+        sleep(latency + scan * max(width, 0))
+        for date, time, uid in studies:
+            if not start <= date <= end:
+                continue
+            if event.is_cancelled:
+                yield (0xFE00, None)
+                return
+            sleep(per_response)
+            ds = Dataset()
+            ds.QueryRetrieveLevel = 'STUDY'
+            ds.StudyDate = date
+            ds.StudyTime = time
+            ds.StudyInstanceUID = uid
+            ds.PatientName = 'Benchmark^Patient'
+            yield (0xFF00, ds)
+
+    ae = AE(ae_title = 'BENCHMARK_PACS')
+    ae.add_supported_context(StudyRootQueryRetrieveInformationModelFind)
+    ae.add_supported_context(Verification)
+    ae.maximum_associations = 16
+
+    server = ae.start_server(('127.0.0.1', port), block = False, evt_handlers = [(evt.EVT_C_FIND, handle_find)])
+    ready.set()
+    stop.wait()
+    server.shutdown()
+
+def search(interface, device: dict, studydate: str, mode: str, associations: int) -> dict:
+
+    """ Runs the study search in one mode. Returns the timings and the (StudyDate, StudyTime, uid) found """
+
+    from services.dicom_interface import study_query
+
+    query = study_query({'StudyDate': studydate}, {'PatientName': '', 'StudyTime': ''})
+    start = perf_counter()
+    first = None
+    found = []
+    if mode == 'single':
+        responses = interface.iter_query_device(device, query)
+    else:
+        responses = interface.iter_query_device_by_date(device, query, mode, associations = associations)
+    for response in responses:
+        if first is None:
+            first = perf_counter() - start
+        found.append((str(response.StudyDate), str(response.StudyTime), str(response.StudyInstanceUID)))
+
+    return {'first_s': first, 'elapsed_s': perf_counter() - start, 'studies': found}
+
+def run(args) -> dict:
+
+    # Import the application inside the temporary working directory
+    from app_pkg import application, db
+    from services.dicom_interface import DicomInterface
+
+    with application.app_context():
+        db.create_all()
+
+    ctx = mp.get_context('spawn')
+    ready, stop = ctx.Event(), ctx.Event()
+    pacs = ctx.Process(target = simulated_pacs, daemon = True,
+                       args = (args.port, args.days, args.studies_per_day, args.latency, args.scan, args.per_response, ready, stop))
+    pacs.start()
+    ready.wait(60)
+    interface = DicomInterface(ae_title = 'BENCHMARK')
+    interface.pool.max_size = max(interface.pool.max_size, args.associations)
+    device = {'ae_title': 'BENCHMARK_PACS', 'address': '127.0.0.1', 'port': args.port}
+    today = datetime.today()
+    studydate = (today - timedelta(days = args.days - 1)).strftime('%Y%m%d') + '-' + today.strftime('%Y%m%d')
+
+    report = {'days': args.days, 'studies_per_day': args.studies_per_day, 'associations': args.associations}
+    try:
+        expected = None
+        for mode in args.modes:
+            result = search(interface, device, studydate, mode, args.associations)
+            studies = result.pop('studies')
+            result['studies'] = len(studies)
+            result['date_order'] = [study[:2] for study in studies] == sorted(study[:2] for study in studies)
+            expected = expected or sorted(studies)
+            result['same_studies'] = sorted(studies) == expected
+            report[mode] = result
+    finally:
+        interface.pool.clear()
+        stop.set()
+        pacs.join()
+
+    return report
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Date range chunked study search benchmark')
+    parser.add_argument('--days', type = int, default = 60, help = 'days in the date range')
+    parser.add_argument('--studies-per-day', type = int, default = 20)
+    parser.add_argument('--associations', type = int, default = 4, help = 'parallel associations of the chunked modes')
+    parser.add_argument('--latency', type = float, default = 0.05, help = 'seconds before the first response of each query')
+    parser.add_argument('--scan', type = float, default = 0.05, help = 'seconds per day of the range of each query')
+    parser.add_argument('--per-response', type = float, default = 0.001, help = 'seconds between responses')
+    parser.add_argument('--modes', nargs = '+', choices = ['single', 'week', 'day'], default = ['single', 'week', 'day'])
+    parser.add_argument('--port', type = int, default = 11510)
+    parser.add_argument('--json', action = 'store_true', help = 'print the report as JSON')
+    args = parser.parse_args()
+
+    # Run in a temporary directory, with a temporary database
+    workdir = tempfile.mkdtemp(prefix = 'date_chunk_search_benchmark_')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'benchmark.db')
+    os.environ.setdefault('LOGGING_FILE', os.path.join(workdir, 'output.log'))
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+
+    report = run(args)
+
+    if args.json:
+        print(json.dumps(report, indent = 2))
+    else:
+        for key, value in report.items():
+            if isinstance(value, dict):
+                value = ', '.join(f'{k}: {v:.2f}' if isinstance(v, float) else f'{k}: {v}' for k, v in value.items())
+            print(f'{key:>16}: {value}')
+    print(f'{"workdir":>16}: {workdir}')
+
+if __name__ == '__main__':
+    main()
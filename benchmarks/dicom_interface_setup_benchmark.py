@@ -0,0 +1,98 @@
+"""
+
+    Microbenchmark of the per-request setup of the SCU DicomInterface.
+
+    Compares the setup that the routes, the task handlers and the storage check used to do for each
+    request (look up the local device in the database and build a new DicomInterface with its AE and
+    presentation contexts) with getting the process-wide interface from services.interface_registry.
+
+    Reports the mean time per request and the requests/s of each setup.
+
+    The benchmark runs in a temporary directory, with a temporary SQLite database.
+
+    Usage (from the repository root):
+        python benchmarks/dicom_interface_setup_benchmark.py --requests 2000
+
+"""
+
+import os, sys, argparse, tempfile, json
+from time import perf_counter
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def per_request_setup(application, Device, DicomInterface):
+
+    """ The setup done by each request before the shared interface """
+
+    with application.app_context():
+        local_device = Device.query.get('__local_store_SCP__')
+        ae = DicomInterface(ae_title = local_device.ae_title, address = local_device.address, acse_timeout = 120)
+        # The PACS interface of the storage check was built from a second lookup
+        local_device = Device.query.get('__local_store_SCP__')
+
+    return ae
+
+def measure(setup, requests: int) -> dict:
+
+    setup()
+    start = perf_counter()
+    for _ in range(requests):
+        setup()
+    elapsed = perf_counter() - start
+
+    return {'mean_us': 1e6 * elapsed / requests, 'requests_per_s': requests / elapsed}
+
+def run(args) -> dict:
+
+    # Import the application inside the temporary working directory
+    from app_pkg import application, db
+    from app_pkg.db_models import Device
+    from services.dicom_interface import DicomInterface
+    from services.interface_registry import shared_interface
+
+    with application.app_context():
+        db.create_all()
+        if not Device.query.get('__local_store_SCP__'):
+            db.session.add(Device(name = '__local_store_SCP__', ae_title = 'BENCHMARK', address = '127.0.0.1', port = 11500))
+            db.session.commit()
+
+    per_request = measure(lambda: per_request_setup(application, Device, DicomInterface), args.requests)
+    shared = measure(shared_interface.get, args.requests)
+
+    return {
+        'requests': args.requests,
+        'per_request_mean_us': per_request['mean_us'],
+        'per_request_requests_per_s': per_request['requests_per_s'],
+        'shared_mean_us': shared['mean_us'],
+        'shared_requests_per_s': shared['requests_per_s'],
+        'speedup': per_request['mean_us'] / shared['mean_us'],
+        'shared_builds': shared_interface.builds,
+    }
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'DicomInterface setup microbenchmark')
+    parser.add_argument('--requests', type = int, default = 2000, help = 'number of simulated requests')
+    parser.add_argument('--json', action = 'store_true', help = 'print the report as JSON')
+    args = parser.parse_args()
+
+    # Run in a temporary directory, with a temporary database
+    workdir = tempfile.mkdtemp(prefix = 'dicom_interface_setup_benchmark_')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'benchmark.db')
+    os.environ.setdefault('LOGGING_FILE', os.path.join(workdir, 'output.log'))
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+
+    report = run(args)
+
+    if args.json:
+        print(json.dumps(report, indent = 2))
+    else:
+        for key, value in report.items():
+            if isinstance(value, float):
+                value = f'{value:.2f}'
+            print(f'{key:>28}: {value}')
+    print(f'{"workdir":>28}: {workdir}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+"""
+
+    Throughput benchmark for the Store SCP.
+
+    Starts a DicomInterface Store SCP on localhost with the selected store handler, and drives it with
+    N concurrent SCU associations (each one in its own process, so that the load generator doesn't share
+    the GIL with the SCP) sending synthetic CT datasets of configurable size.
+
+    Reports instances/s, MB/s and the p50/p95/p99 latency of each C-STORE. For the database store handler,
+    it also reports the time needed to drain the ingest pipeline and the group-commit writer after the
+    last C-STORE response, and the end-to-end rate including that time. With --processes N, the database
+    store handler runs in N Store SCP worker processes (see services.store_scp_workers).
+
+    The benchmark runs in a temporary directory, with a temporary SQLite database.
+
+    Usage (from the repository root):
+        python benchmarks/store_scp_benchmark.py --handler store --associations 4 --instances 500 --size 524288
+        python benchmarks/store_scp_benchmark.py --handler default --associations 4 --instances 500
+        python benchmarks/store_scp_benchmark.py --handler store --processes 4 --associations 8 --instances 250
+
+"""
+
+import os, sys, argparse, tempfile, json
+import multiprocessing as mp
+from time import perf_counter, time, sleep
+
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ImplicitVRLittleEndian, generate_uid
+from pynetdicom import AE
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CT_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.2'
+
+def synthetic_dataset(nbytes: int):
+
+    """
+
+        Builds a CT dataset with nbytes of pixel data (rounded to a whole number of 16-bit rows of 512 columns).
+
+    """
+
+    ds = Dataset()
+    ds.SpecificCharacterSet = 'ISO_IR 100'
+    ds.PatientID = 'BENCHMARK'
+    ds.PatientName = 'Benchmark^Patient'
+    ds.StudyDate = '20240101'
+    ds.StudyTime = '120000'
+    ds.StudyDescription = 'Store SCP benchmark'
+    ds.SeriesDate = '20240101'
+    ds.SeriesTime = '120000'
+    ds.SeriesDescription = 'Synthetic CT'
+    ds.SeriesNumber = 1
+    ds.Modality = 'CT'
+    ds.SOPClassUID = CT_IMAGE_STORAGE
+    ds.Columns = 512
+    ds.Rows = max(1, nbytes // 1024)
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.PixelData = b'\x00\x01' * (ds.Rows * ds.Columns)
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ImplicitVRLittleEndian
+    ds.is_little_endian = True
+    ds.is_implicit_VR = True
+
+    return ds
+
+def scu_worker(port: int, instances: int, nbytes: int, series_size: int, max_pdu: int) -> dict:
+
+    """
+
+        Opens one association with the SCP and sends instances datasets, starting a new series every
+        series_size instances. Returns the latency of each C-STORE, the number of failures and the
+        time window of the association.
+
+    """
+
+    ae = AE(ae_title = 'BENCHMARK')
+    ae.add_requested_context(CT_IMAGE_STORAGE)
+    ae.acse_timeout = ae.dimse_timeout = ae.network_timeout = 120
+    ae.maximum_pdu_size = max_pdu
+    ds = synthetic_dataset(nbytes)
+    ds.StudyInstanceUID = generate_uid()
+
+    latencies = []
+    failed = 0
+    start = time()
+    assoc = ae.associate('127.0.0.1', port, ae_title = 'BENCHMARK')
+    if not assoc.is_established:
+        return {'latencies': latencies, 'failed': instances, 'start': start, 'end': time()}
+
+    for idx in range(instances):
+        if idx % series_size == 0:
+            ds.SeriesInstanceUID = generate_uid()
+        ds.SOPInstanceUID = generate_uid()
+        ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+        sent_at = perf_counter()
+        status = assoc.send_c_store(ds)
+        latencies.append(perf_counter() - sent_at)
+        if not status or status.Status != 0:
+            failed += 1
+
+    assoc.release()
+
+    return {'latencies': latencies, 'failed': failed, 'start': start, 'end': time()}
+
+def percentile(values: list, p: float) -> float:
+
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    idx = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[idx]
+
+def wait_for_ingest(timeout: float = 600) -> None:
+
+    """
+
+        Waits until the ingest pipeline and the group-commit writer are empty.
+
+    """
+
+    from services.db_store_handler import ingest_writer, ingest_pipeline
+
+    start = perf_counter()
+    while perf_counter() - start < timeout:
+        if not ingest_pipeline.get_stats()['queued'] and not ingest_writer.records.qsize() and not ingest_writer.pending:
+            return
+        sleep(0.01)
+
+def wait_for_rows(instances: int, timeout: float = 600) -> None:
+
+    """
+
+        Waits until the database holds instances rows (the worker processes' queues can't be inspected).
+
+    """
+
+    from app_pkg import application, db
+    from app_pkg.db_models import Instance
+
+    start = perf_counter()
+    while perf_counter() - start < timeout:
+        with application.app_context():
+            if db.session.query(Instance).count() >= instances:
+                return
+        sleep(0.05)
+
+def run(args) -> dict:
+
+    # Import the application inside the temporary working directory
+    from app_pkg import application, db
+    from services import store_scp, ingest_writer, ingest_pipeline, ingest_sessions
+    from services.db_store_handler import store_handler
+    from services.dicom_interface import DicomInterface, default_store_handler
+    from services.store_scp_workers import MultiProcessStoreSCP
+
+    with application.app_context():
+        db.create_all()
+
+    if args.handler == 'store' and args.processes > 1:
+        # The worker processes read their configuration from the environment
+        os.environ['STORE_SCP_WRITE_MODE'] = args.write_mode
+        os.environ['INGEST_DURABILITY'] = args.durability
+        os.environ['STORE_SCP_MAX_ASSOCIATIONS'] = str(args.associations)
+        scp = MultiProcessStoreSCP(processes = args.processes, ae_title = 'BENCHMARK_SCP')
+    elif args.handler == 'store':
+        scp = store_scp
+        scp.store_handler = lambda event: store_handler(event, 'incoming', args.write_mode, 'reject', args.durability)
+        ingest_writer.start()
+        ingest_sessions.start()
+        ingest_pipeline.start()
+    else:
+        scp = DicomInterface(ae_title = 'BENCHMARK_SCP',
+                             store_handler = lambda event: default_store_handler(event, write_raw = args.write_mode == 'raw'))
+    scp.max_associations = max(scp.max_associations, args.associations)
+    scp.address = '127.0.0.1'
+    scp.port = args.port
+    scp.start_store_scp()
+
+    try:
+        ctx = mp.get_context('spawn')
+        with ctx.Pool(args.associations) as pool:
+            results = pool.starmap(scu_worker, [(args.port, args.instances, args.size, args.series_size, args.max_pdu)] * args.associations)
+            if args.handler == 'store' and args.processes > 1:
+                wait_for_rows(sum(len(r['latencies']) - r['failed'] for r in results))
+            elif args.handler == 'store':
+                wait_for_ingest()
+            # Measure from the first association request to the last release (or to the end of the ingest)
+            start = min(r['start'] for r in results)
+            elapsed = max(r['end'] for r in results) - start
+            drained = time() - start
+            associations_stats = scp.get_association_stats()
+    finally:
+        scp.stop_store_scp()
+        if args.handler == 'store' and args.processes == 1:
+            ingest_pipeline.stop()
+            ingest_sessions.stop()
+            ingest_writer.stop()
+
+    latencies = [latency for r in results for latency in r['latencies']]
+    sent = len(latencies)
+    megabytes = sent * args.size / 2**20
+    report = {
+        'handler': args.handler,
+        'write_mode': args.write_mode,
+        'durability': args.durability,
+        'processes': args.processes,
+        'associations': args.associations,
+        'instances': sent,
+        'failed': sum(r['failed'] for r in results),
+        'instance_size': args.size,
+        'elapsed_s': elapsed,
+        'instances_per_s': sent / elapsed,
+        'mb_per_s': megabytes / elapsed,
+        'latency_p50_ms': 1000 * percentile(latencies, 50),
+        'latency_p95_ms': 1000 * percentile(latencies, 95),
+        'latency_p99_ms': 1000 * percentile(latencies, 99),
+    }
+    if args.handler == 'store':
+        report['drain_s'] = drained - elapsed
+        report['end_to_end_instances_per_s'] = sent / drained
+    if args.handler == 'store' and args.processes == 1:
+        report['ingest'] = ingest_writer.get_stats()
+        report['sessions'] = ingest_sessions.get_stats()
+    if args.handler == 'store':
+        report['associations_stats'] = associations_stats
+
+    return report
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Store SCP throughput benchmark')
+    parser.add_argument('--handler', choices = ['store', 'default'], default = 'store',
+                        help = 'store: services.db_store_handler.store_handler, default: dicom_interface.default_store_handler')
+    parser.add_argument('--write-mode', choices = ['decode', 'raw'], default = 'decode')
+    parser.add_argument('--durability', choices = ['none', 'batch', 'instance'], default = 'none',
+                        help = 'fsync policy of the database store handler')
+    parser.add_argument('--processes', type = int, default = 1,
+                        help = 'Store SCP worker processes of the database store handler (SO_REUSEPORT)')
+    parser.add_argument('--associations', type = int, default = 4, help = 'number of concurrent SCU associations')
+    parser.add_argument('--instances', type = int, default = 250, help = 'instances sent on each association')
+    parser.add_argument('--size', type = int, default = 512 * 1024, help = 'pixel data size of each instance, in bytes')
+    parser.add_argument('--series-size', type = int, default = 100, help = 'instances per series')
+    parser.add_argument('--max-pdu', type = int, default = 16382, help = 'maximum PDU size of the SCU (0: unlimited)')
+    parser.add_argument('--port', type = int, default = 11500)
+    parser.add_argument('--json', action = 'store_true', help = 'print the report as JSON')
+    args = parser.parse_args()
+
+    # Run in a temporary directory, with a temporary database
+    workdir = tempfile.mkdtemp(prefix = 'store_scp_benchmark_')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'benchmark.db')
+    os.environ.setdefault('LOGGING_FILE', os.path.join(workdir, 'output.log'))
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    # The Store SCP worker processes are forked from a server process that doesn't inherit sys.path
+    os.environ['PYTHONPATH'] = os.pathsep.join(filter(None, [REPO_DIR, os.environ.get('PYTHONPATH')]))
+
+    report = run(args)
+
+    if args.json:
+        print(json.dumps(report, indent = 2))
+    else:
+        for key, value in report.items():
+            if isinstance(value, float):
+                value = f'{value:.2f}'
+            print(f'{key:>28}: {value}')
+    print(f'{"workdir":>28}: {workdir}')
+
+if __name__ == '__main__':
+    main()
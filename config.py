@@ -6,4 +6,11 @@ class Config(object):
     TEMPLATES_AUTO_RELOAD = True
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'db','app.db')
-    
+    # Seconds to wait for each device in a federated study search (more than one device)
+    FEDERATED_SEARCH_TIMEOUT = float(os.environ.get('FEDERATED_SEARCH_TIMEOUT', 30))
+    # Studies returned by each device in a study search, the queries are cancelled after them (0: no limit)
+    SEARCH_MAX_RESULTS = int(os.environ.get('SEARCH_MAX_RESULTS', 2000))
+    # Split the date ranges of the study searches in 'day' or 'week' ranges queried in parallel (empty: don't split)
+    SEARCH_DATE_CHUNKS = os.environ.get('SEARCH_DATE_CHUNKS', '')
+    # Seconds to wait for the devices in a reachability probe (see probe_devices)
+    PROBE_TIMEOUT = float(os.environ.get('PROBE_TIMEOUT', 5))
@@ -1,8 +1,14 @@
-import os, logging, sys
+import os, logging, sys, atexit
+import multiprocessing as mp
 from sqlalchemy.exc import OperationalError
 from services.task_manager import TaskManager, CheckStorageManager
 from services.dicom_interface import DicomInterface
-from services.db_store_handler import store_handler
+from services.store_scp_workers import MultiProcessStoreSCP
+from services.association_pool import association_pool
+from services.device_monitor import device_monitor
+from services.interface_registry import shared_interface
+from services.db_store_handler import (setup_store_scp, ingest_writer, ingest_sessions, hierarchy_cache,
+                                      ingest_pipeline, instance_index)
 from services.loggers import app_logger, dicom_logger
 from app_pkg import application, db
 from app_pkg.db_models import Device
@@ -12,6 +18,14 @@ app_logger()
 dicom_logger()
 logger = logging.getLogger('__main__')
 
+def monitored_devices():
+
+    """ The remote devices checked by the device monitor """
+
+    with application.app_context():
+        return [{attr:getattr(d, attr) for attr in ["name","ae_title","port","address"]}
+                for d in Device.query.all() if d.name != '__local_store_SCP__']
+
 # Task Manager
 task_manager = TaskManager()
 check_storage_manager = CheckStorageManager()
@@ -21,6 +35,11 @@ aet = os.environ.get('DEFAULT_STORE_SCP_AET','DicomWeb')
 port = int(os.environ.get('DEFAULT_STORE_SCP_PORT', 11113))
 address = os.environ.get('DEFAULT_STORE_SCP_ADDRESS', '0.0.0.0')
 
+# Number of Store SCP processes. With more than one, the Store SCP runs in worker processes listening
+# on the same port with SO_REUSEPORT, each one with its own ingest path (see store_scp_workers). The
+# hierarchy cache (INGEST_CACHE_SIZE) is disabled in the worker processes
+processes = int(os.environ.get('STORE_SCP_PROCESSES', 1))
+
 with application.app_context():
     try:
         d = Device.query.get('__local_store_SCP__')                
@@ -46,8 +65,31 @@ with application.app_context():
         logger.info('creating local device with default settings.') 
     
     # Create an Store SCP to receive DICOM objects and store them in the database
-    store_scp = DicomInterface(ae_title = aet, port = port, address = address)
-    store_scp.store_handler = store_handler
-    if 'flask' in sys.argv[0] and 'run' in sys.argv:
+    if processes > 1:
+        store_scp = MultiProcessStoreSCP(processes = processes, ae_title = aet, port = port, address = address)
+    else:
+        store_scp = DicomInterface(ae_title = aet, port = port, address = address)
+    setup_store_scp(store_scp)
+    # The Store SCP worker processes import this package too: only start services in the main process
+    if 'flask' in sys.argv[0] and 'run' in sys.argv and mp.parent_process() is None:
+        if processes == 1:
+            try:
+                instance_index.load()
+            except OperationalError:
+                logger.info('instance index could not be loaded, duplicates will be looked up in the database.')
+            logger.info('starting ingest writer.')
+            ingest_writer.start()
+            atexit.register(ingest_writer.stop)
+            ingest_sessions.start()
+            atexit.register(ingest_sessions.stop)
+            logger.info('starting ingest pipeline.')
+            ingest_pipeline.start()
+            atexit.register(ingest_pipeline.stop)
+        atexit.register(association_pool.stop)
+        logger.info('starting device monitor.')
+        device_monitor.start(devices = monitored_devices, interface = shared_interface.get)
+        atexit.register(device_monitor.stop)
         logger.info('starting store_scp.') 
-        store_scp.start_store_scp()
\ No newline at end of file
+        store_scp.start_store_scp()
+        if processes > 1:
+            atexit.register(store_scp.stop_store_scp)
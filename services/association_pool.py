@@ -0,0 +1,337 @@
+import os, logging, threading
+from time import time
+from contextlib import contextmanager
+from pynetdicom.association import Association
+from pynetdicom.sop_class import Verification
+from typing import List
+
+logger = logging.getLogger('__main__')
+
+class AssociationError(RuntimeError):
+
+    """
+        Raised when an association with a device could not be established. rejected is True if the device answered
+        with an A-ASSOCIATE-RJ (e.g. it is busy), and False if it didn't answer or aborted the association.
+    """
+
+    def __init__(self, message: str, rejected: bool = False):
+
+        super().__init__(message)
+        self.rejected = rejected
+
+class AssociationPool():
+
+    """
+
+    Pool of SCU associations, shared by all the DicomInterfaces of the process (see association_pool),
+    so that queries and retrieves reuse open associations instead of negotiating a new one each time.
+
+    · Associations are pooled by (calling AE title, device, requested contexts). An association is used
+    by one caller at a time: it is taken with acquire and given back with release (or with the
+    association context manager).
+    · Each device (ae_title, address, port) has at most max_size open associations. If none is free when
+    one is needed, an idle association with the device for other contexts is closed, or the caller waits.
+    · Idle associations are released after idle_timeout seconds by a background thread.
+    · An association that has been idle for more than validate_after seconds is checked with a C-ECHO
+    before it is reused. Associations that are not established anymore are discarded.
+    · The pool must be stopped at exit (e.g. with atexit, see services). The pynetdicom association threads
+    are not daemon threads and the interpreter joins them before running the atexit functions, so the
+    background thread also releases the idle associations as soon as the main thread has finished.
+
+    """
+
+    def __init__(self, max_size: int = 4, idle_timeout: float = 60, validate_after: float = 10,
+                 wait_timeout: float = 30):
+
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.validate_after = validate_after
+        self.wait_timeout = wait_timeout
+
+        # Pool key -> list of (association, time of release)
+        self.idle = {}
+        # Device -> number of open associations (idle or in use)
+        self.open = {}
+        # Association -> pool key, for the associations in use
+        self.in_use = {}
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+
+        # Counters
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+        self.evicted = 0
+        self.waits = 0
+
+        self.main_thread = None
+
+    def start(self):
+
+        if self.main_thread and self.main_thread.is_alive():
+            return
+
+        # Set an event to stop the thread later
+        self.stop_event = threading.Event()
+
+        # Create and start the thread
+        self.main_thread = threading.Thread(target = self._main, args = (), daemon = True)
+        self.main_thread.start()
+
+    def stop(self):
+
+        """
+
+            Stops the background thread and releases all the idle associations.
+
+        """
+
+        if self.main_thread:
+            self.stop_event.set()
+            self.main_thread.join()
+        self.clear()
+
+    def acquire(self, ae, device: dict, contexts: List = None) -> Association:
+
+        """
+
+            Takes an association with a device from the pool, or opens a new one.
+
+            Args:
+                · ae: the pynetdicom AE that opens the association, if a new one is needed.
+                · device: a dict with the ae_title, address and port of the remote device.
+                · contexts: the requested presentation contexts (if None, the AE requested contexts).
+
+            Returns: an established association, that must be given back with release.
+
+            Raises:
+                AssociationError (a RuntimeError) if the association could not be established, or RuntimeError
+                if the device has max_size associations in use for more than wait_timeout seconds.
+
+        """
+
+        self.start()
+        target = (device['ae_title'], device['address'], int(device['port']))
+        key = (ae.ae_title, target, self._contexts_key(ae, contexts))
+        deadline = time() + self.wait_timeout
+
+        while True:
+            candidate, evicted = None, None
+            with self.available:
+                while True:
+                    # Reuse an idle association
+                    if self.idle.get(key):
+                        candidate = self.idle[key].pop()
+                        break
+                    # Open a new one if the device is below max_size, closing an idle association with
+                    # other contexts if needed
+                    if self.open.get(target, 0) >= self.max_size:
+                        evicted = self._evict_one(target)
+                    if self.open.get(target, 0) < self.max_size:
+                        self.open[target] = self.open.get(target, 0) + 1
+                        break
+                    # Wait for an association to be released
+                    self.waits += 1
+                    self.available.wait(timeout = max(0, deadline - time()))
+                    if time() >= deadline:
+                        raise RuntimeError(f"No association with {target[0]}@{target[1]}:{target[2]} became available")
+            self._close(evicted)
+
+            if candidate is None:
+                break
+            assoc, released = candidate
+            if self._validate(assoc, released):
+                with self.lock:
+                    self.in_use[assoc] = key
+                    self.reused += 1
+                return assoc
+            with self.available:
+                self._forget(target)
+                self.discarded += 1
+                self.available.notify_all()
+            self._close(assoc, abort = True)
+
+        # Negotiate a new association
+        try:
+            assoc = ae.associate(target[1], target[2], contexts, ae_title = target[0])
+        except Exception:
+            assoc = None
+        if assoc is None or not assoc.is_established:
+            with self.available:
+                self._forget(target)
+                self.available.notify_all()
+            if assoc is not None and assoc.is_rejected:
+                raise AssociationError(f"Association with {target[0]}@{target[1]}:{target[2]} was rejected", rejected = True)
+            raise AssociationError(f"Association with {target[0]}@{target[1]}:{target[2]} could not be established")
+
+        with self.lock:
+            self.in_use[assoc] = key
+            self.created += 1
+
+        return assoc
+
+    def release(self, assoc: Association, discard: bool = False) -> None:
+
+        """
+
+            Gives an association back to the pool. If discard is True, or the association is not
+            established anymore, it is closed instead (aborted if discard is True).
+
+        """
+
+        with self.available:
+            key = self.in_use.pop(assoc, None)
+            if key is None:
+                # Not from the pool
+                return
+            close = discard or not assoc.is_established
+            if close:
+                self._forget(key[1])
+                self.discarded += 1
+            else:
+                self.idle.setdefault(key, []).append((assoc, time()))
+            self.available.notify_all()
+
+        if close:
+            self._close(assoc, abort = True)
+
+    @contextmanager
+    def association(self, ae, device: dict, contexts: List = None):
+
+        """
+
+            Context manager that takes an association from the pool and gives it back. The association is
+            discarded if an exception is raised while it is in use.
+
+        """
+
+        assoc = self.acquire(ae, device, contexts)
+        try:
+            yield assoc
+        except Exception:
+            self.release(assoc, discard = True)
+            raise
+        else:
+            self.release(assoc)
+
+    def clear(self) -> None:
+
+        """ Releases all the idle associations """
+
+        self._release_idle(lambda released: True)
+
+    def evict_idle(self) -> None:
+
+        """ Releases the associations that have been idle for more than idle_timeout seconds """
+
+        evicted = self._release_idle(lambda released: time() - released > self.idle_timeout)
+        with self.lock:
+            self.evicted += evicted
+
+    def get_stats(self) -> dict:
+
+        with self.lock:
+            devices = {}
+            for key, items in self.idle.items():
+                name = '{}@{}:{}'.format(*key[1])
+                devices.setdefault(name, {'idle': 0, 'in_use': 0})['idle'] += len(items)
+            for key in self.in_use.values():
+                name = '{}@{}:{}'.format(*key[1])
+                devices.setdefault(name, {'idle': 0, 'in_use': 0})['in_use'] += 1
+
+            return {
+                'max_size': self.max_size,
+                'idle_timeout': self.idle_timeout,
+                'devices': devices,
+                'created': self.created,
+                'reused': self.reused,
+                'discarded': self.discarded,
+                'evicted': self.evicted,
+                'waits': self.waits,
+            }
+
+    def _main(self):
+
+        while not self.stop_event.wait(1):
+            # The process is exiting: release the associations before the interpreter joins their threads
+            if not threading.main_thread().is_alive():
+                self.clear()
+                break
+            self.evict_idle()
+
+    def _contexts_key(self, ae, contexts: List = None) -> tuple:
+
+        contexts = ae.requested_contexts if contexts is None else contexts
+        return tuple(sorted((cx.abstract_syntax, tuple(cx.transfer_syntax)) for cx in contexts))
+
+    def _validate(self, assoc: Association, released: float) -> bool:
+
+        """ Checks that an idle association can be reused """
+
+        if not assoc.is_established:
+            return False
+        if time() - released <= self.validate_after:
+            return True
+        if not any(cx.abstract_syntax == Verification for cx in assoc.accepted_contexts):
+            return True
+        try:
+            status = assoc.send_c_echo()
+            return bool(status) and status.Status == 0
+        except Exception:
+            return False
+
+    def _release_idle(self, condition) -> int:
+
+        """ Closes the idle associations whose release time matches condition. Returns how many """
+
+        closing = []
+        with self.available:
+            for key, items in self.idle.items():
+                for item in [item for item in items if condition(item[1])]:
+                    items.remove(item)
+                    self._forget(key[1])
+                    closing.append(item[0])
+            if closing:
+                self.available.notify_all()
+
+        for assoc in closing:
+            self._close(assoc)
+        return len(closing)
+
+    def _evict_one(self, target: tuple) -> Association:
+
+        """ Takes the oldest idle association with a device out of the pool, if any (called with the lock held) """
+
+        candidates = [(items[0][1], key) for key, items in self.idle.items() if key[1] == target and items]
+        if not candidates:
+            return None
+        _, key = min(candidates)
+        assoc, _ = self.idle[key].pop(0)
+        self._forget(target)
+        self.evicted += 1
+        return assoc
+
+    def _forget(self, target: tuple) -> None:
+
+        """ Stops counting an open association with a device (called with the lock held) """
+
+        self.open[target] = self.open.get(target, 1) - 1
+        if not self.open[target]:
+            del self.open[target]
+
+    def _close(self, assoc: Association = None, abort: bool = False) -> None:
+
+        if assoc is None or not assoc.is_established:
+            return
+        try:
+            if abort:
+                assoc.abort()
+            else:
+                assoc.release()
+        except Exception as e:
+            logger.debug(f'association could not be closed: {repr(e)}')
+
+# Associations shared by the whole application
+association_pool = AssociationPool(max_size = int(os.environ.get('ASSOCIATION_POOL_SIZE', 4)),
+                                   idle_timeout = float(os.environ.get('ASSOCIATION_POOL_IDLE_TIMEOUT', 60)),
+                                   validate_after = float(os.environ.get('ASSOCIATION_POOL_VALIDATE_AFTER', 10)))
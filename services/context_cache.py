@@ -0,0 +1,112 @@
+import os, logging, threading
+from time import time
+from pynetdicom.association import Association
+
+logger = logging.getLogger('__main__')
+
+class ContextCache():
+
+    """
+
+    Presentation contexts negotiated with each device, shared by all the DicomInterfaces of the process
+    (see context_cache), so that the contexts requested to a device can be built from what it accepted
+    before instead of from scratch.
+
+    · Each device (ae_title, address, port) and role has an entry with the transfer syntaxes accepted for
+    each abstract syntax, the transfer syntaxes proposed in contexts rejected because of the transfer
+    syntax, and the abstract syntaxes rejected for any other reason (e.g. not supported). The role is
+    'scu' for the contexts used by this application as SCU (e.g. C-STORE to the device) and 'scp' for the
+    contexts where it acts as SCP (e.g. the C-STORE sub-operations of a C-GET).
+    · Entries are merged from every negotiated association (see record), and expire ttl seconds after the
+    last negotiation, or when they are invalidated (e.g. when the device configuration changes).
+
+    """
+
+    def __init__(self, ttl: float = 3600):
+
+        self.ttl = ttl
+        # (device, role) -> {'time', 'accepted': {abstract syntax: [transfer syntaxes]},
+        #                    'rejected': {abstract syntax: {transfer syntaxes}}, 'unsupported': {abstract syntaxes}}
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, device: dict, assoc: Association, role: str = 'scu') -> None:
+
+        """ Merges the contexts negotiated in an association into the entry of the device """
+
+        key = (self._target(device), role)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time() - entry['time'] > self.ttl:
+                entry = self.entries[key] = {'time': time(), 'accepted': {}, 'rejected': {}, 'unsupported': set()}
+            entry['time'] = time()
+            for cx in assoc.accepted_contexts:
+                if (role == 'scu' and cx.as_scu) or (role == 'scp' and cx.as_scp):
+                    accepted = entry['accepted'].setdefault(cx.abstract_syntax, [])
+                    if cx.transfer_syntax[0] not in accepted:
+                        accepted.append(cx.transfer_syntax[0])
+            # The transfer syntaxes of the rejected contexts are taken from the requested ones
+            requested = {cx.context_id: cx for cx in assoc.requestor.requested_contexts}
+            for cx in assoc.rejected_contexts:
+                if cx.result == 0x04 and cx.context_id in requested:
+                    entry['rejected'].setdefault(cx.abstract_syntax, set()).update(requested[cx.context_id].transfer_syntax)
+                elif cx.result != 0x04:
+                    entry['unsupported'].add(cx.abstract_syntax)
+
+    def lookup(self, device: dict, role: str = 'scu') -> dict:
+
+        """
+
+            Returns the entry of a device (see the class docstring), or None if the device has not been
+            negotiated with recently.
+
+        """
+
+        key = (self._target(device), role)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time() - entry['time'] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return {'accepted': {uid: list(ts) for uid, ts in entry['accepted'].items()},
+                    'rejected': {uid: set(ts) for uid, ts in entry['rejected'].items()},
+                    'unsupported': set(entry['unsupported'])}
+
+    def invalidate(self, device: dict = None) -> None:
+
+        """ Discards the entries of a device (all of them if device is None) """
+
+        with self.lock:
+            if device is None:
+                self.entries.clear()
+                return
+            target = self._target(device)
+            for key in [key for key in self.entries if key[0] == target]:
+                del self.entries[key]
+
+    def get_stats(self) -> dict:
+
+        with self.lock:
+            return {
+                'ttl': self.ttl,
+                'devices': {'{}@{}:{}'.format(*key[0]) + f' ({key[1]})': {
+                                'accepted': len(entry['accepted']),
+                                'unsupported': len([uid for uid in entry['unsupported'] if uid not in entry['accepted']]),
+                                'age': time() - entry['time']}
+                            for key, entry in self.entries.items()},
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def _target(self, device: dict) -> tuple:
+
+        return (device['ae_title'], device['address'], int(device['port']))
+
+# Negotiated contexts shared by the whole application
+context_cache = ContextCache(ttl = float(os.environ.get('CONTEXT_CACHE_TTL', 3600)))
@@ -1,14 +1,62 @@
-import os, logging
+import os, logging, threading, json
 from pathlib import Path
 from datetime import datetime
+from time import time, sleep
+from queue import Queue, Empty
+from collections import deque, OrderedDict
+from pynetdicom import evt
 from pynetdicom.events import Event
 from pydicom.dataset import Dataset
+from sqlalchemy import insert, update, bindparam
 from app_pkg import application, db
 from app_pkg.db_models import Patient, Study, Series, Instance
-from typing import Union
+from services.dicom_interface import DicomInterface, read_encoded_tags, write_encoded_dataset
+from services.ingest_pipeline import IngestPipeline, DirectoryCache, write_file, sync_files
+from typing import Union, List, Callable
 
 logger = logging.getLogger('__main__')
 
+# Fields read from the received datasets to index them in the database
+INDEX_FIELDS = ['SOPClassUID', 'SOPInstanceUID', 'StudyDate', 'SeriesDate', 'StudyTime', 'SeriesTime',
+                'Modality', 'StudyDescription', 'SeriesDescription', 'PatientName', 'PatientID',
+                'StudyInstanceUID', 'SeriesInstanceUID', 'SeriesNumber']
+
+# 'decode' writes the decoded and re-encoded dataset, 'raw' writes the dataset as it was received
+STORE_SCP_WRITE_MODE = os.environ.get('STORE_SCP_WRITE_MODE', 'decode')
+
+# What to do with instances that already exist: 'reject' (answer 0x0117), 'ignore' (answer success
+# without writing anything) or 'replace' (overwrite the stored file)
+STORE_SCP_DUPLICATES = os.environ.get('STORE_SCP_DUPLICATES', 'reject')
+
+# When received files are flushed to disk: 'none' (left to the OS), 'batch' (all the files in a group
+# commit, before the commit) or 'instance' (each file, before its rename)
+INGEST_DURABILITY = os.environ.get('INGEST_DURABILITY', 'none')
+
+# File where the ingest writer keeps the records it could not commit (see IngestWriter). Each process
+# that runs an ingest writer needs its own file: the Store SCP workers use worker_dead_letter
+INGEST_DEAD_LETTER = os.environ.get('INGEST_DEAD_LETTER', 'ingest_dead_letter.jsonl')
+
+# If True, instance records are collected per association and written to the database one series at a
+# time (the session handlers must be added to the Store SCP, see session_handlers)
+INGEST_SESSIONS = os.environ.get('INGEST_SESSIONS', 'True') == 'True'
+
+# Admission control of the Store SCP: simultaneous associations, in total and from the same calling AE
+# (0: no limit), and the ingest pipeline load (0 to 1) above which new associations are rejected
+STORE_SCP_MAX_ASSOCIATIONS = int(os.environ.get('STORE_SCP_MAX_ASSOCIATIONS', 10))
+STORE_SCP_MAX_ASSOCIATIONS_PER_AE = int(os.environ.get('STORE_SCP_MAX_ASSOCIATIONS_PER_AE', 0))
+STORE_SCP_MAX_QUEUE_LOAD = float(os.environ.get('STORE_SCP_MAX_QUEUE_LOAD', 0.9))
+
+def join_modalities(*modalities: str) -> str:
+
+    """
+
+        Merges '/'-separated lists of modalities (as stored in Study.ModalitiesInStudy) into one,
+        without repetitions and sorted.
+
+    """
+
+    return '/'.join(sorted({m for value in modalities if value for m in value.split('/') if m}))
+
 # Some functions to manage database operations
 def db_create_patient(ds: Dataset) -> Patient:
     
@@ -72,6 +120,7 @@ def db_create_series(ds: Dataset, path: Union[str,Path]) -> Series:
                         path = str(path),
                         patient = patient,
                         study = study)
+        study.ModalitiesInStudy = join_modalities(study.ModalitiesInStudy, mod)
         db.session.add(series)
         db.session.commit()
         
@@ -91,34 +140,868 @@ def db_create_instance(ds: Dataset, filename: Union[str,Path]) -> Instance:
         patient = Patient.query.get(ds.PatientID) or db_create_patient(ds)
         study = Study.query.get(ds.StudyInstanceUID) or db_create_study(ds, Path(filename).parents[1])
         series = Series.query.get(ds.SeriesInstanceUID) or db_create_series(ds, Path(filename).parents[0])
+        file_meta = getattr(ds, 'file_meta', None)
+        size = os.path.getsize(filename) if os.path.exists(filename) else 0
         instance = Instance(SOPInstanceUID = uid, 
                             SOPClassUID = uid_class,
                             filename = str(filename),
+                            TransferSyntaxUID = getattr(file_meta, 'TransferSyntaxUID', None),
+                            size = size,
                             patient = patient,
                             study = study,
                             series = series)
+        for parent in [study, series]:
+            parent.NumberOfInstances = (parent.NumberOfInstances or 0) + 1
+            parent.size = (parent.size or 0) + size
         db.session.add(instance)
         db.session.commit()
         
     return instance
 
+def instance_record(ds: Dataset, filename: Union[str,Path]) -> dict:
+
+    """
+
+        Extracts the fields needed to index an instance (and its patient, study and series) in the
+        database. The study and series paths are inferred from the instance filename, as in db_create_instance.
+
+        Returns: a dict with the columns for the Patient, Study, Series and Instance rows.
+
+    """
+
+    return {
+        'PatientID': str(ds.PatientID),
+        'PatientName': str(ds.PatientName),
+        'StudyInstanceUID': ds.StudyInstanceUID,
+        'StudyDate': datetime.strptime(ds.StudyDate + ds.StudyTime[:6], '%Y%m%d%H%M%S'),
+        'StudyDescription': ds.StudyDescription,
+        'study_path': str(Path(filename).parents[1]),
+        'SeriesInstanceUID': ds.SeriesInstanceUID,
+        'SeriesDate': datetime.strptime(ds.SeriesDate + ds.SeriesTime[:6], '%Y%m%d%H%M%S'),
+        'SeriesDescription': ds.SeriesDescription,
+        'SeriesNumber': ds.SeriesNumber,
+        'Modality': ds.Modality,
+        'series_path': str(Path(filename).parents[0]),
+        'SOPInstanceUID': ds.SOPInstanceUID,
+        'SOPClassUID': ds.SOPClassUID,
+        'filename': str(filename),
+        'TransferSyntaxUID': getattr(getattr(ds, 'file_meta', None), 'TransferSyntaxUID', None),
+    }
+
+class HierarchyCache():
+
+    """
+
+    Bounded LRU cache with the keys of the Patient, Study and Series rows known to exist in the database.
+    The ingest writer checks it before querying the database, so that the instances of an already indexed
+    series can be inserted without looking up their patient, study and series.
+
+    Entries must be discarded when the rows are deleted (see discard_study and discard_series). Hits and
+    misses are counted for each level and can be read with get_stats.
+
+    """
+
+    levels = ('patient', 'study', 'series')
+
+    def __init__(self, maxsize: int = 10000):
+
+        self.maxsize = maxsize
+        # For series, the value is the StudyInstanceUID (used to discard the series of a study)
+        self.keys = {level: OrderedDict() for level in self.levels}
+        self.hits = {level: 0 for level in self.levels}
+        self.misses = {level: 0 for level in self.levels}
+        self.lock = threading.Lock()
+
+    def contains(self, level: str, key: str) -> bool:
+
+        with self.lock:
+            if key in self.keys[level]:
+                self.keys[level].move_to_end(key)
+                self.hits[level] += 1
+                return True
+            self.misses[level] += 1
+            return False
+
+    def add(self, level: str, key: str, parent: str = None) -> None:
+
+        with self.lock:
+            self.keys[level][key] = parent
+            self.keys[level].move_to_end(key)
+            if len(self.keys[level]) > self.maxsize:
+                self.keys[level].popitem(last = False)
+
+    def discard_study(self, uid: str) -> None:
+
+        with self.lock:
+            self.keys['study'].pop(uid, None)
+            for key in [key for key, parent in self.keys['series'].items() if parent == uid]:
+                self.keys['series'].pop(key)
+
+    def discard_series(self, uid: str) -> None:
+
+        with self.lock:
+            self.keys['series'].pop(uid, None)
+
+    def clear(self) -> None:
+
+        with self.lock:
+            for level in self.levels:
+                self.keys[level].clear()
+
+    def get_stats(self) -> dict:
+
+        with self.lock:
+            stats = {}
+            for level in self.levels:
+                lookups = self.hits[level] + self.misses[level]
+                stats[level] = {
+                    'size': len(self.keys[level]),
+                    'hits': self.hits[level],
+                    'misses': self.misses[level],
+                    'hit_rate': self.hits[level] / lookups if lookups else None,
+                }
+            stats['maxsize'] = self.maxsize
+            return stats
+
+hierarchy_cache = HierarchyCache(maxsize = int(os.environ.get('INGEST_CACHE_SIZE', 10000)))
+
+class InstanceIndex():
+
+    """
+
+    In-memory set with the SOPInstanceUIDs stored in the database, so that duplicates can be detected
+    before any disk or database I/O. It is loaded from the Instance table at startup (load), updated by
+    the ingest writer after each commit, and must be updated when instances are deleted (discard).
+
+    Until it is loaded, the loaded attribute is False and lookups should go to the database.
+
+    """
+
+    def __init__(self):
+
+        self.uids = set()
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def load(self) -> None:
+
+        with application.app_context():
+            uids = {uid for (uid,) in db.session.query(Instance.SOPInstanceUID)}
+        with self.lock:
+            self.uids = uids
+            self.loaded = True
+        logger.info(f'instance index loaded with {len(uids)} instances')
+
+    def __contains__(self, uid: str) -> bool:
+
+        return uid in self.uids
+
+    def add(self, uids: List[str]) -> None:
+
+        with self.lock:
+            if self.loaded:
+                self.uids.update(uids)
+
+    def discard(self, uids: List[str]) -> None:
+
+        with self.lock:
+            self.uids.difference_update(uids)
+
+    def __len__(self) -> int:
+
+        return len(self.uids)
+
+instance_index = InstanceIndex()
+
+class IngestWriter():
+
+    """
+
+    Writes the instances received by the Store SCP to the database in group commits. The SCP threads
+    put instance records (see instance_record) in a queue with the submit method, and a single writer thread
+    bulk-inserts the missing Patient, Study, Series and Instance rows. A commit is issued when batch_size
+    records have been collected or when the oldest record in the batch has waited max_latency seconds,
+    whichever happens first.
+
+    Duplicates are detected when the record is submitted (a ValueError is raised, as in db_create_instance),
+    so the store handler can still answer with 0x0117. The check can also be done before writing the file
+    with reserve, and the record submitted later with reserved = True. Instances are looked up in
+    instance_index (or in the database, if the index is not loaded). Records with a 'replace' key set to
+    True update the filename of an existing instance instead of being discarded.
+
+    Files of records with a 'sync' key set to True are flushed to disk before the batch is committed, so
+    the database never points to a file that could be lost in a crash.
+
+    The Store SCP answers success before the records are committed, so a batch that can't be flushed or
+    committed (after max_retries attempts) is not dropped: it is kept, with its instances still reserved,
+    and retried every retry_interval seconds. The kept records are also written to the dead_letter file
+    (json lines), and queued again when the writer starts, so they are not lost if the process stops
+    before they are committed. The file belongs to this writer (it is rewritten and removed as a whole),
+    so writers in different processes must use different files (see worker_dead_letter).
+
+    Patient, study and series keys are looked up in hierarchy_cache first, and only the unknown ones are queried.
+
+    Throughput is tracked over the last stats_window seconds and can be read with get_stats.
+
+    """
+
+    def __init__(self, batch_size: int = 200, max_latency: float = 0.5,
+                 max_retries: int = 3, stats_window: float = 60,
+                 retry_interval: float = 30, dead_letter: str = 'ingest_dead_letter.jsonl'):
+
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.max_retries = max_retries
+        self.stats_window = stats_window
+        self.retry_interval = retry_interval
+        self.dead_letter = dead_letter
+
+        self.records = Queue()
+        # SOPInstanceUIDs submitted but not committed yet
+        self.pending = set()
+        self.lock = threading.Lock()
+        # Batches that could not be committed, waiting to be retried, and the time of their last attempt
+        self.failed = deque()
+        self.failed_at = 0
+
+        # Throughput counters
+        self.total_rows = 0
+        self.total_commits = 0
+        self.history = deque()
+
+        self.main_thread = None
+
+    def start(self):
+
+        if self.main_thread and self.main_thread.is_alive():
+            return
+
+        # Queue again the records that were not committed before the last stop
+        self._load_dead_letter()
+
+        # Set an event to stop the thread later
+        self.stop_event = threading.Event()
+
+        # Create and start the thread
+        self.main_thread = threading.Thread(target = self._main, args = (), daemon = True)
+        self.main_thread.start()
+        logger.info(f'ingest writer started (batch size: {self.batch_size}, max latency: {self.max_latency} s, dead letter: {self.dead_letter})')
+
+    def stop(self):
+
+        """
+
+            Stops the thread after flushing the records still in the queue. The batches that still can't
+            be committed are left in the dead_letter file.
+
+        """
+
+        if not self.main_thread:
+            return
+        self.stop_event.set()
+        self.main_thread.join()
+        if self.failed:
+            logger.error(f'{sum(len(batch) for batch in self.failed)} instances were not written to the database, '
+                         f'they are kept in {self.dead_letter}')
+
+    def reserve(self, uid: str, replace: bool = False) -> None:
+
+        """
+
+            Marks an instance as pending, so that it is reported as a duplicate until it is committed
+            or released.
+
+            Args:
+                · uid: the SOPInstanceUID
+                · replace: if True, the instance may already be in the database (it will be replaced).
+
+            Raises:
+                ValueError if the instance is waiting to be written, or if it is already in the database
+                and replace is False.
+
+        """
+
+        with self.lock:
+            if uid in self.pending or (not replace and instance_index.loaded and uid in instance_index):
+                raise ValueError("This instance already exists")
+            self.pending.add(uid)
+
+        if replace or instance_index.loaded:
+            return
+
+        try:
+            with application.app_context():
+                exists = db.session.get(Instance, uid) is not None
+        except Exception:
+            self.release(uid)
+            raise
+        if exists:
+            self.release(uid)
+            raise ValueError("This instance already exists")
+
+    def release(self, uid: str) -> None:
+
+        """
+
+            Releases a reserved instance that will not be submitted (e.g. its file could not be written).
+
+        """
+
+        with self.lock:
+            self.pending.discard(uid)
+
+    def submit(self, record: dict, reserved: bool = False) -> None:
+
+        """
+
+            Queues an instance record to be written in the next group commit.
+
+            Raises:
+                ValueError if the instance is already in the database or waiting to be written (not
+                checked if the instance was reserved).
+
+        """
+
+        if not reserved:
+            self.reserve(record['SOPInstanceUID'])
+
+        self.records.put(record)
+
+    def get_stats(self) -> dict:
+
+        """
+
+            Returns the number of rows and commits written since startup, and the rates (per second)
+            over the last stats_window seconds.
+
+        """
+
+        with self.lock:
+            self._prune_history()
+            rows = sum(item[1] for item in self.history)
+            commits = len(self.history)
+            return {
+                'rows': self.total_rows,
+                'commits': self.total_commits,
+                'rows_per_second': rows / self.stats_window,
+                'commits_per_second': commits / self.stats_window,
+                'queued': self.records.qsize(),
+                'failed': sum(len(batch) for batch in self.failed),
+            }
+
+    def _main(self):
+
+        while not self.stop_event.is_set() or not self.records.empty():
+            batch = self._next_batch()
+            if batch:
+                self._flush(batch)
+            # Retry the failed batches, oldest first, until one fails again
+            if self.failed and time() - self.failed_at >= self.retry_interval:
+                while self.failed:
+                    with self.lock:
+                        batch = self.failed.popleft()
+                    if not self._flush(batch, retry = True):
+                        break
+                self._save_dead_letter()
+
+    def _next_batch(self) -> List[dict]:
+
+        # Wait for the first record, then collect records until the batch is full or the deadline expires
+        try:
+            batch = [self.records.get(timeout = self.max_latency)]
+        except Empty:
+            return []
+
+        deadline = time() + self.max_latency
+        while len(batch) < self.batch_size:
+            remaining = deadline - time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.records.get(timeout = remaining))
+            except Empty:
+                break
+
+        return batch
+
+    def _flush(self, batch: List[dict], retry: bool = False) -> bool:
+
+        """ Commits a batch. If it fails, the batch is kept to be retried later. Returns True if it was committed """
+
+        # The rows are not committed if their files could not be flushed to disk
+        try:
+            sync_files([r['filename'] for r in batch if r.get('sync')])
+        except Exception as e:
+            logger.error(f'files could not be flushed to disk: {repr(e)}')
+            self._keep(batch, retry)
+            return False
+
+        for attempt in range(self.max_retries):
+            try:
+                start = time()
+                with application.app_context():
+                    rows, new_keys = self._write_batch(batch)
+                    db.session.commit()
+                break
+            except Exception as e:
+                with application.app_context():
+                    db.session.rollback()
+                logger.error(f'group commit of {len(batch)} instances failed (attempt {attempt + 1}): {repr(e)}')
+                sleep(self.max_latency)
+        else:
+            logger.error(f'{len(batch)} instances could not be written to the database, retrying in {self.retry_interval} s')
+            self._keep(batch, retry)
+            return False
+
+        # Update the index before releasing the instances, so that they are always found as duplicates
+        instance_index.add([r['SOPInstanceUID'] for r in batch])
+        self._release(batch)
+        for level, key, parent in new_keys:
+            hierarchy_cache.add(level, key, parent)
+        with self.lock:
+            self.total_rows += rows
+            self.total_commits += 1
+            self.history.append((time(), rows))
+            self._prune_history()
+        logger.debug(f'committed {rows} rows for {len(batch)} instances in {time() - start:.3f} s')
+
+        return True
+
+    def _write_batch(self, batch: List[dict]) -> tuple:
+
+        # Find which rows of the hierarchy already exist. Known keys are taken from the cache,
+        # the rest are looked up with one query per level
+        def existing(level, column, keys):
+            known = {key for key in keys if hierarchy_cache.contains(level, key)}
+            unknown = set(keys) - known
+            if unknown:
+                found = {key for (key,) in db.session.query(column).filter(column.in_(unknown))}
+                for key in found:
+                    hierarchy_cache.add(level, key, keys[key])
+                known.update(found)
+            return known
+
+        patients = existing('patient', Patient.PatientID, {r['PatientID']: None for r in batch})
+        studies = existing('study', Study.StudyInstanceUID, {r['StudyInstanceUID']: None for r in batch})
+        series = existing('series', Series.SeriesInstanceUID, {r['SeriesInstanceUID']: r['StudyInstanceUID'] for r in batch})
+        # Existing instances and their size
+        instances = dict(db.session.query(Instance.SOPInstanceUID, Instance.size).filter(
+            Instance.SOPInstanceUID.in_([r['SOPInstanceUID'] for r in batch])))
+
+        new_patients, new_studies, new_series, new_instances, replaced = [], [], [], [], []
+        # Instances added to each series and study, their size and the modalities of the new series
+        series_totals, study_totals = {}, {}
+        for r in batch:
+            if not r['PatientID'] in patients:
+                patients.add(r['PatientID'])
+                new_patients.append({'PatientID': r['PatientID'], 'PatientName': r['PatientName']})
+            if not r['StudyInstanceUID'] in studies:
+                studies.add(r['StudyInstanceUID'])
+                new_studies.append({'StudyInstanceUID': r['StudyInstanceUID'],
+                                    'StudyDate': r['StudyDate'],
+                                    'StudyDescription': r['StudyDescription'],
+                                    'path': r['study_path'],
+                                    'PatientID': r['PatientID']})
+            if not r['SeriesInstanceUID'] in series:
+                series.add(r['SeriesInstanceUID'])
+                new_series.append({'SeriesInstanceUID': r['SeriesInstanceUID'],
+                                   'SeriesDate': r['SeriesDate'],
+                                   'SeriesDescription': r['SeriesDescription'],
+                                   'SeriesNumber': r['SeriesNumber'],
+                                   'Modality': r['Modality'],
+                                   'path': r['series_path'],
+                                   'PatientID': r['PatientID'],
+                                   'StudyInstanceUID': r['StudyInstanceUID']})
+            if r['SOPInstanceUID'] in instances:
+                if not r.get('replace'):
+                    logger.error(f"instance {r['SOPInstanceUID']} already exists.")
+                    continue
+                replaced.append({'SOPInstanceUID': r['SOPInstanceUID'], 'filename': r['filename'],
+                                 'TransferSyntaxUID': r.get('TransferSyntaxUID'),
+                                 'dataset_offset': r.get('dataset_offset'),
+                                 'size': r.get('size', 0)})
+                # The series and study keep their number of instances, their size changes by the difference
+                added, delta = 0, r.get('size', 0) - (instances[r['SOPInstanceUID']] or 0)
+            else:
+                added, delta = 1, r.get('size', 0)
+            instances[r['SOPInstanceUID']] = r.get('size', 0)
+            for totals, key in [(series_totals, r['SeriesInstanceUID']), (study_totals, r['StudyInstanceUID'])]:
+                count, size = totals.get(key, (0, 0))
+                totals[key] = (count + added, size + delta)
+            if not added:
+                continue
+            new_instances.append({'SOPInstanceUID': r['SOPInstanceUID'],
+                                  'SOPClassUID': r['SOPClassUID'],
+                                  'filename': r['filename'],
+                                  'TransferSyntaxUID': r.get('TransferSyntaxUID'),
+                                  'dataset_offset': r.get('dataset_offset'),
+                                  'size': r.get('size', 0),
+                                  'PatientID': r['PatientID'],
+                                  'StudyInstanceUID': r['StudyInstanceUID'],
+                                  'SeriesInstanceUID': r['SeriesInstanceUID']})
+
+        # Modalities of the new series, by study
+        modalities = {}
+        for ss in new_series:
+            modalities[ss['StudyInstanceUID']] = join_modalities(modalities.get(ss['StudyInstanceUID']), ss['Modality'])
+
+        # New studies and series are inserted with their counters, the existing ones are incremented
+        for rows, key, totals in [(new_studies, 'StudyInstanceUID', study_totals),
+                                  (new_series, 'SeriesInstanceUID', series_totals)]:
+            for row in rows:
+                row['NumberOfInstances'], row['size'] = totals.pop(row[key], (0, 0))
+        for st in new_studies:
+            st['ModalitiesInStudy'] = modalities.pop(st['StudyInstanceUID'])
+        if modalities:
+            current = db.session.query(Study.StudyInstanceUID, Study.ModalitiesInStudy).filter(
+                Study.StudyInstanceUID.in_(modalities))
+            modalities = {uid: join_modalities(value, modalities[uid]) for uid, value in current}
+
+        # Bulk insert, parents first
+        for model, rows in [(Patient, new_patients), (Study, new_studies), (Series, new_series), (Instance, new_instances)]:
+            if rows:
+                db.session.execute(insert(model), rows)
+        if replaced:
+            db.session.execute(update(Instance), replaced)
+
+        # Bulk update of the counters of the existing studies and series
+        for model, column, totals in [(Study, Study.StudyInstanceUID, study_totals),
+                                      (Series, Series.SeriesInstanceUID, series_totals)]:
+            if totals:
+                table = model.__table__
+                stmt = update(table).where(table.c[column.key] == bindparam('uid')).values(
+                    NumberOfInstances = db.func.coalesce(table.c.NumberOfInstances, 0) + bindparam('count'),
+                    size = db.func.coalesce(table.c.size, 0) + bindparam('bytes'))
+                db.session.connection().execute(stmt, [{'uid': uid, 'count': count, 'bytes': size}
+                                                       for uid, (count, size) in totals.items()])
+        if modalities:
+            table = Study.__table__
+            stmt = update(table).where(table.c.StudyInstanceUID == bindparam('uid')).values(
+                ModalitiesInStudy = bindparam('modalities'))
+            db.session.connection().execute(stmt, [{'uid': uid, 'modalities': value} for uid, value in modalities.items()])
+
+        # Keys to add to the cache once the batch is committed
+        new_keys = [('patient', p['PatientID'], None) for p in new_patients] + \
+                   [('study', st['StudyInstanceUID'], None) for st in new_studies] + \
+                   [('series', ss['SeriesInstanceUID'], ss['StudyInstanceUID']) for ss in new_series]
+
+        return len(new_patients) + len(new_studies) + len(new_series) + len(new_instances) + len(replaced), new_keys
+
+    def _keep(self, batch: List[dict], retry: bool = False) -> None:
+
+        """ Keeps a batch that could not be committed (its instances stay reserved) """
+
+        with self.lock:
+            if retry:
+                self.failed.appendleft(batch)
+            else:
+                self.failed.append(batch)
+        self.failed_at = time()
+        if not retry:
+            self._save_dead_letter()
+
+    def _save_dead_letter(self) -> None:
+
+        """ Writes the records of the failed batches to the dead_letter file (removes it if there are none) """
+
+        with self.lock:
+            records = [r for batch in self.failed for r in batch]
+        try:
+            if not records:
+                if os.path.exists(self.dead_letter):
+                    os.remove(self.dead_letter)
+                return
+            tmp = self.dead_letter + '.tmp'
+            with open(tmp, 'w') as f:
+                for r in records:
+                    f.write(json.dumps(r, default = str) + '\n')
+            os.replace(tmp, self.dead_letter)
+        except Exception as e:
+            logger.error(f'dead letter file {self.dead_letter} could not be written: {repr(e)}')
+
+    def _load_dead_letter(self) -> None:
+
+        """ Queues the records of the dead_letter file, if any, as a failed batch to be retried """
+
+        if not self.dead_letter or not os.path.exists(self.dead_letter):
+            return
+        try:
+            with open(self.dead_letter) as f:
+                batch = [json.loads(line) for line in f if line.strip()]
+        except Exception as e:
+            logger.error(f'dead letter file {self.dead_letter} could not be read: {repr(e)}')
+            return
+        for r in batch:
+            for key in ['StudyDate', 'SeriesDate']:
+                r[key] = datetime.fromisoformat(r[key])
+        with self.lock:
+            self.pending.update(r['SOPInstanceUID'] for r in batch)
+        if batch:
+            # Retried as soon as the writer starts
+            self.failed.append(batch)
+            self.failed_at = 0
+            logger.info(f'{len(batch)} instances from {self.dead_letter} will be written to the database')
+
+    def _release(self, batch: List[dict]) -> None:
+
+        with self.lock:
+            for r in batch:
+                self.pending.discard(r['SOPInstanceUID'])
+
+    def _prune_history(self) -> None:
+
+        while self.history and self.history[0][0] < time() - self.stats_window:
+            self.history.popleft()
+
+class IngestSessions():
+
+    """
+
+    Per-association ingest sessions. The records of the instances received on an association are kept
+    in its session and submitted to the ingest writer one series at a time: when an instance from another
+    series arrives, when the association is released or aborted (close), or as a safety measure when the
+    session holds max_records records or its oldest record has waited max_age seconds.
+
+    A background thread checks the sessions every second for expired records (see start and stop).
+
+    """
+
+    def __init__(self, writer: IngestWriter, max_records: int = 500, max_age: float = 5):
+
+        self.writer = writer
+        self.max_records = max_records
+        self.max_age = max_age
+
+        # Key (association) -> {'series': SeriesInstanceUID, 'records': list of records, 'started': time}
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+        # Flush counters
+        self.flushes = 0
+        self.flushed_records = 0
+
+        self.main_thread = None
+
+    def start(self):
+
+        if self.main_thread and self.main_thread.is_alive():
+            return
+
+        # Set an event to stop the thread later
+        self.stop_event = threading.Event()
+
+        # Create and start the thread
+        self.main_thread = threading.Thread(target = self._main, args = (), daemon = True)
+        self.main_thread.start()
+
+    def stop(self):
+
+        """
+
+            Stops the thread and flushes all the sessions.
+
+        """
+
+        if self.main_thread:
+            self.stop_event.set()
+            self.main_thread.join()
+        for key in list(self.sessions):
+            self.close(key)
+
+    def open(self, key) -> None:
+
+        with self.lock:
+            self.sessions.setdefault(key, self._new_session())
+
+    def add(self, key, record: dict) -> None:
+
+        flush = []
+        with self.lock:
+            session = self.sessions.setdefault(key, self._new_session())
+            if session['records'] and session['series'] != record['SeriesInstanceUID']:
+                flush.append(self._take(session))
+            if not session['records']:
+                session['started'] = time()
+            session['series'] = record['SeriesInstanceUID']
+            session['records'].append(record)
+            if len(session['records']) >= self.max_records or time() - session['started'] > self.max_age:
+                flush.append(self._take(session))
+
+        for records in flush:
+            self._submit(records)
+
+    def close(self, key) -> None:
+
+        with self.lock:
+            session = self.sessions.pop(key, None)
+            records = self._take(session) if session else []
+        self._submit(records)
+
+    def flush_expired(self) -> None:
+
+        with self.lock:
+            flush = [self._take(session) for session in self.sessions.values()
+                     if session['records'] and time() - session['started'] > self.max_age]
+        for records in flush:
+            self._submit(records)
+
+    def get_stats(self) -> dict:
+
+        with self.lock:
+            return {
+                'open': len(self.sessions),
+                'held_records': sum(len(session['records']) for session in self.sessions.values()),
+                'flushes': self.flushes,
+                'records_per_flush': self.flushed_records / self.flushes if self.flushes else None,
+            }
+
+    def _main(self):
+
+        while not self.stop_event.wait(1):
+            self.flush_expired()
+
+    def _new_session(self) -> dict:
+
+        return {'series': None, 'records': [], 'started': time()}
+
+    def _take(self, session: dict) -> List[dict]:
+
+        records = session['records']
+        session['records'] = []
+        if records:
+            self.flushes += 1
+            self.flushed_records += len(records)
+        return records
+
+    def _submit(self, records: List[dict]) -> None:
+
+        for record in records:
+            self.writer.submit(record, reserved = True)
+
+ingest_writer = IngestWriter(batch_size = int(os.environ.get('INGEST_BATCH_SIZE', 200)),
+                             max_latency = float(os.environ.get('INGEST_MAX_LATENCY', 0.5)),
+                             retry_interval = float(os.environ.get('INGEST_RETRY_INTERVAL', 30)),
+                             dead_letter = INGEST_DEAD_LETTER)
+
+def worker_dead_letter(index: int) -> str:
+
+    """ The dead letter file of the ingest writer of a Store SCP worker process (e.g. ingest_dead_letter.worker-0.jsonl) """
+
+    root, ext = os.path.splitext(INGEST_DEAD_LETTER)
+    return f'{root}.worker-{index}{ext}'
+
+ingest_pipeline = IngestPipeline(workers = int(os.environ.get('INGEST_WORKERS', 4)),
+                                 queue_size = int(os.environ.get('INGEST_QUEUE_SIZE', 1000)))
+ingest_sessions = IngestSessions(ingest_writer,
+                                 max_records = int(os.environ.get('INGEST_SESSION_SIZE', 500)),
+                                 max_age = float(os.environ.get('INGEST_SESSION_MAX_AGE', 5)))
+directory_cache = DirectoryCache()
+
+def write_instance(filepath: str, write: Callable, record: dict, durability: str = INGEST_DURABILITY,
+                   session = None) -> None:
+
+    """
+
+        Writes a received instance to disk and queues it for the database. The instance must have been
+        reserved in ingest_writer; the reservation is released if the file can't be written.
+
+        Args:
+            · filepath: the path of the file to write.
+            · write: a function that writes the dataset to a file-like object.
+            · record: the instance record for the database (see instance_record).
+            · durability: 'none', 'batch' or 'instance' (see INGEST_DURABILITY).
+            · session: if not None, the key of the ingest session that collects the record. If None,
+            the record is submitted to the ingest writer directly.
+
+    """
+
+    filedir = os.path.dirname(filepath)
+    try:
+        directory_cache.makedirs(filedir)
+        try:
+            write_file(filepath, write, fsync = durability == 'instance')
+        except FileNotFoundError:
+            # The directory was removed after it was cached
+            directory_cache.discard(filedir)
+            directory_cache.makedirs(filedir)
+            write_file(filepath, write, fsync = durability == 'instance')
+        record['size'] = os.path.getsize(filepath)
+    except Exception as e:
+        ingest_writer.release(record['SOPInstanceUID'])
+        logger.error(f"Can't write instance to storage: {repr(e)}")
+        raise
+
+    record['sync'] = durability == 'batch'
+    if session is None:
+        ingest_writer.submit(record, reserved = True)
+    else:
+        ingest_sessions.add(session, record)
+
+# Handlers to keep an ingest session for each association of the Store SCP
+def session_open_handler(event: Event) -> None:
+
+    ingest_sessions.open(id(event.assoc))
+
+def session_close_handler(event: Event) -> None:
+
+    # Close the session in the association lane, after the instances still being written
+    ingest_pipeline.submit(id(event.assoc), ingest_sessions.close, id(event.assoc), force = True)
+
+session_handlers = [(evt.EVT_CONN_OPEN, session_open_handler),
+                    (evt.EVT_RELEASED, session_close_handler),
+                    (evt.EVT_ABORTED, session_close_handler)]
+
 # Create a handler for the store request event
-def store_handler(event: Event, root_dir = 'incoming') -> int:
+def store_handler(event: Event, root_dir = 'incoming', write_mode = STORE_SCP_WRITE_MODE,
+                  duplicates = STORE_SCP_DUPLICATES, durability = INGEST_DURABILITY,
+                  sessions = INGEST_SESSIONS) -> int:
     
     try:
-        ds = event.dataset
-        ds.file_meta = event.file_meta    
-        filedir = os.path.join(root_dir, ds.StudyInstanceUID, ds.SeriesInstanceUID)
-        os.makedirs(filedir, exist_ok = True)
-        filepath = os.path.join(filedir, ds.SOPInstanceUID)
-        ds.save_as(filepath, write_like_original = False)
-        # Store in the database
+        # Check for duplicates before any I/O. In 'replace' mode every instance is written as a replacement:
+        # the writer updates the existing row, whether it is found in the index or only in the database
+        # (e.g. if the index is not loaded), and inserts the others
+        uid = event.request.AffectedSOPInstanceUID
+        replace = duplicates == 'replace'
+        if (uid in instance_index or uid in ingest_writer.pending) and not replace:
+            if duplicates == 'ignore':
+                logger.debug('instance already exists, ignored.')
+                return 0x0000
+            logger.error("Can't write instance to database: instance already exists")
+            return 0x0117
+
+        if write_mode == 'raw':
+            # Read only the fields needed for the database
+            ds = read_encoded_tags(event, INDEX_FIELDS)
+            ds.file_meta = file_meta = event.file_meta
+            stream = event.request.DataSet
+            def write(f):
+                # The dataset offset lets the instance be sent from the file without decoding it
+                record['dataset_offset'] = write_encoded_dataset(f, file_meta, stream)
+        else:
+            ds = event.dataset
+            ds.file_meta = event.file_meta    
+            write = lambda f: ds.save_as(f, write_like_original = False)
+        filepath = os.path.join(root_dir, ds.StudyInstanceUID, ds.SeriesInstanceUID, ds.SOPInstanceUID)
+        record = instance_record(ds, filepath)
+        record['replace'] = replace
+
+        # Reserve the instance, so that it is not written twice at the same time
         try:
-            db_create_instance(ds, filepath)
+            ingest_writer.reserve(ds.SOPInstanceUID, replace)
         except ValueError:
+            if duplicates == 'ignore':
+                logger.debug('instance already exists, ignored.')
+                return 0x0000
             logger.error("Can't write instance to database: instance already exists")
             return 0x0117
 
+        # Hand the instance over to the writer threads. Instances from the same association are written in order
+        session = id(event.assoc) if sessions else None
+        if not ingest_pipeline.submit(id(event.assoc), write_instance, filepath, write, record, durability, session):
+            ingest_writer.release(ds.SOPInstanceUID)
+            logger.error("Can't write instance to storage: ingest queue is full")
+            return 0xA700
+
     except Exception as e:
         logger.error(f"Can't write instance to storage: {repr(e)}")
         return 0xA700
@@ -126,4 +1009,21 @@ def store_handler(event: Event, root_dir = 'incoming') -> int:
     else:
         # Return a 'Success' status
         logger.debug('instance stored successfully.')
-        return 0x0000
\ No newline at end of file
+        return 0x0000
+
+def setup_store_scp(scp: DicomInterface) -> None:
+
+    """
+
+        Configures a DicomInterface to receive instances into the database: sets the store handler,
+        the ingest session handlers and the admission limits.
+
+    """
+
+    scp.store_handler = store_handler
+    if INGEST_SESSIONS:
+        scp.extra_handlers = session_handlers
+    scp.max_associations = STORE_SCP_MAX_ASSOCIATIONS or None
+    scp.max_associations_per_ae = STORE_SCP_MAX_ASSOCIATIONS_PER_AE or None
+    scp.max_queue_load = STORE_SCP_MAX_QUEUE_LOAD
+    scp.queue_load = ingest_pipeline.load
@@ -0,0 +1,273 @@
+import os, logging, threading
+from time import time, perf_counter
+from collections import deque
+from typing import Callable, List
+from pynetdicom import build_context
+from pynetdicom.sop_class import Verification
+
+logger = logging.getLogger('__main__')
+
+class DeviceMonitor():
+
+    """
+
+    Health of the remote devices, shared by all the DicomInterfaces of the process (see device_monitor),
+    so that the operations with a device that is known to be down fail fast instead of waiting for the
+    network timeouts.
+
+    · A background thread C-ECHOes every device each interval seconds (see start), with a new association
+    (not one from the association pool), and keeps the association and echo latency of the last history
+    checks of each device.
+    · Each device (ae_title, address, port) has a circuit breaker, fed by the echoes and by the associations
+    requested by the application (see record_success and record_failure). After failure_threshold
+    consecutive failures the circuit opens: the device is 'down' and new associations with it are refused
+    (see allow). retry_after seconds after the last failure, one association is let through to test the
+    device (the circuit is half-open), and the circuit closes again with the first success.
+
+    """
+
+    def __init__(self, interval: float = 60, failure_threshold: int = 2, retry_after: float = 30, history: int = 30):
+
+        self.interval = interval
+        self.failure_threshold = failure_threshold
+        self.retry_after = retry_after
+        self.history = history
+
+        # Device -> {'circuit', 'failures', 'failed', 'trial', 'error', 'checked', 'history': deque of checks}
+        self.entries = {}
+        self.lock = threading.Lock()
+
+        # Counters
+        self.checks = 0
+        self.refused = 0
+
+        self.devices = None
+        self.interface = None
+        self.main_thread = None
+
+    def start(self, devices: Callable[[], List[dict]], interface: Callable):
+
+        """
+
+            Starts the background thread that checks the devices.
+
+            Args:
+                · devices: a function that returns the devices to check, as dicts with the name, ae_title,
+                address and port of each device.
+                · interface: a function that returns the DicomInterface used to open the associations.
+
+        """
+
+        self.devices = devices
+        self.interface = interface
+        if not self.interval or (self.main_thread and self.main_thread.is_alive()):
+            return
+
+        # Set an event to stop the thread later
+        self.stop_event = threading.Event()
+
+        # Create and start the thread
+        self.main_thread = threading.Thread(target = self._main, args = (), daemon = True)
+        self.main_thread.start()
+
+    def stop(self):
+
+        if self.main_thread:
+            self.stop_event.set()
+            self.main_thread.join()
+
+    def allow(self, device: dict) -> bool:
+
+        """ Returns False if a new association with the device must be refused (its circuit is open) """
+
+        target = self._target(device)
+        with self.lock:
+            entry = self.entries.get(target)
+            if entry is None or entry['circuit'] == 'closed':
+                return True
+            # Let one association through to test the device, after retry_after seconds
+            now = time()
+            last = entry['trial'] if entry['circuit'] == 'half-open' else entry['failed']
+            if now - last >= self.retry_after:
+                entry['circuit'] = 'half-open'
+                entry['trial'] = now
+                return True
+            self.refused += 1
+            return False
+
+    def record_success(self, device: dict, association: float = None, echo: float = None) -> None:
+
+        """ Records a successful association (or echo, with its latencies in seconds) with a device """
+
+        target = self._target(device)
+        with self.lock:
+            entry = self._entry(target)
+            if entry['circuit'] != 'closed':
+                logger.info('device {}@{}:{} is up'.format(*target))
+            entry['circuit'] = 'closed'
+            entry['failures'] = 0
+            entry['error'] = None
+            if echo is not None:
+                entry['checked'] = time()
+                entry['history'].append({'time': entry['checked'], 'ok': True,
+                                         'association_ms': round(association * 1000, 1), 'echo_ms': round(echo * 1000, 1)})
+
+    def record_failure(self, device: dict, error: str = None, check: bool = False) -> None:
+
+        """ Records a failed association with a device (or a failed echo, if check is True) """
+
+        target = self._target(device)
+        with self.lock:
+            entry = self._entry(target)
+            entry['failures'] += 1
+            entry['failed'] = time()
+            entry['error'] = error
+            if check:
+                entry['checked'] = entry['failed']
+                entry['history'].append({'time': entry['checked'], 'ok': False, 'association_ms': None, 'echo_ms': None})
+            if entry['circuit'] != 'open' and (entry['circuit'] == 'half-open' or entry['failures'] >= self.failure_threshold):
+                entry['circuit'] = 'open'
+                logger.warning('device {}@{}:{} is down: {}'.format(*target, error))
+
+    def check(self, device: dict, ae = None) -> bool:
+
+        """
+
+            C-ECHOes a device with a new association and records the result, even if its circuit is open.
+            Returns True if it answered the echo. A rejected association (e.g. the device is busy) is not
+            a failure of the device, but it is not an answer either. The association is opened by ae (by
+            the interface given to start if ae is None).
+
+        """
+
+        ae = ae or self.interface()
+        start = perf_counter()
+        try:
+            assoc = ae.associate(device['address'], int(device['port']), [build_context(Verification)], ae_title = device['ae_title'])
+        except Exception:
+            assoc = None
+        association = perf_counter() - start
+        if assoc is not None and assoc.is_rejected:
+            self.record_success(device)
+            return False
+        if assoc is None or not assoc.is_established:
+            self.record_failure(device, 'association could not be established', check = True)
+            return False
+
+        try:
+            start = perf_counter()
+            status = assoc.send_c_echo()
+            echo = perf_counter() - start
+            ok = bool(status) and status.Status == 0
+        except Exception:
+            ok = False
+        finally:
+            try:
+                assoc.release()
+            except Exception:
+                assoc.abort()
+
+        if ok:
+            self.record_success(device, association, echo)
+        else:
+            self.record_failure(device, 'C-ECHO failed', check = True)
+        return ok
+
+    def check_all(self) -> None:
+
+        """ Checks all the devices in parallel """
+
+        try:
+            devices = self.devices()
+        except Exception as e:
+            logger.error(f'device monitor: devices could not be read: {repr(e)}')
+            return
+
+        threads = [threading.Thread(target = self.check, args = (device,), daemon = True) for device in devices]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        with self.lock:
+            self.checks += 1
+
+    def get_state(self, device: dict) -> dict:
+
+        """
+
+            Returns the health of a device:
+                · state: 'up', 'failing' (the last association failed, but the circuit is not open yet), 'down'
+                (circuit open) or 'unknown' (not checked nor used yet).
+                · circuit: 'closed', 'open' or 'half-open'.
+                · failures: consecutive failures.
+                · error: the last error, if the last association or echo failed.
+                · checked: time of the last check.
+                · association_ms, echo_ms: latencies of the last check, in milliseconds.
+                · history: the last checks, as dicts with time, ok, association_ms and echo_ms.
+
+        """
+
+        with self.lock:
+            entry = self.entries.get(self._target(device))
+            if entry is None:
+                return {'state': 'unknown', 'circuit': 'closed', 'failures': 0, 'error': None, 'checked': None,
+                        'association_ms': None, 'echo_ms': None, 'history': []}
+            last = entry['history'][-1] if entry['history'] else {}
+            return {
+                'state': 'down' if entry['circuit'] == 'open' else 'failing' if entry['failures'] else 'up',
+                'circuit': entry['circuit'],
+                'failures': entry['failures'],
+                'error': entry['error'],
+                'checked': entry['checked'],
+                'association_ms': last.get('association_ms'),
+                'echo_ms': last.get('echo_ms'),
+                'history': list(entry['history']),
+            }
+
+    def forget(self, device: dict = None) -> None:
+
+        """ Discards the health of a device (of all of them if device is None), e.g. when its configuration changes """
+
+        with self.lock:
+            if device is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(self._target(device), None)
+
+    def get_stats(self) -> dict:
+
+        with self.lock:
+            return {
+                'interval': self.interval,
+                'failure_threshold': self.failure_threshold,
+                'retry_after': self.retry_after,
+                'down': ['{}@{}:{}'.format(*target) for target, entry in self.entries.items() if entry['circuit'] == 'open'],
+                'checks': self.checks,
+                'refused': self.refused,
+            }
+
+    def _main(self):
+
+        while True:
+            self.check_all()
+            if self.stop_event.wait(self.interval):
+                break
+
+    def _entry(self, target: tuple) -> dict:
+
+        """ The entry of a device, created if needed (called with the lock held) """
+
+        entry = self.entries.get(target)
+        if entry is None:
+            entry = self.entries[target] = {'circuit': 'closed', 'failures': 0, 'failed': None, 'trial': None,
+                                            'error': None, 'checked': None, 'history': deque(maxlen = self.history)}
+        return entry
+
+    def _target(self, device: dict) -> tuple:
+
+        return (device['ae_title'], device['address'], int(device['port']))
+
+# Health of the devices, shared by the whole application
+device_monitor = DeviceMonitor(interval = float(os.environ.get('DEVICE_MONITOR_INTERVAL', 60)),
+                               failure_threshold = int(os.environ.get('DEVICE_MONITOR_FAILURE_THRESHOLD', 2)),
+                               retry_after = float(os.environ.get('DEVICE_MONITOR_RETRY_AFTER', 30)))
@@ -1,15 +1,29 @@
-from queue import Queue
-from typing import List, Union, Callable
-import logging, os, traceback
+from queue import Queue, Empty, Full
+from io import BytesIO
+from typing import List, Union, Callable, BinaryIO, Iterator, Tuple
+import logging, os, sys, traceback, socket, threading, time
 from logging.handlers import RotatingFileHandler
 from pathlib import Path
+from datetime import datetime, timedelta
+from copy import deepcopy
+from contextlib import contextmanager
 
 from pydicom.uid import UID
 from pydicom.dataset import Dataset
+from pydicom.tag import Tag
+from pydicom.filereader import read_dataset
 
-from pynetdicom import AE, evt, StoragePresentationContexts, build_role, build_context, debug_logger
+from pynetdicom import AE, evt, StoragePresentationContexts, DEFAULT_TRANSFER_SYNTAXES, build_role, build_context, debug_logger
+from pynetdicom.dsutils import encode_file_meta, split_dataset
+from pynetdicom.dimse_primitives import C_STORE
 from pynetdicom.association import Association
 from pynetdicom.events import Event
+from pynetdicom.transport import ThreadedAssociationServer, RequestHandler
+from pynetdicom.acse import ACSE
+from services.association_pool import association_pool, AssociationError
+from services.device_monitor import device_monitor
+from services.context_cache import context_cache
+from services.query_cache import query_cache
 from pynetdicom.sop_class import (
     PatientRootQueryRetrieveInformationModelFind,
     StudyRootQueryRetrieveInformationModelFind,
@@ -18,6 +32,12 @@ from pynetdicom.sop_class import (
     Verification
 )
 
+# Maximum number of presentation contexts that can be requested in an association
+MAX_CONTEXTS = 128
+
+# Sizes of the ranges in which the StudyDate range of a query can be split (see split_date_range)
+DATE_CHUNKS = ['day', 'week']
+
 # Setup logging behaviour
 app_logger = logging.getLogger('__main__')
 
@@ -59,11 +79,252 @@ def default_query(level: str):
 
     return ds
 
+def study_query(search_criteria: Union[dict, Dataset] = None, responses: Union[dict, Dataset] = None) -> Dataset:
+
+    """
+        Builds the dataset for a study level query (see DicomInterface.query_studies_in_device).
+    """
+
+    ds = Dataset()        
+    if search_criteria:
+        ds.update(search_criteria)
+    if not responses:
+        responses = default_query('STUDY')        
+    new_entries = {key:value for key,value in responses.items() if not key in ds}
+    ds.update(new_entries)           
+    ds.QueryRetrieveLevel = 'STUDY'
+    ds.StudyInstanceUID = ''
+
+    return ds
+
+def split_date_range(dates: str, chunk: str = 'day') -> List[str]:
+
+    """
+        Splits a date range (YYYYMMDD-YYYYMMDD) in ranges of one day or one week (chunk = 'day' or 'week'),
+        in date order. Other values (a single date, an open range, an empty value) are not split.
+        Raises ValueError if chunk is not one of DATE_CHUNKS.
+    """
+
+    if not chunk in DATE_CHUNKS:
+        raise ValueError(f"Unknown date chunk {chunk!r}, it must be one of {DATE_CHUNKS}")
+
+    try:
+        start, end = [datetime.strptime(date, '%Y%m%d') for date in dates.split('-')]
+    except (ValueError, AttributeError):
+        return [dates]
+
+    step = timedelta(days = 7 if chunk == 'week' else 1)
+    chunks = []
+    while start <= end:
+        chunk_end = min(start + step - timedelta(days = 1), end)
+        chunks.append(start.strftime('%Y%m%d') if chunk_end == start else start.strftime('%Y%m%d') + '-' + chunk_end.strftime('%Y%m%d'))
+        start = chunk_end + timedelta(days = 1)
+
+    return chunks
+
+def read_encoded_tags(event: Event, fields: List[Union[str, int]]) -> Dataset:
+
+    """
+
+        Reads only the selected fields from the encoded dataset of a C-STORE request, without decoding
+        the whole dataset. The values of the other elements are skipped, and reading stops after the
+        element with the highest tag requested (so the pixel data is never read if it is not requested).
+        Deflated transfer syntaxes can't be partially read, so in that case the whole dataset is decoded.
+
+        Args:
+            · event: a C-STORE request event.
+            · fields: a list of str or int with the fields to read. Strings must be standard dicom field
+            names; ints must be in the form 0xggggffff.
+
+        Returns: a pydicom.Dataset with the selected fields (those present in the encoded dataset).
+
+    """
+
+    transfer_syntax = UID(event.file_meta.TransferSyntaxUID)
+    if transfer_syntax.is_deflated:
+        return event.dataset
+
+    # Keep the character set to decode text values
+    tags = [Tag(field) for field in fields] + [Tag(0x00080005)]
+    last_tag = max(tags)
+
+    fp = event.request.DataSet
+    fp.seek(0)
+    try:
+        ds = read_dataset(fp, transfer_syntax.is_implicit_VR, transfer_syntax.is_little_endian,
+                          stop_when = lambda tag, vr, length: tag > last_tag,
+                          specific_tags = tags)
+    finally:
+        fp.seek(0)
+
+    return ds
+
+def write_encoded_dataset(fp: BinaryIO, file_meta: Dataset, stream: BytesIO) -> int:
+
+    """
+
+        Writes an encoded dataset to the file-like fp in the DICOM File Format: the preamble, the file meta
+        information and the dataset bytes are written without decoding and re-encoding the dataset.
+
+        Args:
+            · fp: a file-like object opened for binary writing.
+            · file_meta: the file meta information (e.g. event.file_meta for a C-STORE request).
+            · stream: the encoded dataset (e.g. event.request.DataSet for a C-STORE request).
+
+        Returns: the byte offset of the dataset in the file.
+
+    """
+
+    file_meta = encode_file_meta(file_meta)
+    fp.write(b'\x00' * 128)
+    fp.write(b'DICM')
+    fp.write(file_meta)
+    with stream.getbuffer() as buffer:
+        fp.write(buffer)
+
+    return 132 + len(file_meta)
+
+def send_c_store_file(assoc: Association, filename: Union[str, Path], sop_class_uid: str, sop_instance_uid: str,
+                      transfer_syntax: str = None, offset: int = None) -> Dataset:
+
+    """
+
+        Sends a C-STORE request with a dataset stored in the DICOM File Format. If the association has an
+        accepted presentation context for the SOP class with the transfer syntax of the file, the encoded
+        dataset is streamed from disk in PDU-sized chunks, without decoding it. Otherwise the file is read
+        and sent with Association.send_c_store (which decodes it and re-encodes it with an accepted
+        transfer syntax).
+
+        The streamed request uses pynetdicom internals (the ones Association.send_c_store uses to send
+        chunked datasets), so pynetdicom is pinned in requirements.txt: check tests/test_store_scu.py when
+        it is upgraded.
+
+        Args:
+            · assoc: an established association.
+            · filename: the path of the file.
+            · sop_class_uid, sop_instance_uid: the SOP Class and SOP Instance UIDs of the dataset.
+            · transfer_syntax: the transfer syntax of the dataset in the file (if None, the file is decoded).
+            · offset: the byte offset of the dataset in the file (if None, it is found by reading the
+            file meta information).
+
+        Returns: the status of the C-STORE response (see Association.send_c_store).
+
+    """
+
+    context = None
+    if transfer_syntax:
+        for cx in assoc.accepted_contexts:
+            if cx.abstract_syntax == sop_class_uid and cx.transfer_syntax[0] == transfer_syntax and cx.as_scu:
+                context = cx
+                break
+    if context is None:
+        return assoc.send_c_store(filename)
+
+    if not assoc.is_established:
+        raise RuntimeError("The association with a peer SCP must be established before sending a C-STORE request")
+    if offset is None:
+        _, offset = split_dataset(Path(filename))
+
+    # Same request as Association.send_c_store with STORE_SEND_CHUNKED_DATASET, but without re-reading
+    # the file meta information and only for this request
+    req = C_STORE()
+    req.MessageID = 1
+    req.Priority = 2
+    req.AffectedSOPClassUID = sop_class_uid
+    req.AffectedSOPInstanceUID = sop_instance_uid
+    req._dataset_path = (Path(filename), offset)
+
+    # Pause the reactor while waiting for the response, as Association.send_c_store does
+    assoc._reactor_checkpoint.clear()
+    while not assoc._is_paused:
+        time.sleep(0.0001)
+    try:
+        assoc.dimse.send_msg(req, context.context_id)
+        _, rsp = assoc.dimse.get_msg(block = True)
+    finally:
+        assoc._reactor_checkpoint.set()
+
+    if rsp is None:
+        # DIMSE timeout
+        assoc._handle_no_response()
+        return Dataset()
+
+    return assoc._check_received_status(rsp)
+
+def store_contexts(datasets: List, negotiated: dict = None) -> dict:
+
+    """
+
+        Builds the presentation contexts to request for sending datasets with C-STORE, for each SOP class: a
+        context with the default transfer syntaxes, and, for the file-backed datasets (see
+        DicomInterface.iter_store_datasets), a context with the transfer syntax of their files, so that they
+        can be sent without decoding them (see send_c_store_file).
+
+        Args:
+            · datasets: the datasets to send.
+            · negotiated: the contexts negotiated before with the device (see ContextCache.lookup), or None.
+            If the device accepted a SOP class, the context requests the transfer syntaxes it accepted. The
+            transfer syntaxes it rejected are not requested again.
+
+        Returns: a dict with a list of contexts for each SOP class. The list is empty if the device doesn't
+        support the SOP class, or rejected all its transfer syntaxes.
+
+    """
+
+    stored = {}
+    for ds in datasets:
+        syntaxes = stored.setdefault(ds.SOPClassUID, set())
+        if not isinstance(ds, (Dataset, str, Path)) and getattr(ds, 'TransferSyntaxUID', None):
+            syntaxes.add(ds.TransferSyntaxUID)
+
+    contexts = {}
+    for uid, syntaxes in stored.items():
+        accepted = negotiated['accepted'].get(uid, []) if negotiated else []
+        rejected = negotiated['rejected'].get(uid, set()) if negotiated else set()
+        if not accepted and negotiated and uid in negotiated['unsupported']:
+            contexts[uid] = []
+            continue
+        if accepted:
+            contexts[uid] = [build_context(uid, accepted)]
+        else:
+            default = [ts for ts in DEFAULT_TRANSFER_SYNTAXES if ts not in rejected]
+            contexts[uid] = [build_context(uid, default)] if default else []
+        for transfer_syntax in sorted(syntaxes):
+            if transfer_syntax not in accepted and transfer_syntax not in rejected:
+                contexts[uid].insert(0, build_context(uid, transfer_syntax))
+
+    return contexts
+
+def split_contexts(contexts: dict, reserved: int = 0) -> List[List[str]]:
+
+    """
+
+        Splits the SOP classes of a dict of contexts by SOP class (see store_contexts) in groups that can be
+        requested in one association (at most MAX_CONTEXTS contexts, minus reserved contexts for other uses).
+        SOP classes without contexts are left out.
+
+    """
+
+    groups, group, size = [], [], 0
+    for uid, cxs in contexts.items():
+        if not cxs:
+            continue
+        if group and size + len(cxs) > MAX_CONTEXTS - reserved:
+            groups.append(group)
+            group, size = [], 0
+        group.append(uid)
+        size += len(cxs)
+    if group:
+        groups.append(group)
+
+    return groups
+
 def default_store_handler(event: Event, 
         write_to_disk: str = True, root_dir: str = 'incoming', 
         dcm_path: List[str] = ['PatientName', 'StudyDescription', 'SeriesDescription'], 
         dcm_filename: str = 'SOPInstanceUID',        
-        output_queue: Queue = None, keep_fields: List[Union[str, int]] = None) -> int:
+        output_queue: Queue = None, keep_fields: List[Union[str, int]] = None,
+        write_raw: bool = False) -> int:
 
     """
     
@@ -89,17 +350,28 @@ def default_store_handler(event: Event,
         · keep_fields: a list of str or int to select the dicom fields that should be kept when putting the
         datasets on output_queue. Strings must be standard dicom field names; ints must be in the form 0xggggffff,
         where g and f are the numbers for the corresponding dicom tag. If
+        · write_raw (bool, default: False): if True, the dataset is written to disk as it was received, without
+        decoding and re-encoding it. Only the fields needed for the path, the filename and keep_fields are read
+        (see read_encoded_tags). If datasets are put in output_queue without selecting keep_fields, the whole
+        dataset is still decoded.
 
     """
     
     try:
-        ds = event.dataset
-        ds.file_meta = event.file_meta
+        if write_raw and (keep_fields or not output_queue):
+            ds = read_encoded_tags(event, dcm_path + [dcm_filename] + (keep_fields or []))
+        else:
+            ds = event.dataset
+            ds.file_meta = event.file_meta
         if write_to_disk:            
             filedir = os.path.join(root_dir, *[str(ds[field].value).replace('/','_') for field in dcm_path])
             os.makedirs(filedir, exist_ok = True)
             filepath = os.path.join(filedir, str(ds[dcm_filename].value).replace('/','_'))
-            ds.save_as(filepath, write_like_original = False)
+            if write_raw:
+                with open(filepath, 'wb') as f:
+                    write_encoded_dataset(f, event.file_meta, event.request.DataSet)
+            else:
+                ds.save_as(filepath, write_like_original = False)
     except:
         app_logger.error("SCP: dataset could not be written to disk")
 
@@ -123,6 +395,50 @@ def default_store_handler(event: Event,
     
     return 0x0000 
 
+class ReusePortAssociationServer(ThreadedAssociationServer):
+
+    """
+
+    Association server that binds its socket with SO_REUSEPORT, so that several processes can listen
+    on the same address and port. The kernel distributes the incoming connections between them.
+
+    """
+
+    def server_bind(self) -> None:
+
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+class AdmissionACSE(ACSE):
+
+    """
+
+    ACSE that asks the DicomInterface whether an association request can be admitted (see
+    DicomInterface.admit_association) before negotiating it. Requests that are not admitted are rejected
+    as transient, local limit exceeded, so that the calling AE retries later.
+
+    """
+
+    def _negotiate_as_acceptor(self) -> None:
+
+        calling_aet = self.requestor.primitive.calling_ae_title.strip()
+        if not self.assoc.ae.admit_association(self.assoc, calling_aet):
+            self.send_reject(0x02, 0x03, 0x02)
+            evt.trigger(self.assoc, evt.EVT_REJECTED, {})
+            self.assoc.kill()
+            return
+        super()._negotiate_as_acceptor()
+
+class AdmissionRequestHandler(RequestHandler):
+
+    """ Request handler that creates the associations with an AdmissionACSE """
+
+    def _create_association(self):
+
+        assoc = super()._create_association()
+        assoc.acse = AdmissionACSE(assoc)
+        return assoc
+
 class DicomInterface(AE):    
 
     """ 
@@ -130,7 +446,8 @@ class DicomInterface(AE):
     
     """
 
-    def __init__(self, address = '0.0.0.0', port = None, acse_timeout:int = 60,
+    def __init__(self, address = '0.0.0.0', port = None, acse_timeout:int = 60, dimse_timeout: int = 120,
+                       network_timeout: int = 120, connection_timeout: float = None,
                        store_handler: Callable = default_store_handler, *args, **kwargs):
 
         """
@@ -142,9 +459,29 @@ class DicomInterface(AE):
             · port: int, optional, default None
                 The port to use for the Store SCP. Can be ommited during instantiation, but 
                 must be set to a valid int before using starting store SCP.
+            · acse_timeout: int, optional, default 60
+                Seconds to wait for the association negotiation (and release) messages.
+            · dimse_timeout: int, optional, default 120
+                Seconds to wait for the DIMSE messages (e.g. the responses of a C-FIND).
+            · network_timeout: int, optional, default 120
+                Seconds without network activity before an association is aborted.
+            · connection_timeout: float, optional, default None
+                Seconds to wait for the TCP connection when requesting an association (None: the OS timeout).
             · store_handler: an appropiate handler for a C-STORE request (see pynetdicom documentation for
             more hints on how to write an appropiate handler). If not specified, the default handler defined
             above will be used.
+
+        Other event handlers for the Store SCP (e.g. for evt.EVT_RELEASED) can be added as (event, handler)
+        tuples to the extra_handlers attribute before starting the SCP. If the reuse_port attribute is set
+        to True, the Store SCP listens with SO_REUSEPORT (see ReusePortAssociationServer).
+
+        Association requests to the Store SCP are admitted according to these attributes (see
+        admit_association):
+            · max_associations: maximum number of simultaneous associations (None: no limit).
+            · max_associations_per_ae: maximum number of simultaneous associations from the same calling
+            AE title (None: no limit).
+            · queue_load: a function that returns how full the queue behind the store handler is (0 to 1),
+            or None. New associations are rejected while it is at or above max_queue_load.
         
         """
         # Get ae_title to initalize class
@@ -154,10 +491,34 @@ class DicomInterface(AE):
         self.address = address
         self.port = port
         self.store_handler = store_handler
+        self.extra_handlers = []
+        self.reuse_port = False
         self.store_scp_active = False
-        self.acse_timeout = 120
-        self.dimse_timeout = 120
-        self.network_timeout = 120
+
+        # SCU associations are taken from the pool shared by the whole application, the contexts they
+        # negotiate are kept in the shared context cache, and the query responses in the shared query cache
+        self.pool = association_pool
+        self.context_cache = context_cache
+        self.query_cache = query_cache
+        # Associations with the devices that are down (see DeviceMonitor) are refused without trying them
+        self.device_monitor = device_monitor
+        # Associations used in parallel by the queries that are split in several C-FIND (e.g. query_imgs_in_study)
+        self.query_associations = 4
+
+        # Admission control
+        self.max_associations = 10
+        self.max_associations_per_ae = None
+        self.queue_load = None
+        self.max_queue_load = 0.9
+        self.admission_lock = threading.Lock()
+        self.admitted = {}
+        self.accepted = 0
+        self.rejected = {'max_associations': 0, 'max_associations_per_ae': 0, 'queue_load': 0}
+        self.rejected_by_ae = {}
+        self.acse_timeout = acse_timeout
+        self.dimse_timeout = dimse_timeout
+        self.network_timeout = network_timeout
+        self.connection_timeout = connection_timeout
 
         # AE configuration
         # Requested contexts (when acting as Store SCU)
@@ -190,10 +551,18 @@ class DicomInterface(AE):
             """Handle a C-ECHO request event."""
             return 0x0000
 
-        handlers = [(evt.EVT_C_STORE, self.store_handler), (evt.EVT_C_ECHO, handle_echo)]            
+        handlers = [(evt.EVT_C_STORE, self.store_handler), (evt.EVT_C_ECHO, handle_echo),
+                    (evt.EVT_CONN_CLOSE, self.release_admission)] + self.extra_handlers
+
+        # The admission limits are checked by admit_association, the AE limit must not get in the way
+        self.maximum_associations = max(self.maximum_associations, self.max_associations + 1) if self.max_associations else sys.maxsize
 
         # Start listening for incoming association requests
-        self.server = self.start_server((self.address, self.port), evt_handlers=handlers, block = False)
+        server_class = ReusePortAssociationServer if self.reuse_port else ThreadedAssociationServer
+        self.server = self.make_server((self.address, self.port), evt_handlers = handlers, server_class = server_class,
+                                       request_handler = AdmissionRequestHandler)
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+        self._servers.append(self.server)
         self.store_scp_active = True
         # Show message       
         app_logger.info('Starting store SCP listener ' + self.ae_title.strip() + '@' + self.address + ':' + str(self.port))
@@ -206,39 +575,132 @@ class DicomInterface(AE):
         self.store_scp_active = False
         app_logger.debug("Store SCP stopped")
 
-    def get_association(self, device: dict, *args,**kwargs) -> Association:
+    def admit_association(self, assoc: Association, calling_aet: str) -> bool:
+
+        """
+
+            Decides whether an association request to the Store SCP is admitted. It is rejected if
+            max_associations associations are already admitted, if max_associations_per_ae associations
+            from calling_aet are already admitted, or if queue_load is at or above max_queue_load.
+
+            Admitted associations are counted until their connection is closed (see release_admission).
+
+            Returns: True if the association is admitted.
+
+        """
+
+        load = self.queue_load() if self.queue_load else 0
+        with self.admission_lock:
+            reason = None
+            if self.max_associations and sum(self.admitted.values()) >= self.max_associations:
+                reason = 'max_associations'
+            elif self.max_associations_per_ae and self.admitted.get(calling_aet, 0) >= self.max_associations_per_ae:
+                reason = 'max_associations_per_ae'
+            elif load >= self.max_queue_load:
+                reason = 'queue_load'
+
+            if reason:
+                self.rejected[reason] += 1
+                self.rejected_by_ae[calling_aet] = self.rejected_by_ae.get(calling_aet, 0) + 1
+            else:
+                self.admitted[calling_aet] = self.admitted.get(calling_aet, 0) + 1
+                self.accepted += 1
+                assoc.admitted_aet = calling_aet
+
+        if reason:
+            app_logger.warning(f'association from {calling_aet} rejected ({reason})')
+            return False
+        return True
+
+    def release_admission(self, event: Event) -> None:
+
+        """ Handler for evt.EVT_CONN_CLOSE: stops counting the association as admitted """
+
+        calling_aet = getattr(event.assoc, 'admitted_aet', None)
+        if calling_aet is None:
+            return
+        with self.admission_lock:
+            self.admitted[calling_aet] -= 1
+            if not self.admitted[calling_aet]:
+                del self.admitted[calling_aet]
+        event.assoc.admitted_aet = None
+
+    def get_association_stats(self) -> dict:
+
+        with self.admission_lock:
+            return {
+                'active': sum(self.admitted.values()),
+                'active_by_ae': dict(self.admitted),
+                'accepted': self.accepted,
+                'rejected': dict(self.rejected),
+                'rejected_by_ae': dict(self.rejected_by_ae),
+                'limits': {
+                    'max_associations': self.max_associations,
+                    'max_associations_per_ae': self.max_associations_per_ae,
+                    'max_queue_load': self.max_queue_load,
+                },
+                'queue_load': self.queue_load() if self.queue_load else None,
+            }
+
+    def get_association(self, device: dict, contexts: List = None) -> Association:
 
         """
 
-        If a live association with the device exists, return it. If not, start it and return it.
+        Takes an association with the device from the association pool (opening it if there is no idle one).
+        It must be given back with release_association when it is not needed anymore.
 
         device: a dict with the following keys/values:
             · ae_title: str with the ae_title of the remote application
             · address: str with the ip address of the remote application
             · port: int with the TCP port where the remote application is running          
+        contexts: the requested presentation contexts (if None, the requested contexts of this AE)
         
         Returns: an active association with the selected device
 
         Raises:
-            RuntimeError if association could not be established.
+            RuntimeError if association could not be established (AssociationError if the device didn't
+            answer or rejected the association, or if it is known to be down).
         """
 
-        # Keep neccesary keys only
-        device = {'ae_title': device['ae_title'],
-                  'address': device['address'],
-                  'port': device['port']}
-        
-        for assoc in self.active_associations:
-            remote = {key: assoc.remote[key] for key in device.keys()}
-            if remote == device:
-                return assoc
-        
-        assoc = self.associate(device['address'], device['port'], ae_title = device['ae_title'], *args, **kwargs)
-
-        if not assoc.is_established:
-            raise(RuntimeError(f"Association with {device['ae_title']}@{device['address']}:{device['port']} could not be established"))
+        if not self.device_monitor.allow(device):
+            raise AssociationError(f"{device['ae_title']}@{device['address']}:{device['port']} is down")
+        try:
+            assoc = self.pool.acquire(self, device, contexts)
+        except AssociationError as e:
+            # A device that rejects the association (e.g. it is busy) is up: only no answer or an abort is a failure
+            if e.rejected:
+                self.device_monitor.record_success(device)
+            else:
+                self.device_monitor.record_failure(device, str(e))
+            raise
+        self.device_monitor.record_success(device)
+        self.context_cache.record(device, assoc)
 
         return assoc
+
+    def release_association(self, assoc: Association, discard: bool = False) -> None:
+
+        """
+            Gives an association taken with get_association back to the pool (or closes it if discard is True)
+        """
+
+        self.pool.release(assoc, discard)
+
+    @contextmanager
+    def association(self, device: dict, contexts: List = None):
+
+        """
+            Context manager to use an association from the pool (see get_association and AssociationPool.association)
+        """
+
+        assoc = self.get_association(device, contexts)
+        try:
+            yield assoc
+        except Exception:
+            self.release_association(assoc, discard = True)
+            raise
+        else:
+            self.release_association(assoc)
             
     def release_connections(self) -> None:
         """
@@ -255,64 +717,356 @@ class DicomInterface(AE):
 
         """
         try:
-            assoc = self.get_association(device)
-
-            if assoc.is_established:
+            with self.association(device) as assoc:
                 echo_response = assoc.send_c_echo()
-                if 'Status' in echo_response: 
-                    return echo_response.Status
-            else:
-                return -1
+            if 'Status' in echo_response: 
+                return echo_response.Status
+            return -1
         except RuntimeError:
             app_logger.debug(f"DicomInterface - echo: Association with {device['ae_title']}@{device['address']}:{device['port']} could not be established")
             return -1
 
-    def query_device(self, device: dict, search_criteria: Union[dict, Dataset]) ->  List[Dataset]:
+    def query_device(self, device: dict, search_criteria: Union[dict, Dataset], max_results: int = None) ->  List[Dataset]:
 
         """        
-            Query a device with custom search_criteria
+            Query a device with custom search_criteria (see iter_query_device for max_results)
 
         """
 
+        return list(self.iter_query_device(device, search_criteria, max_results))
+
+    def iter_query_device(self, device: dict, search_criteria: Union[dict, Dataset], max_results: int = None,
+                          strict: bool = False) -> Iterator[Dataset]:
+
+        """
+
+            Query a device with custom search_criteria, yielding each response as it is received, so that the
+            responses don't have to be held in memory until the query completes.
+
+            If the iterator is closed before the query completes, the association is aborted.
+
+            If max_results is set, the query is cancelled (C-CANCEL) after max_results responses, so that the device
+            stops searching. To know if there were more results, ask for one more than needed. The responses that
+            the device sent before it received the C-CANCEL are yielded too, so there may be more than max_results.
+
+            The responses of completed queries are cached (see QueryCache) for the devices with a cache ttl, and
+            repeated queries are answered from the cache.
+
+            A query that fails (the association could not be established, a failure status, a DIMSE timeout or an
+            abort) just ends, after the responses received until then. If strict is True, it raises RuntimeError
+            instead (AssociationError if the association could not be established).
+
+        """
+
+        # Set query parameters
+        ds = Dataset()
+        ds.update(search_criteria)
+
+        # Answer from the cache if the device answered the same query recently
+        cached = self.query_cache.lookup(device, ds)
+        if cached is not None:
+            app_logger.debug(f"DicomInterface - query_device: Got {len(cached)} results from the cache for {device['ae_title']}")
+            yield from cached[:max_results or None]
+            return
+
         # Get the association with the device
         try:
             assoc = self.get_association(device)
         except RuntimeError:
             app_logger.debug(f"DicomInterface - query_device: Association with {device['ae_title']}@{device['address']}:{device['port']} could not be established")
-            return []
-
-        # Set query parameters
-        ds = Dataset()
-        ds.update(search_criteria)
+            if strict:
+                raise
+            return
         
         # Start the query
         app_logger.debug(f"DicomInterface - query_device: Querying association with {assoc.acceptor.ae_title}")
+        recorder = self.query_cache.recorder(device, ds)
+        count = 0
+        completed = False
+        cancelled = False
+        status = None
         try:
-            c_find_resp = assoc.send_c_find(ds, StudyRootQueryRetrieveInformationModelFind)    
-            # Extract results
-            query_results = list(c_find_resp)  
+            c_find_resp = assoc.send_c_find(ds, StudyRootQueryRetrieveInformationModelFind, msg_id = 1)    
+            for status, identifier in c_find_resp:
+                # Discard None
+                if identifier:
+                    count += 1
+                    if recorder:
+                        recorder.add(identifier)
+                    yield identifier
+                    if max_results and count >= max_results:
+                        break
+            else:
+                completed = True
+            if not completed:
+                # Stop the query. The association can be reused if the device answers the cancellation. The
+                # query is incomplete whatever the final status (many devices answer a C-CANCEL with 0x0000)
+                cancelled = True
+                status, drained = self._cancel_c_find(assoc, c_find_resp)
+                completed = status is not None
+                # The responses that were on their way when the query was cancelled
+                for identifier in drained:
+                    count += 1
+                    if recorder:
+                        recorder.add(identifier)
+                    yield identifier
         except RuntimeError:      
             app_logger.debug(f"DicomInterface - query_device: Association with {device['ae_title']}@{device['address']}:{device['port']} is not stablished")
-            query_results = []
         except Exception as e:
             app_logger.error(traceback.format_exc())
-            query_results = []
+        finally:
+            established = assoc.is_established
+            # The association is aborted if the query didn't complete (e.g. the iterator was closed)
+            self.release_association(assoc, discard = not completed)
+
+        # Only the complete answers are cached: not cancelled, with a success final status (not a failure, nor
+        # the empty status of a DIMSE timeout or an abort) and with the association still established
+        succeeded = completed and not cancelled and status and status.Status == 0x0000 and established
+        if succeeded and recorder:
+            recorder.commit()
+        app_logger.debug(f"DicomInterface - query_device: Got {count} results from query to {assoc.acceptor.ae_title}" + 
+                         (" (cancelled)" if cancelled else ""))
+        if strict and not succeeded and not cancelled:
+            raise RuntimeError(f"Query to {device['ae_title']}@{device['address']}:{device['port']} failed" +
+                               (f" with status 0x{status.Status:04X}" if status and 'Status' in status else ""))
+
+    def _cancel_c_find(self, assoc: Association, c_find_resp: Iterator, max_pending: int = 100) -> Tuple[Dataset, List[Dataset]]:
+
+        """
+
+            Sends a C-CANCEL for the C-FIND in progress in an association, and reads the pending responses that
+            were already on their way until the final one.
+
+            Returns: the status of the final response, or None if it didn't arrive (e.g. the device ignored the
+            C-CANCEL and sent more than max_pending responses), and the identifiers of the pending responses.
+
+        """
+
+        app_logger.debug(f"DicomInterface - query_device: Cancelling query to {assoc.acceptor.ae_title}")
+        assoc.send_c_cancel(1, query_model = StudyRootQueryRetrieveInformationModelFind)
+        drained = []
+        for pending, (status, identifier) in enumerate(c_find_resp):
+            if status and not status.Status in [0xFF00, 0xFF01]:
+                return status, drained
+            if identifier:
+                drained.append(identifier)
+            if pending >= max_pending:
+                break
+
+        return None, drained
+
+    def iter_query_device_by_date(self, device: dict, search_criteria: Union[dict, Dataset], chunk: str = 'day',
+                                  associations: int = None, max_results: int = None) -> Iterator[Dataset]:
+
+        """
+
+            Query a device with custom search_criteria, splitting its StudyDate range in ranges of one day or one
+            week (see split_date_range) that are queried in parallel, for devices that answer wide ranges slowly.
 
+            Each association (taken from the pool) queries the next range that has not been queried yet, at most
+            2 * associations ranges ahead of the one being yielded. The number of associations is associations
+            (or self.query_associations if None), capped by the number of ranges and by the pool size per device.
 
-        # Format the output
-        responses = []
-        for element in query_results:
-            # Discard None
-            if element[1]:
-                responses.append(element[1])
+            The responses are yielded in date order: the ranges in order, each one as soon as it and the previous
+            ones completed, sorted by StudyDate and StudyTime. If max_results is set, at most max_results responses
+            are yielded (each range is also cancelled after max_results, see iter_query_device). If the StudyDate
+            can't be split, the query is sent as is.
 
-        app_logger.debug(f"DicomInterface - query_device: Got {len(responses)} results from query to {assoc.acceptor.ae_title}")
+            Raises: ValueError if chunk is not one of DATE_CHUNKS, and RuntimeError (when the responses of that
+            range are reached) if the query of a range failed, so that a failed range doesn't look empty.
 
-        return responses
+        """
+
+        # Set query parameters
+        ds = Dataset()
+        ds.update(search_criteria)
+        chunks = split_date_range(ds.get('StudyDate', ''), chunk)
+        if len(chunks) <= 1:
+            yield from self.iter_query_device(device, ds, max_results)
+            return
+
+        associations = min(len(chunks), associations or self.query_associations, self.pool.max_size)
+        app_logger.debug(f"DicomInterface - query_device: Querying {len(chunks)} date ranges in {device['ae_title']} over {associations} associations")
+
+        # Responses of each range (None until it completes, or the exception if it failed), next range to query,
+        # and first range not yielded yet
+        results = [None] * len(chunks)
+        state = {'next': 0, 'yielding': 0, 'stop': False}
+        changed = threading.Condition()
+
+        def query():
+            while True:
+                with changed:
+                    while not state['stop'] and state['next'] < len(chunks) and state['next'] >= state['yielding'] + 2 * associations:
+                        changed.wait()
+                    if state['stop'] or state['next'] >= len(chunks):
+                        return
+                    idx = state['next']
+                    state['next'] += 1
+                responses = None
+                try:
+                    # The elements of a Dataset.update copy are shared, so the query is copied
+                    chunk_ds = deepcopy(ds)
+                    chunk_ds.StudyDate = chunks[idx]
+                    responses = list(self.iter_query_device(device, chunk_ds, max_results, strict = True))
+                    responses.sort(key = lambda response: (str(response.get('StudyDate', '')), str(response.get('StudyTime', ''))))
+                except Exception as e:
+                    responses = e
+                finally:
+                    # The consumer waits for every range, so the result is always set
+                    with changed:
+                        results[idx] = responses if responses is not None else RuntimeError(f"Query of range {chunks[idx]} failed")
+                        changed.notify_all()
+
+        threads = [threading.Thread(target = query, daemon = True, name = f"QueryDates-{idx}") for idx in range(associations)]
+        for thread in threads:
+            thread.start()
+
+        count = 0
+        try:
+            for idx in range(len(chunks)):
+                with changed:
+                    while results[idx] is None:
+                        changed.wait()
+                    responses, results[idx] = results[idx], []
+                    state['yielding'] = idx + 1
+                    changed.notify_all()
+                if isinstance(responses, Exception):
+                    raise responses
+                for response in responses:
+                    yield response
+                    count += 1
+                    if max_results and count >= max_results:
+                        return
+        finally:
+            # Don't start the ranges that were not queried yet (e.g. the iterator was closed)
+            with changed:
+                state['stop'] = True
+                changed.notify_all()
+
+    def query_devices(self, queries: dict, timeout: Union[float, dict] = None, max_results: int = None,
+                      date_chunks: str = None) -> Tuple[dict, List]:
+
+        """
+
+            Sends queries to several devices in parallel and waits for the responses until every device answered
+            or its deadline passed (see iter_query_devices), so that the total time is that of the slowest device
+            that answers in time.
+
+            Args:
+                · queries, timeout, max_results, date_chunks: see iter_query_devices.
+
+            Returns: a dict with the list of responses for each key that answered in time, and a list with
+            the keys whose deadline passed (their responses are discarded).
+
+        """
+
+        responses = {key: [] for key in queries}
+        completed = []
+        for key, response in self.iter_query_devices(queries, timeout, max_results, date_chunks):
+            if response is None:
+                completed.append(key)
+            else:
+                responses[key].append(response)
+
+        timed_out = [key for key in queries if not key in completed]
+
+        return {key: responses[key] for key in completed}, timed_out
+
+    def iter_query_devices(self, queries: dict, timeout: Union[float, dict] = None,
+                           max_results: int = None, date_chunks: str = None) -> Iterator[Tuple[object, Dataset]]:
+
+        """
+
+            Sends queries to several devices in parallel (see iter_query_device), each one in its own thread, and
+            yields the responses of all of them as they are received, until every query completed or its
+            deadline passed.
+
+            The responses wait for the caller in a bounded queue: if the iterator is not advanced, the queries
+            stop reading responses. The queries whose deadline passed, and all of them when the iterator is
+            closed, are stopped (their late responses are discarded).
+
+            Args:
+                · queries: a dict with a (device, search_criteria) tuple for each key (e.g. the device names).
+                · timeout: seconds to wait for the responses of each device, from the start of the queries.
+                A dict with a timeout for each key can be used instead. The interface dimse_timeout is used if
+                timeout is None, and for the keys missing from the dict.
+                · max_results: the maximum number of responses of each device (see iter_query_device).
+                · date_chunks: if 'day' or 'week', the StudyDate range of each query is split in ranges queried
+                in parallel (see iter_query_device_by_date).
+
+            Yields: (key, response) for each response, and (key, None) when the query of a key completes.
+            The keys that don't get a (key, None) timed out.
+
+        """
+
+        results = Queue(maxsize = 256)
+        stopped = {key: threading.Event() for key in queries}
+
+        def put(key, response) -> bool:
+            while not stopped[key].is_set():
+                try:
+                    results.put((key, response), timeout = 0.5)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def query(key, device, search_criteria):
+            if date_chunks:
+                responses = self.iter_query_device_by_date(device, search_criteria, date_chunks, max_results = max_results)
+            else:
+                responses = self.iter_query_device(device, search_criteria, max_results)
+            try:
+                for response in responses:
+                    if not put(key, response):
+                        return
+            except Exception as e:
+                app_logger.error(f"DicomInterface - query_devices: query to {device['ae_title']} failed: {repr(e)}")
+            finally:
+                responses.close()
+            put(key, None)
+
+        start = time.time()
+        if not isinstance(timeout, dict):
+            timeout = {key: timeout for key in queries}
+        deadlines = {key: start + (timeout.get(key) or self.dimse_timeout) for key in queries}
+        for key, (device, search_criteria) in queries.items():
+            threading.Thread(target = query, args = (key, device, search_criteria), daemon = True,
+                             name = f"Query-{device['ae_title']}").start()
+
+        pending = set(queries)
+        timed_out = []
+        try:
+            while pending:
+                # Stop the queries whose deadline passed
+                for key in [key for key in pending if time.time() > deadlines[key]]:
+                    pending.discard(key)
+                    stopped[key].set()
+                    timed_out.append(key)
+                if not pending:
+                    break
+                try:
+                    # Wake up at the nearest deadline, to stop that query in time
+                    key, response = results.get(timeout = max(0, min(deadlines[key] for key in pending) - time.time()))
+                except Empty:
+                    continue
+                if not key in pending or time.time() > deadlines[key]:
+                    continue
+                if response is None:
+                    pending.discard(key)
+                yield key, response
+        finally:
+            for event in stopped.values():
+                event.set()
+            if timed_out:
+                app_logger.info(f"DicomInterface - query_devices: no response in time from {timed_out}")
 
     def query_studies_in_device(self, device: dict, 
         search_criteria: Union[dict, Dataset] = None, 
-        responses: Union[dict, Dataset] = None) ->  List[Dataset]:
+        responses: Union[dict, Dataset] = None,
+        max_results: int = None,
+        date_chunks: str = None) ->  List[Dataset]:
 
         """
         
@@ -329,20 +1083,17 @@ class DicomInterface(AE):
                 Searches for PET studies on 1/2/2023 and asks the remote device to report patient name and
                 study description for each result.
 
+            If max_results is set, the query is cancelled after max_results studies (see iter_query_device).
+            If date_chunks is 'day' or 'week', the StudyDate range is split in ranges queried in parallel (see
+            iter_query_device_by_date).
+
         """
 
-        # Set query parameters
-        ds = Dataset()        
-        if search_criteria:
-            ds.update(search_criteria)
-        if not responses:
-            responses = default_query('STUDY')        
-        new_entries = {key:value for key,value in responses.items() if not key in ds}
-        ds.update(new_entries)           
-        ds.QueryRetrieveLevel = 'STUDY'
-        ds.StudyInstanceUID = ''
+        if date_chunks:
+            return list(self.iter_query_device_by_date(device, study_query(search_criteria, responses), date_chunks,
+                                                       max_results = max_results))
 
-        return self.query_device(device, ds)
+        return self.query_device(device, study_query(search_criteria, responses), max_results)
 
     def query_series_in_study(self, device: dict, StudyInstanceUID: Union[str, UID],
         search_criteria : Union[Dataset, dict] = None,
@@ -421,7 +1172,8 @@ class DicomInterface(AE):
     def query_imgs_in_study(self, device: dict, StudyInstanceUID: Union[str, UID],
         series_search_criteria : Union[Dataset, dict] = None,
         imgs_search_criteria : Union[Dataset, dict] = None,
-        responses : Union[Dataset, dict] = {}) -> List[Dataset]:
+        responses : Union[Dataset, dict] = {},
+        associations: int = None) -> List[Dataset]:
 
         """
         
@@ -435,15 +1187,42 @@ class DicomInterface(AE):
             be a dict or pydicom.dataset object with the keys to fetch and blank values. If not specified,
             the SOPInstanceUID is the only field guaranteed to be retrieved.            
 
+            The image level queries of the series run in parallel, each association (taken from the pool) querying
+            the next series that has not been queried yet. The number of associations is associations (or
+            self.query_associations if None), capped by the number of series and by the pool size per device.
+            The images are returned in the order of the series.
+
         """
 
         # Find the series in the study
         series = self.query_series_in_study(device, StudyInstanceUID, series_search_criteria)        
-        imgs = []
-        for ss in series:
-            imgs.extend(self.query_imgs_in_series(device, StudyInstanceUID, ss.SeriesInstanceUID, imgs_search_criteria, responses))
-
-        return imgs
+        associations = min(len(series), associations or self.query_associations, self.pool.max_size)
+
+        # Query the images of each series, in parallel if more than one association is used
+        imgs = [[] for _ in series]
+        pending = Queue()
+        for idx in range(len(series)):
+            pending.put(idx)
+
+        def query():
+            while True:
+                try:
+                    idx = pending.get_nowait()
+                except Empty:
+                    return
+                imgs[idx] = self.query_imgs_in_series(device, StudyInstanceUID, series[idx].SeriesInstanceUID,
+                                                      imgs_search_criteria, responses)
+
+        if associations <= 1:
+            query()
+        else:
+            threads = [threading.Thread(target = query, daemon = True, name = f"QueryImgs-{idx}") for idx in range(associations)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        return [img for series_imgs in imgs for img in series_imgs]
 
         
     def move_datasets(self, src_device: dict, dst_device_aet: str, datasets: List[Dataset]) -> List[dict]:
@@ -481,34 +1260,37 @@ class DicomInterface(AE):
         try:
             association = self.get_association(src_device)   
             
-            for dataset in datasets:                
+            try:
+                for dataset in datasets:                
                 
-                    ds = Dataset()
+                        ds = Dataset()
                     
-                    # Keep relevant fields only            
-                    for elem in dataset:
-                        if elem.keyword == 'QueryRetrieveLevel':
-                            setattr(ds, 'QueryRetrieveLevel', elem.value)
-                        if isinstance(elem.value, UID):
-                            setattr(ds, elem.keyword, elem.value)                
-                    try:
-                        c_move_response = association.send_c_move(ds, move_aet = dst_device_aet, query_model = StudyRootQueryRetrieveInformationModelMove)
-
-                        responses = list(c_move_response)
+                        # Keep relevant fields only            
+                        for elem in dataset:
+                            if elem.keyword == 'QueryRetrieveLevel':
+                                setattr(ds, 'QueryRetrieveLevel', elem.value)
+                            if isinstance(elem.value, UID):
+                                setattr(ds, elem.keyword, elem.value)                
+                        try:
+                            c_move_response = association.send_c_move(ds, move_aet = dst_device_aet, query_model = StudyRootQueryRetrieveInformationModelMove)
+
+                            responses = list(c_move_response)
                         
-                        # Select the last response with sub-operations data            
-                        idx = -1
-                        while not -idx > len(responses) and not 'NumberOfCompletedSuboperations' in responses[idx][0]:
-                            idx-=1                
-                        if -idx > len(responses):
+                            # Select the last response with sub-operations data            
+                            idx = -1
+                            while not -idx > len(responses) and not 'NumberOfCompletedSuboperations' in responses[idx][0]:
+                                idx-=1                
+                            if -idx > len(responses):
+                                results.append({'Completed': None, 'Failed': None, 'Warning': None})
+                            else:
+                                results.append({'Completed': responses[idx][0]['NumberOfCompletedSuboperations'].value,
+                                                'Failed': responses[idx][0]['NumberOfFailedSuboperations'].value,
+                                                'Warning': responses[idx][0]['NumberOfWarningSuboperations'].value})                
+                        except RuntimeError:
                             results.append({'Completed': None, 'Failed': None, 'Warning': None})
-                        else:
-                            results.append({'Completed': responses[idx][0]['NumberOfCompletedSuboperations'].value,
-                                            'Failed': responses[idx][0]['NumberOfFailedSuboperations'].value,
-                                            'Warning': responses[idx][0]['NumberOfWarningSuboperations'].value})                
-                    except RuntimeError:
-                        results.append({'Completed': None, 'Failed': None, 'Warning': None})
-                        app_logger.debug(f"DicomInterface - move_datasets: Association with {src_device['ae_title']}@{src_device['address']}:{src_device['port']} is not stablished")
+                            app_logger.debug(f"DicomInterface - move_datasets: Association with {src_device['ae_title']}@{src_device['address']}:{src_device['port']} is not stablished")
+            finally:
+                self.release_association(association)
         
         except RuntimeError:
             app_logger.debug(f"DicomInterface - move_datasets: Association with {src_device['ae_title']}@{src_device['address']}:{src_device['port']} is not stablished")
@@ -564,26 +1346,39 @@ class DicomInterface(AE):
         if not store_handler:
             store_handler = self.store_handler
 
-        # Set the presentation contexts for the C-GET association
-        contexts = [build_context(StudyRootQueryRetrieveInformationModelGet)]
-
-        # Add the SOP class uids present in the datasets to the requested contexts for the association        
-        new_uids = set([ds.SOPClassUID for ds in datasets])
-        for uid in new_uids:
-            contexts.append(build_context(uid))
-
-        # Stablish a specific association with role negotiation for the c_get
-        roles = []
-        for context in contexts[1:]:
-            roles.append(build_role(context.abstract_syntax, scp_role=True))        
-        handlers = [(evt.EVT_C_STORE, store_handler)]
-        association = self.associate(device['address'], device['port'], contexts, device['ae_title'], ext_neg = roles, evt_handlers = handlers)
-        results = []        
-            
-        # For each element in datasets, send a C-GET request
-        if association.is_established:                 
-            for dataset in datasets:              
+        # The SOP class uids present in the datasets are added to the requested contexts, with the SCP role.
+        # Those that the device rejected before fail without a request, and if there are more than fit in
+        # one association (besides the C-GET context), the datasets are split in several associations
+        negotiated = self.context_cache.lookup(device, 'scp')
+        new_uids = list(dict.fromkeys([ds.SOPClassUID for ds in datasets if 'SOPClassUID' in ds]))
+        refused = set([uid for uid in new_uids if negotiated and not uid in negotiated['accepted'] and uid in negotiated['unsupported']])
+        groups = split_contexts({uid: [build_context(uid)] for uid in new_uids if not uid in refused}, reserved = 1) or [[]]
+
+        results = [{'Completed': None, 'Failed': None, 'Warning': None} for _ in datasets]
+        for group_idx, group in enumerate(groups):
+            # Datasets without SOP class uid (e.g. study or series level) go with the first group
+            indices = [idx for idx, ds in enumerate(datasets)
+                       if ds.get('SOPClassUID') in group or (group_idx == 0 and not 'SOPClassUID' in ds)]
+            if not indices:
+                continue
+
+            # Set the presentation contexts for the C-GET association
+            contexts = [build_context(StudyRootQueryRetrieveInformationModelGet)]
+            for uid in group:
+                contexts.append(build_context(uid))
+
+            # Stablish a specific association with role negotiation for the c_get
+            roles = []
+            for context in contexts[1:]:
+                roles.append(build_role(context.abstract_syntax, scp_role=True))        
+            handlers = [(evt.EVT_C_STORE, store_handler)]
+            association = self.associate(device['address'], device['port'], contexts, device['ae_title'], ext_neg = roles, evt_handlers = handlers)
                 
+            # For each element in datasets, send a C-GET request
+            if association.is_established:
+                self.context_cache.record(device, association, 'scp')
+                for idx in indices:
+                    dataset = datasets[idx]
                     ds = Dataset()                    
                     # Keep relevant fields only            
                     for elem in dataset:
@@ -596,22 +1391,21 @@ class DicomInterface(AE):
                         responses = list(c_get_response)
                         
                         # Select the last response with sub-operations data            
-                        idx = -1
-                        while not -idx > len(responses) and not 'NumberOfCompletedSuboperations' in responses[idx][0]:
-                            idx-=1                
-                        if -idx > len(responses):
-                            results.append({'Completed': None, 'Failed': None, 'Warning': None})
-                        else:
-                            results.append({'Completed': responses[idx][0]['NumberOfCompletedSuboperations'].value,
-                                            'Failed': responses[idx][0]['NumberOfFailedSuboperations'].value,
-                                            'Warning': responses[idx][0]['NumberOfWarningSuboperations'].value})     
+                        last = -1
+                        while not -last > len(responses) and not 'NumberOfCompletedSuboperations' in responses[last][0]:
+                            last-=1                
+                        if not -last > len(responses):
+                            results[idx] = {'Completed': responses[last][0]['NumberOfCompletedSuboperations'].value,
+                                            'Failed': responses[last][0]['NumberOfFailedSuboperations'].value,
+                                            'Warning': responses[last][0]['NumberOfWarningSuboperations'].value}
                     except RuntimeError:
                         app_logger.debug(f"DicomInterface - get_datasets: Association with {device['ae_title']}@{device['address']}:{device['port']} is not stablished")
-                        results.append({'Completed': None, 'Failed': None, 'Warning': None})
+                association.release()
                         
         return results
 
-    def store_datasets(self, device: dict, datasets: List[Union[Dataset, str, Path]]) -> List[dict]:
+    def store_datasets(self, device: dict, datasets: List[Union[Dataset, str, Path]],
+                       associations: int = None) -> List[dict]:
         
         """
 
@@ -621,41 +1415,172 @@ class DicomInterface(AE):
                 · datasets: a list of pydicom.dataset.Dataset, str or pathlib.Path
                     The list of DICOM datasets to send to the peer or the file path to the
                     datasets to be sent. If a file path then the datasets will be read
-                    and decoded using :func:`~pydicom.filereader.dcmread`.
+                    and decoded using :func:`~pydicom.filereader.dcmread`. Database Instances
+                    (or other objects with filename, SOPClassUID, SOPInstanceUID, TransferSyntaxUID and
+                    dataset_offset attributes) are sent from their files with send_c_store_file.
                 · device: a dict with the following fields for the destination:
                     - ae_title: the source ae_title (str)
                     - address: ip address of the source AE (str)
                     - port: port of the source AE (int)
+                    - store_associations: optional, the default number of parallel associations (int)
+                · associations: the number of parallel associations (see iter_store_datasets).
 
-            Returns: a list with equal size as datasets. Each element is a dictionary, with the number of 
-            succesfully sent, warnings and failed operations.
+            Returns: a list with equal size as datasets. Each element is True if the dataset was succesfully
+            stored, or False otherwise.
 
         """
 
-        # Add the SOP class uids present in the datasets to the requested contexts for the association
-        contexts = []
-        new_uids = set([ds.SOPClassUID for ds in datasets])
-        for uid in new_uids:
-            contexts.append(build_context(uid))
+        results = [False] * len(datasets)
+        try:
+            for idx, result in self.iter_store_datasets(device, datasets, associations = associations):
+                results[idx] = result
+        except RuntimeError:
+            app_logger.debug(f"DicomInterface - store_datasets: Association with {device['ae_title']}@{device['address']}:{device['port']} could not be established")
+                
+        return results
 
-        # Create association
-        association = self.associate(device['address'], device['port'], contexts, device['ae_title'])     
-        
-        # Send the C-STORE
-        results = []      
-        
-        for dataset in datasets:
+    def iter_store_datasets(self, device: dict, datasets: List[Union[Dataset, str, Path]], contexts: List = None,
+                            associations: int = None) -> Iterator[Tuple[int, bool]]:
+
+        """
+
+            Sends the datasets to a remote device over several associations in parallel, so that the throughput
+            over high latency links is not bounded by the round trip time of each C-STORE.
+
+            Each association is taken from the pool and runs in its own thread, sending the next dataset that
+            has not been sent yet (so the datasets are partitioned dynamically among the associations). At most
+            one result per association is kept waiting for the caller: if the iterator is not advanced (e.g. a
+            paused task), the associations stop sending. Closing the iterator stops them.
+
+            If contexts is None, the requested contexts are built with store_contexts from the contexts that
+            the device accepted before (see ContextCache). The datasets whose SOP class the device rejected
+            fail without opening an association, and if more than MAX_CONTEXTS contexts are needed, the
+            datasets are sent in several rounds of associations, each one for a group of SOP classes.
+
+            Args:
+                · device, datasets: see store_datasets.
+                · contexts: the requested presentation contexts. If None, they are built with store_contexts
+                (so the datasets must be pydicom Datasets or database Instances).
+                · associations: the number of parallel associations. If None, device['store_associations'] (or 1)
+                is used. It is capped by the number of datasets and by the pool size per device.
+
+            Yields: (index of the dataset, True if it was succesfully stored), as each C-STORE completes.
+            The datasets that could not be sent because the associations were lost are yielded as failed
+            at the end of their round.
+
+            Raises:
+                RuntimeError if no association could be established.
+
+        """
+
+        if not datasets:
+            return
+
+        if contexts is None:
+            by_class = store_contexts(datasets, self.context_cache.lookup(device))
+            groups = [set(group) for group in split_contexts(by_class)]
+            batches = [([cx for uid in group for cx in by_class[uid]],
+                        [idx for idx, ds in enumerate(datasets) if ds.SOPClassUID in group]) for group in groups]
+            refused = [idx for idx, ds in enumerate(datasets) if not by_class[ds.SOPClassUID]]
+        else:
+            batches = [(contexts, list(range(len(datasets))))]
+            refused = []
+
+        # Fail fast the datasets that can't be sent
+        if refused:
+            app_logger.debug(f"DicomInterface - store_datasets: {device['ae_title']} rejected the SOP classes of {len(refused)} datasets")
+        for idx in refused:
+            yield idx, False
+
+        established = False
+        for batch_contexts, indices in batches:
             try:
-                status = association.send_c_store(dataset)
-                if status and status.Status == 0:
-                    results.append(True)
-                else:
-                    results.append(False)
+                yield from self._iter_store_batch(device, datasets, indices, batch_contexts, associations)
+                established = True
             except RuntimeError:
-                results.append(False)
-                app_logger.debug(f"DicomInterface - store_datasets: Association with {device['ae_title']}@{device['address']}:{device['port']} is not stablished")
-                
-        return results
+                if len(batches) == 1:
+                    raise
+                for idx in indices:
+                    yield idx, False
+
+        if batches and not established:
+            raise RuntimeError(f"Association with {device['ae_title']}@{device['address']}:{device['port']} could not be established")
+
+    def _iter_store_batch(self, device: dict, datasets: List, indices: List[int], contexts: List,
+                          associations: int = None) -> Iterator[Tuple[int, bool]]:
+
+        """ Sends the datasets at indices over parallel associations with contexts (see iter_store_datasets) """
+
+        associations = associations or device.get('store_associations') or 1
+        associations = max(1, min(int(associations), len(indices), self.pool.max_size))
+
+        pending = Queue()
+        for idx in indices:
+            pending.put(idx)
+        results = Queue()
+        slots = threading.Semaphore(associations)
+        stop = threading.Event()
+        established = [0]
+        lock = threading.Lock()
+
+        def sender():
+
+            try:
+                association = self.get_association(device, contexts)
+            except RuntimeError:
+                results.put(None)
+                return
+            with lock:
+                established[0] += 1
+            try:
+                while not stop.is_set() and association.is_established:
+                    if not slots.acquire(timeout = 0.5):
+                        continue
+                    try:
+                        idx = pending.get_nowait()
+                    except Empty:
+                        slots.release()
+                        break
+                    dataset = datasets[idx]
+                    try:
+                        if isinstance(dataset, (Dataset, str, Path)):
+                            status = association.send_c_store(dataset)
+                        else:
+                            status = send_c_store_file(association, dataset.filename, dataset.SOPClassUID,
+                                                       dataset.SOPInstanceUID, getattr(dataset, 'TransferSyntaxUID', None),
+                                                       getattr(dataset, 'dataset_offset', None))
+                        result = bool(status) and status.Status == 0
+                    except Exception as e:
+                        # Any error fails the dataset: the sender must keep yielding results (and release its slot)
+                        app_logger.debug(f"DicomInterface - store_datasets: dataset {idx} could not be sent to {device['ae_title']}: {repr(e)}")
+                        result = False
+                    results.put((idx, result))
+            finally:
+                self.release_association(association)
+                results.put(None)
+
+        threads = [threading.Thread(target = sender, daemon = True, name = f"StoreSCU-{device['ae_title']}-{n}")
+                   for n in range(associations)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            running = len(threads)
+            while running:
+                item = results.get()
+                if item is None:
+                    running -= 1
+                    continue
+                slots.release()
+                yield item
+
+            if not established[0]:
+                raise RuntimeError(f"Association with {device['ae_title']}@{device['address']}:{device['port']} could not be established")
+            # Datasets left behind by lost associations
+            while not pending.empty():
+                yield pending.get_nowait(), False
+        finally:
+            stop.set()
 
     def get_studies(self, device: dict, search_criteria: Union[dict, Dataset] = None,
         store_handler: Callable = None):
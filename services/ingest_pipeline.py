@@ -0,0 +1,212 @@
+import os, logging, threading
+from queue import Queue
+from collections import OrderedDict
+from typing import Callable, List
+
+logger = logging.getLogger('__main__')
+
+def write_file(filepath: str, write: Callable, fsync: bool = False) -> None:
+
+    """
+
+        Writes a file atomically: the data is written to a temporary file in the same directory, which is
+        then renamed to filepath. A crash during the write leaves a *.tmp file behind instead of a
+        truncated file at filepath.
+
+        Args:
+            · filepath: the path of the file to write.
+            · write: a function that writes the data to a file-like object.
+            · fsync: if True, the file is flushed to disk before the rename, and the directory after it.
+
+    """
+
+    tmp_filepath = f'{filepath}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_filepath, 'wb') as f:
+            write(f)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_filepath, filepath)
+    except Exception:
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+        raise
+
+    if fsync:
+        sync_directory(os.path.dirname(filepath))
+
+def sync_directory(path: str) -> None:
+
+    """ Flushes a directory entry to disk (only possible in posix systems) """
+
+    if os.name != 'posix':
+        return
+    fd = os.open(path or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def sync_files(filepaths: List[str]) -> None:
+
+    """
+
+        Flushes a group of files, and the directories that contain them, to disk.
+
+    """
+
+    for filepath in filepaths:
+        fd = os.open(filepath, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    for path in set(os.path.dirname(filepath) for filepath in filepaths):
+        sync_directory(path)
+
+class DirectoryCache():
+
+    """
+
+    Bounded LRU set of the directories already created by the ingest path, so that os.makedirs is
+    called once per series instead of once per instance.
+
+    Directories may be removed from disk after they were cached (e.g. when a study is deleted). Callers
+    should discard the entry and call makedirs again if writing to a cached directory fails.
+
+    """
+
+    def __init__(self, maxsize: int = 10000):
+
+        self.maxsize = maxsize
+        self.dirs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def makedirs(self, path: str) -> None:
+
+        with self.lock:
+            if path in self.dirs:
+                self.dirs.move_to_end(path)
+                return
+        os.makedirs(path, exist_ok = True)
+        with self.lock:
+            self.dirs[path] = None
+            if len(self.dirs) > self.maxsize:
+                self.dirs.popitem(last = False)
+
+    def discard(self, path: str) -> None:
+
+        with self.lock:
+            self.dirs.pop(path, None)
+
+class IngestPipeline():
+
+    """
+
+    Decouples the network side of the Store SCP from the disk and database writes. The store handler
+    submits a job for each received instance, and a pool of writer threads runs them.
+
+    · Each writer thread has its own lane (a queue). Jobs are assigned to a lane by a key (e.g. the
+    association), so jobs with the same key run in the order they were submitted.
+    · The number of jobs waiting or running is bounded by queue_size. When the pipeline is full, submit
+    returns False so that the store handler can answer with 0xA700 (out of resources).
+    · If workers is 0, or the pipeline has not been started, jobs run in the caller thread.
+
+    """
+
+    def __init__(self, workers: int = 4, queue_size: int = 1000):
+
+        self.workers = workers
+        self.queue_size = queue_size
+        self.lanes = []
+        self.threads = []
+
+        # Number of jobs waiting or running, and jobs rejected because the pipeline was full
+        self.queued = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+
+        if self.threads or not self.workers:
+            return
+
+        for idx in range(self.workers):
+            lane = Queue()
+            thread = threading.Thread(target = self._main, args = (lane,), daemon = True, name = f'IngestWorker-{idx}')
+            self.lanes.append(lane)
+            self.threads.append(thread)
+            thread.start()
+        logger.info(f'ingest pipeline started (workers: {self.workers}, queue size: {self.queue_size})')
+
+    def stop(self):
+
+        """
+
+            Stops the writer threads after the jobs already submitted are finished.
+
+        """
+
+        for lane in self.lanes:
+            lane.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.lanes = []
+        self.threads = []
+
+    def submit(self, key, job: Callable, *args, force: bool = False) -> bool:
+
+        """
+
+            Submits a job (job(*args)) to the lane selected by key. If force is True, the job is accepted
+            even if the pipeline is full (for control jobs that must not be lost, like closing a session).
+
+            Returns: False if the pipeline is full and the job was rejected, True otherwise.
+
+        """
+
+        if not self.threads:
+            job(*args)
+            return True
+
+        with self.lock:
+            if self.queued >= self.queue_size and not force:
+                self.rejected += 1
+                return False
+            self.queued += 1
+
+        self.lanes[hash(key) % len(self.lanes)].put((job, args))
+        return True
+
+    def load(self) -> float:
+
+        """ Returns the fraction of the pipeline that is in use (0 to 1) """
+
+        with self.lock:
+            return self.queued / self.queue_size if self.threads and self.queue_size else 0
+
+    def get_stats(self) -> dict:
+
+        with self.lock:
+            return {
+                'workers': len(self.threads),
+                'queue_size': self.queue_size,
+                'queued': self.queued,
+                'rejected': self.rejected,
+            }
+
+    def _main(self, lane: Queue):
+
+        while True:
+            item = lane.get()
+            if item is None:
+                break
+            job, args = item
+            try:
+                job(*args)
+            except Exception as e:
+                logger.error(f'ingest job failed: {repr(e)}')
+            finally:
+                with self.lock:
+                    self.queued -= 1
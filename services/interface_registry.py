@@ -0,0 +1,64 @@
+import os, logging, threading
+from app_pkg import application
+from app_pkg.db_models import Device
+from services.dicom_interface import DicomInterface
+
+logger = logging.getLogger('__main__')
+
+class InterfaceRegistry():
+
+    """
+
+    Process-wide DicomInterface for the SCU operations (queries, retrieves, sends, echoes) of the routes,
+    the task handlers and the storage check.
+
+    The interface is built on first use with the AE title and address of the local device, and reused
+    until reset is called (e.g. when the local device configuration changes), so that requests don't
+    pay for building an AE and looking up the local device in the database.
+
+    """
+
+    def __init__(self):
+
+        self.interface = None
+        self.lock = threading.Lock()
+        self.builds = 0
+
+    def get(self) -> DicomInterface:
+
+        interface = self.interface
+        if interface is not None:
+            return interface
+
+        with self.lock:
+            if self.interface is None:
+                self.interface = self._build()
+            return self.interface
+
+    def reset(self) -> None:
+
+        """ Discards the current interface: the next call to get builds a new one """
+
+        with self.lock:
+            self.interface = None
+
+    def _build(self) -> DicomInterface:
+
+        ae_title = os.environ.get('DEFAULT_STORE_SCP_AET', 'DicomWeb')
+        address = os.environ.get('DEFAULT_STORE_SCP_ADDRESS', '0.0.0.0')
+        with application.app_context():
+            local = Device.query.get('__local_store_SCP__')
+            if local:
+                ae_title, address = local.ae_title, local.address
+
+        self.builds += 1
+        logger.debug(f'shared DICOM interface built for {ae_title}@{address}')
+
+        return DicomInterface(ae_title = ae_title, address = address,
+                              acse_timeout = int(os.environ.get('DICOM_ACSE_TIMEOUT', 30)),
+                              dimse_timeout = int(os.environ.get('DICOM_DIMSE_TIMEOUT', 120)),
+                              network_timeout = int(os.environ.get('DICOM_NETWORK_TIMEOUT', 120)),
+                              connection_timeout = float(os.environ.get('DICOM_CONNECTION_TIMEOUT', 10)))
+
+# Shared by the whole application
+shared_interface = InterfaceRegistry()
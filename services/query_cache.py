@@ -0,0 +1,210 @@
+import os, logging, threading
+from io import BytesIO
+from time import time
+from collections import OrderedDict
+from typing import List, Union
+from pydicom.dataset import Dataset
+from pynetdicom.dsutils import encode, decode
+
+logger = logging.getLogger('__main__')
+
+class QueryCache():
+
+    """
+
+    Responses of the C-FIND queries to each device, shared by all the DicomInterfaces of the process
+    (see query_cache), so that repeated queries (e.g. expanding the same study again, or the storage
+    check repeating the same dates) are answered without querying the device.
+
+    · Entries are keyed by device (ae_title, address, port) and query dataset. The query is normalized by
+    encoding it, so that the same query built in different ways (e.g. a dict or a Dataset, different
+    value types) has the same key.
+    · Only the queries that completed are cached. The responses are kept encoded, so each hit returns
+    new Datasets that the caller can modify, and the size of the cache is known exactly.
+    · Entries expire ttl seconds after the query. The ttl of a device can be set with its query_cache_ttl
+    (0 disables the cache for the device). When the cache grows over max_bytes, the least recently used
+    entries are evicted.
+    · The entries of a device are invalidated when its content changes (e.g. when a C-MOVE into it completes)
+    or when its configuration changes.
+
+    """
+
+    def __init__(self, ttl: float = 0, max_bytes: int = 32 * 2**20):
+
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        # (device, encoded query) -> {'time', 'ttl', 'responses': [encoded responses], 'size'}
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def device_ttl(self, device: dict) -> float:
+
+        """ The ttl of the entries of a device (the default ttl if the device doesn't set it) """
+
+        ttl = device.get('query_cache_ttl')
+        return self.ttl if ttl is None else ttl
+
+    def lookup(self, device: dict, query: Dataset) -> List[Dataset]:
+
+        """
+
+            Returns the responses of the device to the query, or None if it is not cached (or the cache is
+            disabled for the device).
+
+        """
+
+        if not self.device_ttl(device):
+            return None
+        key = self._key(device, query)
+        with self.lock:
+            entry = self.entries.get(key) if key else None
+            if entry is not None and time() - entry['time'] > entry['ttl']:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            responses = list(entry['responses'])
+
+        return [decode(BytesIO(response), True, True) for response in responses]
+
+    def recorder(self, device: dict, query: Dataset) -> 'QueryRecorder':
+
+        """ Returns a QueryRecorder for a query to a device, or None if the cache is disabled for the device """
+
+        return QueryRecorder(self, device, query) if self.device_ttl(device) else None
+
+    def store(self, device: dict, query: Dataset, responses: List[bytes]) -> None:
+
+        """ Caches the encoded responses of the device to the query (see QueryRecorder) """
+
+        ttl = self.device_ttl(device)
+        key = self._key(device, query)
+        if not ttl or not key or responses is None:
+            return
+        with self.lock:
+            self._remove(key)
+            entry = {'time': time(), 'ttl': ttl, 'responses': responses, 'size': len(key[1]) + sum(len(r) for r in responses)}
+            self.entries[key] = entry
+            self.size += entry['size']
+            # Evict the least recently used entries
+            while self.size > self.max_bytes and self.entries:
+                self._remove(next(iter(self.entries)))
+                self.evicted += 1
+
+    def invalidate(self, device: dict = None, ae_title: str = None) -> None:
+
+        """
+
+            Discards the entries of a device, or of every device with an AE title (e.g. the destination of a
+            C-MOVE). If both are None, all the entries are discarded.
+
+        """
+
+        with self.lock:
+            if device is not None:
+                target = self._target(device)
+                keys = [key for key in self.entries if key[0] == target]
+            elif ae_title is not None:
+                keys = [key for key in self.entries if key[0][0] == ae_title]
+            else:
+                keys = list(self.entries)
+            for key in keys:
+                self._remove(key)
+
+        if keys:
+            logger.debug(f'query cache: {len(keys)} entries invalidated')
+
+    def get_stats(self) -> dict:
+
+        with self.lock:
+            devices = {}
+            for key, entry in self.entries.items():
+                name = '{}@{}:{}'.format(*key[0])
+                stats = devices.setdefault(name, {'entries': 0, 'bytes': 0})
+                stats['entries'] += 1
+                stats['bytes'] += entry['size']
+
+            return {
+                'ttl': self.ttl,
+                'max_bytes': self.max_bytes,
+                'bytes': self.size,
+                'entries': len(self.entries),
+                'devices': devices,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evicted': self.evicted,
+            }
+
+    def _key(self, device: dict, query: Union[Dataset, dict]) -> tuple:
+
+        """ The key of a query to a device (None if the query can't be encoded) """
+
+        ds = Dataset()
+        ds.update(query)
+        try:
+            encoded = encode(ds, True, True)
+        except Exception:
+            encoded = None
+
+        return (self._target(device), encoded) if encoded is not None else None
+
+    def _remove(self, key: tuple) -> None:
+
+        """ Removes an entry, if it exists (called with the lock held) """
+
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry['size']
+
+    def _target(self, device: dict) -> tuple:
+
+        return (device['ae_title'], device['address'], int(device['port']))
+
+class QueryRecorder():
+
+    """
+
+    Keeps the responses of a query, encoded, while they are received, so that they are cached if the query
+    completes. If they grow over the size of the cache, they are dropped (they can't be cached).
+
+    """
+
+    def __init__(self, cache: QueryCache, device: dict, query: Dataset):
+
+        self.cache = cache
+        self.device = device
+        self.query = query
+        self.responses = []
+        self.size = 0
+
+    def add(self, response: Dataset) -> None:
+
+        if self.responses is None:
+            return
+        try:
+            encoded = encode(response, True, True)
+        except Exception:
+            encoded = None
+        if encoded is None or self.size + len(encoded) > self.cache.max_bytes:
+            self.responses = None
+            return
+        self.responses.append(encoded)
+        self.size += len(encoded)
+
+    def commit(self) -> None:
+
+        """ Caches the responses (called when the query completes) """
+
+        if self.responses is not None:
+            self.cache.store(self.device, self.query, self.responses)
+
+# C-FIND responses shared by the whole application
+query_cache = QueryCache(ttl = float(os.environ.get('QUERY_CACHE_TTL', 0)),
+                         max_bytes = int(os.environ.get('QUERY_CACHE_MAX_BYTES', 32 * 2**20)))
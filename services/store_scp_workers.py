@@ -0,0 +1,203 @@
+import logging, threading
+from time import time
+import multiprocessing as mp
+from queue import Empty
+from services.dicom_interface import DicomInterface
+
+logger = logging.getLogger('__main__')
+
+def store_scp_worker(index: int, ae_title: str, address: str, port: int, stop_event, status, conn) -> None:
+
+    """
+
+        Runs a Store SCP in a worker process, with its own ingest path (pipeline, sessions and writer)
+        into the shared database, until stop_event is set.
+
+        The hierarchy cache is disabled and the instance index is not loaded: the rows may be deleted
+        by another process (the web application), so they are always looked up in the database. The
+        ingest writer keeps the records it can't commit in the dead letter file of the worker (see
+        worker_dead_letter), so that the workers don't overwrite each other's.
+
+        Args:
+            · index: the number of the worker (0 to processes - 1), the same each time the SCP starts.
+            · ae_title, address, port: the Store SCP configuration.
+            · stop_event: a multiprocessing Event that stops the worker.
+            · status: a multiprocessing Queue where the worker puts None when it is listening, or
+            the repr of the exception if it couldn't start.
+            · conn: a multiprocessing Connection where the worker answers each request (an id) with the id and
+            its association stats (see DicomInterface.get_association_stats).
+
+    """
+
+    from app_pkg import application, db
+    from services.db_store_handler import (setup_store_scp, ingest_writer, ingest_sessions, ingest_pipeline, hierarchy_cache,
+                                          worker_dead_letter)
+
+    # Don't reuse the database connections inherited from the fork server
+    with application.app_context():
+        db.engine.dispose(close = False)
+    # The hierarchy cache could point to rows deleted by another process
+    hierarchy_cache.maxsize = 0
+    logger.info('store SCP worker: hierarchy cache disabled, the hierarchy rows are looked up in the database')
+    ingest_writer.dead_letter = worker_dead_letter(index)
+    scp = DicomInterface(ae_title = ae_title, address = address, port = port)
+    setup_store_scp(scp)
+    scp.reuse_port = True
+
+    try:
+        ingest_writer.start()
+        ingest_sessions.start()
+        ingest_pipeline.start()
+        scp.start_store_scp()
+    except Exception as e:
+        status.put(repr(e))
+    else:
+        status.put(None)
+        while not stop_event.is_set():
+            if conn.poll(0.5):
+                request_id = conn.recv()
+                conn.send((request_id, scp.get_association_stats()))
+    finally:
+        scp.stop_store_scp()
+        ingest_pipeline.stop()
+        ingest_sessions.stop()
+        ingest_writer.stop()
+
+class MultiProcessStoreSCP(DicomInterface):
+
+    """
+
+    DicomInterface whose Store SCP runs in several worker processes listening on the same port with
+    SO_REUSEPORT (see store_scp_worker), so that associations from several modalities are decoded and
+    written in parallel, without sharing the GIL with the web application.
+
+    The rest of the DicomInterface (e.g. echo, queries) runs in the calling process. The admission limits
+    are applied by each worker process (e.g. max_associations is per process), and get_association_stats
+    adds up the stats of the workers. The hierarchy cache of the ingest path (see HierarchyCache) is
+    disabled in the workers.
+
+    """
+
+    def __init__(self, processes: int = 2, start_timeout: float = 60, *args, **kwargs):
+
+        """
+
+        Args:
+            · processes: number of Store SCP worker processes.
+            · start_timeout: seconds to wait for the workers to start listening.
+
+        Other arguments are passed to DicomInterface.
+
+        """
+
+        super().__init__(*args, **kwargs)
+        self.processes = processes
+        self.start_timeout = start_timeout
+        self.workers = []
+        self.connections = []
+        self.connections_lock = threading.Lock()
+        # Id of the last stats request sent to the workers
+        self.request_id = 0
+
+    def start_store_scp(self) -> None:
+
+        """
+
+            Starts the worker processes and waits until all of them are listening.
+
+            Raises:
+                ValueError if the port is not set, or RuntimeError if a worker couldn't start (the other
+                workers are stopped).
+
+        """
+
+        if not self.port:
+            logger.error("Listening port must be specified before starting the StoreSCP. Set it to a int in the port attribute.")
+            raise(ValueError('Listening port must be specified before starting the StoreSCP. Set it to a int in the port attribute.'))
+
+        # The workers are forked from a server process that has already imported the application
+        # (services can't be imported before app_pkg)
+        ctx = mp.get_context('forkserver')
+        ctx.set_forkserver_preload(['app_pkg'])
+        self.stop_event = ctx.Event()
+        status = ctx.Queue()
+        pipes = [ctx.Pipe() for _ in range(self.processes)]
+        self.connections = [parent_conn for parent_conn, _ in pipes]
+        self.workers = [ctx.Process(target = store_scp_worker, daemon = True, name = f'StoreSCP-{idx}',
+                                    args = (idx, self.ae_title, self.address, int(self.port), self.stop_event, status, child_conn))
+                        for idx, (_, child_conn) in enumerate(pipes)]
+        for worker in self.workers:
+            worker.start()
+
+        errors = []
+        for _ in self.workers:
+            try:
+                error = status.get(timeout = self.start_timeout)
+            except Empty:
+                error = 'timeout'
+            if error is not None:
+                errors.append(error)
+        if errors:
+            self.stop_store_scp()
+            logger.error(f'store SCP workers could not be started: {errors}')
+            raise RuntimeError(f'store SCP workers could not be started: {errors}')
+
+        self.store_scp_active = True
+        logger.info(f'Starting store SCP listener {self.ae_title.strip()}@{self.address}:{self.port} in {self.processes} processes')
+
+    def stop_store_scp(self) -> None:
+
+        """ Stops the worker processes """
+
+        if self.workers:
+            self.stop_event.set()
+            for worker in self.workers:
+                worker.join(timeout = 30)
+                if worker.is_alive():
+                    logger.error(f'{worker.name} did not stop, terminating it')
+                    worker.terminate()
+        self.workers = []
+        self.connections = []
+        self.store_scp_active = False
+        logger.debug("Store SCP stopped")
+
+    def get_association_stats(self) -> dict:
+
+        """ Adds up the association stats of the worker processes """
+
+        stats = {'active': 0, 'active_by_ae': {}, 'accepted': 0, 'rejected': {}, 'rejected_by_ae': {},
+                 'processes': 0, 'queue_load': []}
+        with self.connections_lock:
+            self.request_id += 1
+            for conn in self.connections:
+                # Late replies to previous requests (after their timeout) are discarded
+                worker_stats = None
+                deadline = time() + 5
+                try:
+                    conn.send(self.request_id)
+                    while conn.poll(max(0, deadline - time())):
+                        request_id, reply = conn.recv()
+                        if request_id == self.request_id:
+                            worker_stats = reply
+                            break
+                except (OSError, EOFError):
+                    continue
+                if worker_stats is None:
+                    continue
+                stats['processes'] += 1
+                stats['active'] += worker_stats['active']
+                stats['accepted'] += worker_stats['accepted']
+                for key in ['active_by_ae', 'rejected', 'rejected_by_ae']:
+                    for name, count in worker_stats[key].items():
+                        stats[key][name] = stats[key].get(name, 0) + count
+                stats['limits'] = worker_stats['limits']
+                stats['queue_load'].append(worker_stats['queue_load'])
+
+        return stats
+
+    def get_stats(self) -> dict:
+
+        return {
+            'processes': self.processes,
+            'alive': [worker.pid for worker in self.workers if worker.is_alive()],
+        }
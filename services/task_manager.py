@@ -6,12 +6,12 @@ import threading, logging, json
 import pandas as pd
 from numpy import argmax
 from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelMove
-from pynetdicom import build_context
 from pydicom.dataset import Dataset
 
 from app_pkg import application
 from app_pkg.db_models import Device, Study, Series
 from services.dicom_interface import DicomInterface
+from services.interface_registry import shared_interface
 
 logger = logging.getLogger('__main__')
 
@@ -48,15 +48,17 @@ class DeviceTasksHandler():
         self.tasks_list = {}
         self.task_modifiers = Queue()
 
-        # Initialize DICOM interface
-        with application.app_context():
-            self.ae = DicomInterface(ae_title = Device.query.get('__local_store_SCP__').ae_title)
-        
         # Initialize the current task id to None
         self.current_task_id = None
         
         self.start()
 
+    @property
+    def ae(self) -> DicomInterface:
+
+        # The DICOM interface shared by the application
+        return shared_interface.get()
+
     def start(self):
 
         # Set an event to stop the thread later 
@@ -142,7 +144,11 @@ class DeviceTasksHandler():
 
         elif action == 'delete':
             if 'association' in self.tasks_list[id]:
-                self.tasks_list[id]['association'].release()
+                # The task may be in the middle of an operation: don't reuse the association
+                self.ae.release_association(self.tasks_list[id]['association'], discard = True)
+            if 'step' in self.tasks_list[id]:
+                # Stop the operations started by the task (e.g. the associations of a SEND)
+                self.tasks_list[id]['step'].close()
             self.tasks_list.pop(id)
             logger.debug(f"_modify_task - Delete task with id {id}")
             #logger.debug(f"_modify_task - Tasks status: {[(id, task['status'], task['priority']) for id,task in self.tasks_list.items()]}")
@@ -192,18 +198,20 @@ class DeviceTasksHandler():
             current_task['progress'] = progress
         except ValueError as e:
             # Set task as completed
-            self.tasks_list[task_id]['association'].release()
+            if 'association' in self.tasks_list[task_id]:
+                self.ae.release_association(self.tasks_list[task_id]['association'])
             logger.debug(f"_task_step - value error")
             logger.debug(repr(e))
             self.manage_task(task_id, action = 'complete')
         except StopIteration as e:
-            self.tasks_list[task_id]['association'].release()
+            if 'association' in self.tasks_list[task_id]:
+                self.ae.release_association(self.tasks_list[task_id]['association'])
             logger.debug(f"_task_step - stop iteration")
             self.manage_task(task_id, action = 'complete')        
         except RuntimeError as e:
             # Set task as failed
             if 'association' in self.tasks_list[task_id]:
-                self.tasks_list[task_id]['association'].release()
+                self.ae.release_association(self.tasks_list[task_id]['association'], discard = True)
             logger.debug(f"_task_step - runtime error")
             logger.debug(repr(e))
             self.manage_task(task_id, action = 'fail')
@@ -249,7 +257,7 @@ class DeviceTasksHandler():
             # Get the number of imgs to move
             imgs = task_data['ImgsStudy'] if task_data['level'] == 'STUDY' else task_data['ImgsSeries']
 
-            # Create a new DICOM association to perform the C-MOVE
+            # Take a DICOM association from the pool to perform the C-MOVE
             source = {attr:getattr(device, attr) for attr in ["ae_title","port","address"]}
             association = self.ae.get_association(source)
             self.tasks_list[task_id]['association'] = association
@@ -262,28 +270,32 @@ class DeviceTasksHandler():
 
             c_move_responses = association.send_c_move(ds, move_aet = destination, query_model = StudyRootQueryRetrieveInformationModelMove)
 
-            while True:
-                try:
-                    rsp = next(c_move_responses)
-                except StopIteration:
-                    # I raise ValueError because exception is taken as RuntimeError insted of StopIteration when I raise StopIteration                                                            
-                    raise ValueError                    
-                if not bool(rsp[0]):
-                    # An empty response indicates a failure state. Raise RuntimeError
-                    raise RuntimeError                
-                try:
-                    completed = rsp[0]['NumberOfCompletedSuboperations'].value
-                except:
-                    completed = 0                
-                progress = f"{completed} / {imgs}"
-                yield progress            
+            try:
+                while True:
+                    try:
+                        rsp = next(c_move_responses)
+                    except StopIteration:
+                        # I raise ValueError because exception is taken as RuntimeError insted of StopIteration when I raise StopIteration                                                            
+                        raise ValueError                    
+                    if not bool(rsp[0]):
+                        # An empty response indicates a failure state. Raise RuntimeError
+                        raise RuntimeError                
+                    try:
+                        completed = rsp[0]['NumberOfCompletedSuboperations'].value
+                    except:
+                        completed = 0                
+                    progress = f"{completed} / {imgs}"
+                    yield progress            
+            finally:
+                # The cached queries to the destination don't include the moved instances
+                self.ae.query_cache.invalidate(ae_title = destination)
         
         elif task_data['type'] == 'SEND':
             
             dest = task_data['destination']
             with application.app_context():
                 device = Device.query.get(dest)
-                destination = {attr:getattr(device, attr) for attr in ["ae_title","port","address"]}
+                destination = {attr:getattr(device, attr) for attr in ["ae_title","port","address","store_associations"]}
                 
             # Get the dicom instances to send
             items = task_data['datasets']
@@ -297,22 +309,23 @@ class DeviceTasksHandler():
                     instances = element.instances.all()
                     datasets.extend(instances)
             
-            contexts = []
-            new_uids = set([ds.SOPClassUID for ds in datasets])
-            for uid in new_uids:
-                contexts.append(build_context(uid))
-            
-            # Create association
-            association = self.ae.associate(destination['address'], destination['port'], contexts, destination['ae_title'])  
-            self.tasks_list[task_id]['association'] = association
-
-            for idx, ds in enumerate(datasets):
-                try:
-                    status = association.send_c_store(ds.filename)
-                except (ValueError, AttributeError):
-                    raise RuntimeError
-                progress = f"{idx + 1} / {len(datasets)}"
-                yield progress
+            # Send the instances over the parallel associations configured for the destination (the task
+            # can override it). The files are streamed without decoding them when their transfer syntax is
+            # accepted (see send_c_store_file). The progress counts the stored instances only: the task is
+            # completed with a partial progress if some of them failed, and fails if all of them failed
+            results = self.ae.iter_store_datasets(destination, datasets, associations = task_data.get('associations'))
+            try:
+                stored = 0
+                for _, result in results:
+                    stored += result
+                    progress = f"{stored} / {len(datasets)}"
+                    yield progress
+                if datasets and not stored:
+                    raise RuntimeError(f"None of the {len(datasets)} instances could be stored in {destination['ae_title']}")
+            finally:
+                results.close()
+                # The cached queries to the destination don't include the sent instances
+                self.ae.query_cache.invalidate(destination)
 
         elif task_data['type'] == 'GET':
 
@@ -421,7 +434,7 @@ class CheckStorageManager():
         self.status = 'Desocupado'
 
 
-    def find_missing_series(self, device_name, studydate):
+    def find_missing_series(self, device_name, studydate, date_chunks = None):
 
         with application.app_context():
             if 'CLOUDPACS' in device_name:
@@ -431,8 +444,8 @@ class CheckStorageManager():
                 source = Device.query.get(device_name)
                 target = Device.query.get('PACS')
 
-        device = {attr:getattr(source, attr) for attr in ["ae_title","port","address","imgs_study","imgs_series"]}
-        pacs = {attr:getattr(target, attr) for attr in ["ae_title","port","address","imgs_study","imgs_series"]}
+        device = {attr:getattr(source, attr) for attr in ["ae_title","port","address","imgs_study","imgs_series","query_cache_ttl"]}
+        pacs = {attr:getattr(target, attr) for attr in ["ae_title","port","address","imgs_study","imgs_series","query_cache_ttl"]}
 
         # Build the data for the dicom query
         qr = {'StudyDate':  studydate}        
@@ -442,15 +455,16 @@ class CheckStorageManager():
             'StudyDescription': '',
             device["imgs_study"]: ''}
         
-        # Start a DICOM AE to perform C-FIND operations on the device
-        with application.app_context():
-            ae = DicomInterface(ae_title = Device.query.get('__local_store_SCP__').ae_title, 
-                        address = Device.query.get('__local_store_SCP__').address,
-                        acse_timeout=120)          
+        # Use the shared DICOM interface to perform C-FIND operations on the device
+        ae = shared_interface.get()
+
+        # Fail fast if a device is down (AssociationError), instead of reporting every series as missing
+        for d in [device, pacs]:
+            ae.release_association(ae.get_association(d))
 
         # Query studies and series in the target device
         self.status = f'Buscando estudios en {source.name}...'
-        studies = ae.query_studies_in_device(device, qr, rs)
+        studies = ae.query_studies_in_device(device, qr, rs, date_chunks = date_chunks)
 
         # Get series for each study
         rs = {'SeriesNumber':'',
@@ -478,19 +492,10 @@ class CheckStorageManager():
                     setattr(series, field, value)
             series_in_device.extend(series_rsp)
         
-        # Release connection with the device
-        ae.release_connections()
-
         # Apply filters
         ignored_series = list(filter(lambda x: not self.series_filter(x, device_name), series_in_device))
         series_filtered = list(filter(lambda x: self.series_filter(x, device_name), series_in_device))
         
-        # PACS connection
-        with application.app_context():
-            ae_pacs = DicomInterface(ae_title = Device.query.get('__local_store_SCP__').ae_title, 
-                        address = Device.query.get('__local_store_SCP__').address,
-                        acse_timeout=120) 
-        
         # Check if each series exists in PACS with the same number of images
         self.status = f'Buscando series en {target.name}...' 
         missing_series = []
@@ -503,7 +508,7 @@ class CheckStorageManager():
                 'SeriesInstanceUID': series.SeriesInstanceUID,
                 'QueryRetrieveLevel':'SERIES',
                 pacs['imgs_series']: ''}
-            series_in_pacs = ae_pacs.query_device(pacs, qr)
+            series_in_pacs = ae.query_device(pacs, qr)
 
             try:
                 series_in_pacs = series_in_pacs[0]
@@ -512,8 +517,6 @@ class CheckStorageManager():
                 archived_series.append(series)
             except Exception as e:
                 missing_series.append(series)
-        
-        ae_pacs.release_connections()
 
         # Reset status
         self.status = 'Desocupado'
@@ -0,0 +1,221 @@
+"""
+
+    The tests run in a temporary directory (also the working directory, for the logs and the other relative
+    paths), with a temporary SQLite database and log file (like the benchmarks). The SCPs they talk to are
+    pynetdicom servers started on free ports of localhost.
+
+    Usage (from the repository root):
+        python -m pytest -q
+
+"""
+
+import os, sys, socket, tempfile
+from functools import partial
+from time import time, sleep
+from datetime import datetime
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix = 'dicomweb-tests-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(WORKDIR, 'tests.db')
+os.environ['LOGGING_FILE'] = os.path.join(WORKDIR, 'output.log')
+sys.path.insert(0, REPO_DIR)
+os.chdir(WORKDIR)
+
+import pytest
+# app_pkg must be imported before services
+import app_pkg
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian
+from pynetdicom import AE, evt
+from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelFind, Verification, CTImageStorage
+from services.dicom_interface import DicomInterface
+from services.db_store_handler import (hierarchy_cache, instance_index, ingest_writer, ingest_sessions, ingest_pipeline,
+                                      setup_store_scp, store_handler)
+from app_pkg import application, db
+from app_pkg.db_models import Instance
+
+def free_port() -> int:
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+@pytest.fixture
+def find_scp():
+
+    """
+
+        Starts C-FIND SCPs with AE title 'REMOTE'. The fixture is a function that takes the C-FIND handler
+        and returns the device dict (with a query cache ttl) of the new SCP. The SCPs are stopped after the test.
+
+    """
+
+    servers = []
+
+    def start(on_find) -> dict:
+        ae = AE(ae_title = 'REMOTE')
+        ae.add_supported_context(StudyRootQueryRetrieveInformationModelFind)
+        ae.add_supported_context(Verification)
+        port = free_port()
+        servers.append(ae.start_server(('127.0.0.1', port), block = False, evt_handlers = [(evt.EVT_C_FIND, on_find)]))
+        return {'ae_title': 'REMOTE', 'address': '127.0.0.1', 'port': port, 'query_cache_ttl': 60}
+
+    yield start
+    for server in servers:
+        server.shutdown()
+
+@pytest.fixture
+def interface():
+
+    """ A DicomInterface (SCU) with short timeouts """
+
+    ae = DicomInterface(ae_title = 'TESTS', acse_timeout = 5, dimse_timeout = 2, network_timeout = 5, connection_timeout = 2)
+    yield ae
+    ae.pool.clear()
+    ae.query_cache.invalidate()
+
+@pytest.fixture
+def database():
+
+    """ Creates the tables of the temporary database, and drops them (and the ingest caches) after the test """
+
+    with application.app_context():
+        db.create_all()
+    yield db
+    with application.app_context():
+        db.session.remove()
+        db.drop_all()
+    hierarchy_cache.clear()
+    instance_index.loaded = False
+    instance_index.uids = set()
+
+@pytest.fixture
+def store_scp(database, tmp_path, monkeypatch):
+
+    """
+
+        Starts Store SCPs with the database store handler and the ingest path (writer, sessions and pipeline).
+        The fixture is a function that takes keyword arguments for store_handler (e.g. duplicates) and
+        returns the SCP. The files are written in tmp_path/incoming.
+
+    """
+
+    monkeypatch.setattr(ingest_writer, 'dead_letter', str(tmp_path / 'dead_letter.jsonl'))
+    ingest_writer.start()
+    ingest_sessions.start()
+    ingest_pipeline.start()
+    scps = []
+
+    def start(**options) -> DicomInterface:
+        scp = DicomInterface(ae_title = 'STORESCP', address = '127.0.0.1', port = free_port())
+        setup_store_scp(scp)
+        scp.store_handler = partial(store_handler, root_dir = str(tmp_path / 'incoming'), **options)
+        scp.start_store_scp()
+        scps.append(scp)
+        return scp
+
+    yield start
+    for scp in scps:
+        scp.stop_store_scp()
+    ingest_pipeline.stop()
+    ingest_sessions.stop()
+    ingest_writer.stop()
+
+def ct(uid: str, series: str = '1.2.9.1', study: str = '1.2.9', rows: int = 8) -> Dataset:
+
+    """ A CT instance with rows x 16 pixels of 16 bits """
+
+    ds = Dataset()
+    ds.PatientID = 'P1'
+    ds.PatientName = 'Test^Patient'
+    ds.StudyInstanceUID = study
+    ds.StudyDate = ds.SeriesDate = '20240101'
+    ds.StudyTime = ds.SeriesTime = '120000'
+    ds.StudyDescription = 'Study'
+    ds.SeriesInstanceUID = series
+    ds.SeriesDescription = 'Series'
+    ds.SeriesNumber = 1
+    ds.Modality = 'CT'
+    ds.SOPClassUID = CTImageStorage
+    ds.SOPInstanceUID = uid
+    ds.Rows, ds.Columns = rows, 16
+    ds.BitsAllocated = ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.PixelData = bytes(rows * 16 * 2)
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.is_little_endian, ds.is_implicit_VR = True, False
+    return ds
+
+def send(scp: DicomInterface, datasets: list, ae_title: str = 'SCU') -> list:
+
+    """ Sends datasets to a Store SCP in one association. Returns the status of each C-STORE """
+
+    scu = AE(ae_title = ae_title)
+    scu.add_requested_context(CTImageStorage, ExplicitVRLittleEndian)
+    assoc = scu.associate('127.0.0.1', scp.port, ae_title = scp.ae_title)
+    assert assoc.is_established
+    try:
+        return [assoc.send_c_store(ds).Status for ds in datasets]
+    finally:
+        assoc.release()
+
+def committed(uids: list, timeout: float = 10) -> dict:
+
+    """ Waits until the instances are in the database. Returns their Instance rows by SOPInstanceUID """
+
+    deadline = time() + timeout
+    while True:
+        with application.app_context():
+            rows = {uid: db.session.get(Instance, uid) for uid in uids}
+            for row in rows.values():
+                if row is not None:
+                    db.session.expunge(row)
+        if all(rows.values()) or time() > deadline:
+            return rows
+        sleep(0.1)
+
+def written(timeout: float = 10) -> bool:
+
+    """ Waits until the ingest writer has committed all the instances it received """
+
+    deadline = time() + timeout
+    while ingest_writer.pending:
+        if time() > deadline:
+            return False
+        sleep(0.1)
+    return True
+
+def instance(uid: str, series: str = '1.2.9.1', study: str = '1.2.9', size: int = 100, filename: str = None) -> dict:
+
+    """ An instance record for the ingest writer (see instance_record) """
+
+    filename = filename or os.path.join('incoming', study, series, uid)
+    return {'PatientID': 'P1', 'PatientName': 'Test^Patient', 'StudyInstanceUID': study,
+            'StudyDate': datetime(2024, 1, 1, 12), 'StudyDescription': 'Study', 'study_path': os.path.dirname(os.path.dirname(filename)),
+            'SeriesInstanceUID': series, 'SeriesDate': datetime(2024, 1, 1, 12), 'SeriesDescription': 'Series',
+            'SeriesNumber': 1, 'Modality': 'CT', 'series_path': os.path.dirname(filename), 'SOPInstanceUID': uid,
+            'SOPClassUID': '1.2.840.10008.5.1.4.1.1.2', 'filename': filename, 'TransferSyntaxUID': None, 'size': size}
+
+def study(idx: int, date: str = '20240101') -> Dataset:
+
+    """ A study level C-FIND response """
+
+    ds = Dataset()
+    ds.QueryRetrieveLevel = 'STUDY'
+    ds.StudyInstanceUID = f'1.2.3.{idx}'
+    ds.StudyDate = date
+    return ds
+
+def query(date: str = '') -> Dataset:
+
+    """ A study level C-FIND query """
+
+    ds = Dataset()
+    ds.QueryRetrieveLevel = 'STUDY'
+    ds.StudyInstanceUID = ''
+    ds.StudyDate = date
+    return ds
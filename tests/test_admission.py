@@ -0,0 +1,71 @@
+from types import SimpleNamespace
+import pytest
+from pynetdicom import AE
+from pynetdicom.sop_class import Verification
+from services.dicom_interface import DicomInterface
+from conftest import free_port
+
+def admit(scp: DicomInterface, calling_aet: str = 'SCU'):
+
+    """ Asks scp to admit an association. Returns the association if it was admitted, None otherwise """
+
+    assoc = SimpleNamespace()
+    return assoc if scp.admit_association(assoc, calling_aet) else None
+
+def release(scp: DicomInterface, assoc) -> None:
+
+    scp.release_admission(SimpleNamespace(assoc = assoc))
+
+@pytest.mark.parametrize('max_associations', [None, 0])
+def test_no_limit(max_associations):
+
+    scp = DicomInterface(ae_title = 'SCP')
+    scp.max_associations = max_associations
+    assert all(admit(scp) for _ in range(50))
+    assert scp.get_association_stats()['active'] == 50
+
+def test_max_associations():
+
+    scp = DicomInterface(ae_title = 'SCP')
+    scp.max_associations = 2
+    first, second = admit(scp, 'A'), admit(scp, 'B')
+    assert first and second
+    assert admit(scp, 'C') is None
+    assert scp.rejected['max_associations'] == 1
+    release(scp, first)
+    assert admit(scp, 'C')
+
+def test_max_associations_per_ae():
+
+    scp = DicomInterface(ae_title = 'SCP')
+    scp.max_associations_per_ae = 1
+    assert admit(scp, 'A')
+    assert admit(scp, 'A') is None
+    assert admit(scp, 'B')
+    assert scp.rejected_by_ae == {'A': 1}
+
+def test_queue_load():
+
+    load = {'value': 0.5}
+    scp = DicomInterface(ae_title = 'SCP')
+    scp.queue_load = lambda: load['value']
+    assert admit(scp)
+    load['value'] = scp.max_queue_load
+    assert admit(scp) is None
+    assert scp.rejected['queue_load'] == 1
+
+def test_store_scp_rejects_over_the_limit():
+
+    scp = DicomInterface(ae_title = 'SCP', address = '127.0.0.1', port = free_port())
+    scp.max_associations = 1
+    scp.start_store_scp()
+    scu = AE(ae_title = 'SCU')
+    scu.add_requested_context(Verification)
+    try:
+        first = scu.associate('127.0.0.1', scp.port, ae_title = 'SCP')
+        assert first.is_established
+        second = scu.associate('127.0.0.1', scp.port, ae_title = 'SCP')
+        assert second.is_rejected
+        first.release()
+    finally:
+        scp.stop_store_scp()
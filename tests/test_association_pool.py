@@ -0,0 +1,26 @@
+import sys, subprocess
+from time import time
+from conftest import REPO_DIR
+
+# Takes an association from the pool, gives it back and exits with the association idle
+CHILD = """
+import sys
+sys.path.insert(0, {repo!r})
+import app_pkg
+from pynetdicom import AE
+from pynetdicom.sop_class import Verification
+from services.association_pool import association_pool
+ae = AE(ae_title = 'SCU')
+ae.add_requested_context(Verification)
+device = {{'ae_title': 'REMOTE', 'address': '127.0.0.1', 'port': {port}}}
+association_pool.release(association_pool.acquire(ae, device))
+assert association_pool.get_stats()['devices']['REMOTE@127.0.0.1:{port}']['idle'] == 1
+"""
+
+def test_idle_associations_dont_delay_the_exit(find_scp):
+
+    device = find_scp(lambda event: iter([]))
+    start = time()
+    subprocess.run([sys.executable, '-c', CHILD.format(repo = REPO_DIR, port = device['port'])], check = True, timeout = 30)
+    # The idle timeout of the pool is 60 s
+    assert time() - start < 10
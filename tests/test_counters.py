@@ -0,0 +1,44 @@
+import os
+from services.db_store_handler import IngestWriter
+from app_pkg import application
+from conftest import instance
+
+def ingest(records: list) -> None:
+
+    writer = IngestWriter(max_latency = 0.01)
+    for record in records:
+        writer.submit(record)
+    assert writer._flush(writer._next_batch())
+
+def stored(root: str, uid: str, series: str, size: int, modality: str = 'CT') -> dict:
+
+    """ An instance record whose file exists under root """
+
+    filename = os.path.join(root, '1.2.9', series, uid)
+    os.makedirs(os.path.dirname(filename), exist_ok = True)
+    open(filename, 'wb').close()
+    return dict(instance(uid, series = series, size = size, filename = filename), Modality = modality)
+
+def local_studies(client) -> list:
+
+    return client.post('/get_local_studies').json['data']
+
+def test_counters_are_kept_by_the_writer(database, tmp_path):
+
+    client = application.test_client()
+    ingest([stored(tmp_path, '1.1', 'A', 100), stored(tmp_path, '1.2', 'A', 200)])
+    ingest([stored(tmp_path, '1.3', 'A', 300), stored(tmp_path, '2.1', 'B', 50, 'MR')])
+    [data] = local_studies(client)
+    assert (data['ImgsStudy'], data['StudySize'], data['ModalitiesInStudy']) == (4, 650, 'CT/MR')
+    series = client.post('/get_local_study_data', json = {'StudyInstanceUID': '1.2.9'}).json['data']
+    assert sorted((s['Modality'], s['ImgsSeries'], s['SeriesSize']) for s in series) == [('CT', 3, 600), ('MR', 1, 50)]
+
+def test_deleting_a_series_updates_its_study(database, tmp_path):
+
+    client = application.test_client()
+    ingest([stored(tmp_path, '1.1', 'A', 100), stored(tmp_path, '2.1', 'B', 50, 'MR')])
+    response = client.post('/delete_studies', json = [{'level': 'SERIES', 'StudyInstanceUID': '1.2.9',
+                                                       'SeriesInstanceUID': 'B'}])
+    assert response.status_code == 200
+    [data] = local_studies(client)
+    assert (data['ImgsStudy'], data['StudySize'], data['ModalitiesInStudy']) == (1, 100, 'CT')
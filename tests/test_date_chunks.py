@@ -0,0 +1,32 @@
+import pytest
+from conftest import study, query
+
+def test_date_ranges_are_yielded_in_order(find_scp, interface):
+
+    def on_find(event):
+        yield 0xFF00, study(0, event.identifier.StudyDate)
+
+    device = find_scp(on_find)
+    responses = list(interface.iter_query_device_by_date(device, query('20240101-20240105'), 'day'))
+    assert [response.StudyDate for response in responses] == [f'2024010{day}' for day in range(1, 6)]
+
+def test_failed_date_range_raises(find_scp, interface):
+
+    def on_find(event):
+        if event.identifier.StudyDate == '20240103':
+            yield 0xC000, None
+            return
+        yield 0xFF00, study(0, event.identifier.StudyDate)
+
+    device = find_scp(on_find)
+    received = []
+    with pytest.raises(RuntimeError):
+        for response in interface.iter_query_device_by_date(device, query('20240101-20240105'), 'day'):
+            received.append(response.StudyDate)
+    assert received == ['20240101', '20240102']
+
+def test_unknown_date_chunk_is_rejected(interface):
+
+    device = {'ae_title': 'REMOTE', 'address': '127.0.0.1', 'port': 1}
+    with pytest.raises(ValueError):
+        list(interface.iter_query_device_by_date(device, query('20240101-20240105'), 'month'))
@@ -0,0 +1,106 @@
+import sys
+import pytest
+from pynetdicom import AE
+from pynetdicom.sop_class import Verification
+from services.device_monitor import DeviceMonitor
+from services.association_pool import AssociationError
+from conftest import free_port
+
+DEVICE = {'ae_title': 'REMOTE', 'address': '127.0.0.1', 'port': 104}
+
+@pytest.fixture
+def clock(monkeypatch):
+
+    """ Replaces the time of the device monitor with a clock that the test moves forward """
+
+    now = {'time': 1000.0}
+    # services.device_monitor is also the name of the singleton in the services package
+    monkeypatch.setattr(sys.modules['services.device_monitor'], 'time', lambda: now['time'])
+    return now
+
+def test_circuit_opens_after_the_failure_threshold(clock):
+
+    monitor = DeviceMonitor(failure_threshold = 2, retry_after = 30)
+    monitor.record_failure(DEVICE, 'no answer')
+    assert monitor.get_state(DEVICE)['state'] == 'failing'
+    assert monitor.allow(DEVICE)
+    monitor.record_failure(DEVICE, 'no answer')
+    assert monitor.get_state(DEVICE)['state'] == 'down'
+    assert not monitor.allow(DEVICE)
+    assert monitor.get_stats()['refused'] == 1
+
+def test_half_open_circuit_lets_one_trial_through(clock):
+
+    monitor = DeviceMonitor(failure_threshold = 1, retry_after = 30)
+    monitor.record_failure(DEVICE, 'no answer')
+    clock['time'] += 29
+    assert not monitor.allow(DEVICE)
+    clock['time'] += 1
+    assert monitor.allow(DEVICE)
+    assert monitor.get_state(DEVICE)['circuit'] == 'half-open'
+    # Only one trial each retry_after seconds
+    assert not monitor.allow(DEVICE)
+
+def test_failed_trial_opens_the_circuit_again(clock):
+
+    monitor = DeviceMonitor(failure_threshold = 3, retry_after = 30)
+    for _ in range(3):
+        monitor.record_failure(DEVICE, 'no answer')
+    clock['time'] += 30
+    assert monitor.allow(DEVICE)
+    monitor.record_failure(DEVICE, 'no answer')
+    assert monitor.get_state(DEVICE)['circuit'] == 'open'
+    assert not monitor.allow(DEVICE)
+
+def test_success_closes_the_circuit(clock):
+
+    monitor = DeviceMonitor(failure_threshold = 1, retry_after = 30)
+    monitor.record_failure(DEVICE, 'no answer')
+    clock['time'] += 30
+    assert monitor.allow(DEVICE)
+    monitor.record_success(DEVICE)
+    state = monitor.get_state(DEVICE)
+    assert (state['state'], state['circuit'], state['failures']) == ('up', 'closed', 0)
+    assert monitor.allow(DEVICE)
+
+def test_forget(clock):
+
+    monitor = DeviceMonitor(failure_threshold = 1)
+    monitor.record_failure(DEVICE, 'no answer')
+    monitor.forget(DEVICE)
+    assert monitor.get_state(DEVICE)['state'] == 'unknown'
+    assert monitor.allow(DEVICE)
+
+def test_rejected_association_is_not_a_failure(interface):
+
+    # A device that rejects the association (e.g. it is busy) is up
+    ae = AE(ae_title = 'REMOTE')
+    ae.add_supported_context(Verification)
+    ae.require_calling_aet = ['SOMEONE_ELSE']
+    port = free_port()
+    server = ae.start_server(('127.0.0.1', port), block = False)
+    device = {'ae_title': 'REMOTE', 'address': '127.0.0.1', 'port': port}
+    try:
+        for _ in range(interface.device_monitor.failure_threshold + 1):
+            with pytest.raises(AssociationError) as error:
+                interface.get_association(device)
+            assert error.value.rejected
+        assert interface.device_monitor.get_state(device)['state'] == 'up'
+    finally:
+        server.shutdown()
+        interface.device_monitor.forget(device)
+
+def test_no_answer_is_a_failure(interface):
+
+    device = {'ae_title': 'REMOTE', 'address': '127.0.0.1', 'port': free_port()}
+    try:
+        for _ in range(interface.device_monitor.failure_threshold):
+            with pytest.raises(AssociationError) as error:
+                interface.get_association(device)
+            assert not error.value.rejected
+        assert interface.device_monitor.get_state(device)['state'] == 'down'
+        # Refused without trying the device
+        with pytest.raises(AssociationError, match = 'is down'):
+            interface.get_association(device)
+    finally:
+        interface.device_monitor.forget(device)
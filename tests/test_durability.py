@@ -0,0 +1,67 @@
+import os
+import pytest
+from services.ingest_pipeline import write_file
+from services.db_store_handler import IngestWriter, ingest_writer, write_instance
+from conftest import instance
+
+@pytest.fixture
+def fsyncs(monkeypatch):
+
+    """ Records the paths flushed to disk with os.fsync """
+
+    paths = []
+    fsync = os.fsync
+    def record(fd):
+        paths.append(os.readlink(f'/proc/self/fd/{fd}'))
+        fsync(fd)
+    monkeypatch.setattr(os, 'fsync', record)
+    return paths
+
+def test_failed_write_leaves_the_file_untouched(tmp_path):
+
+    filepath = str(tmp_path / 'instance')
+    write_file(filepath, lambda f: f.write(b'first'))
+
+    def fail(f):
+        f.write(b'second')
+        raise OSError('no space left on device')
+
+    with pytest.raises(OSError):
+        write_file(filepath, fail)
+    assert open(filepath, 'rb').read() == b'first'
+    assert os.listdir(tmp_path) == ['instance']
+
+@pytest.mark.parametrize('durability', ['none', 'batch', 'instance'])
+def test_durability_modes(tmp_path, monkeypatch, fsyncs, durability):
+
+    submitted = []
+    monkeypatch.setattr(ingest_writer, 'submit', lambda record, reserved: submitted.append(record))
+    filepath = str(tmp_path / 'study' / 'series' / '1.1')
+    write_instance(filepath, lambda f: f.write(b'data'), instance('1.1', filename = filepath), durability)
+    # 'instance' flushes each file (before it is renamed) and its directory before the instance is
+    # queued, 'batch' leaves it to the ingest writer
+    if durability == 'instance':
+        assert fsyncs[0].startswith(filepath + '.') and fsyncs[0].endswith('.tmp')
+        assert fsyncs[1:] == [os.path.dirname(filepath)]
+    else:
+        assert fsyncs == []
+    assert submitted[0]['sync'] == (durability == 'batch')
+    assert submitted[0]['size'] == 4
+
+def test_batch_is_flushed_before_the_commit(database, tmp_path, fsyncs):
+
+    writer = IngestWriter(max_latency = 0.01, max_retries = 1, dead_letter = str(tmp_path / 'dead_letter.jsonl'))
+    filepath = str(tmp_path / '1.1')
+    open(filepath, 'wb').close()
+    writer.submit(dict(instance('1.1', filename = filepath), sync = True))
+    writer.submit(instance('1.2'))
+    assert writer._flush(writer._next_batch())
+    assert fsyncs == [filepath, str(tmp_path)]
+
+def test_batch_is_kept_if_its_files_cant_be_flushed(database, tmp_path):
+
+    writer = IngestWriter(max_latency = 0.01, max_retries = 1, dead_letter = str(tmp_path / 'dead_letter.jsonl'))
+    writer.submit(dict(instance('1.1', filename = str(tmp_path / 'missing')), sync = True))
+    assert not writer._flush(writer._next_batch())
+    assert writer.get_stats()['failed'] == 1
+    assert '1.1' in writer.pending
@@ -0,0 +1,43 @@
+from services.db_store_handler import HierarchyCache, IngestWriter, hierarchy_cache
+from conftest import instance
+
+def test_least_recently_used_keys_are_evicted():
+
+    cache = HierarchyCache(maxsize = 2)
+    cache.add('study', '1')
+    cache.add('study', '2')
+    assert cache.contains('study', '1')
+    cache.add('study', '3')
+    assert cache.contains('study', '1') and cache.contains('study', '3')
+    assert not cache.contains('study', '2')
+
+def test_discard_study_discards_its_series():
+
+    cache = HierarchyCache()
+    cache.add('study', '1')
+    cache.add('series', '1.1', '1')
+    cache.add('series', '2.1', '2')
+    cache.discard_study('1')
+    assert not cache.contains('study', '1')
+    assert not cache.contains('series', '1.1')
+    assert cache.contains('series', '2.1')
+
+def test_disabled_cache_keeps_nothing():
+
+    # maxsize 0 is used by the Store SCP worker processes
+    cache = HierarchyCache(maxsize = 0)
+    cache.add('patient', 'P1')
+    assert not cache.contains('patient', 'P1')
+
+def test_writer_skips_the_lookups_of_known_rows(database):
+
+    writer = IngestWriter(max_latency = 0.01)
+    writer.submit(instance('1.1'))
+    assert writer._flush(writer._next_batch())
+    hits = {level: stats['hits'] for level, stats in hierarchy_cache.get_stats().items() if level in HierarchyCache.levels}
+
+    # The next instance of the same series finds its patient, study and series in the cache
+    writer.submit(instance('1.2'))
+    assert writer._flush(writer._next_batch())
+    stats = hierarchy_cache.get_stats()
+    assert all(stats[level]['hits'] == hits[level] + 1 for level in HierarchyCache.levels)
@@ -0,0 +1,59 @@
+import threading
+from services.ingest_pipeline import IngestPipeline
+from services.db_store_handler import ingest_pipeline, ingest_writer
+from conftest import ct, send, committed
+
+def test_jobs_with_the_same_key_run_in_order():
+
+    pipeline = IngestPipeline(workers = 4, queue_size = 1000)
+    pipeline.start()
+    done = {key: [] for key in range(3)}
+    try:
+        for idx in range(50):
+            for key in done:
+                assert pipeline.submit(key, done[key].append, idx)
+    finally:
+        pipeline.stop()
+    assert all(jobs == list(range(50)) for jobs in done.values())
+
+def test_full_pipeline_rejects_jobs():
+
+    pipeline = IngestPipeline(workers = 1, queue_size = 2)
+    release = threading.Event()
+    pipeline.start()
+    try:
+        assert pipeline.submit('a', release.wait)
+        assert pipeline.submit('a', lambda: None)
+        assert pipeline.load() == 1
+        assert not pipeline.submit('b', lambda: None)
+        # Control jobs are accepted anyway
+        assert pipeline.submit('b', lambda: None, force = True)
+        assert pipeline.get_stats()['rejected'] == 1
+    finally:
+        release.set()
+        pipeline.stop()
+    assert pipeline.queued == 0
+
+def test_pipeline_not_started_runs_jobs_inline():
+
+    pipeline = IngestPipeline(workers = 2, queue_size = 1)
+    done = []
+    assert all(pipeline.submit('a', done.append, idx) for idx in range(3))
+    assert done == [0, 1, 2]
+
+def test_store_handler_answers_out_of_resources_when_the_pipeline_is_full(store_scp, monkeypatch):
+
+    scp = store_scp()
+    # Admission by queue load would reject the association before the store handler sees the instance
+    scp.queue_load = None
+    monkeypatch.setattr(ingest_pipeline, 'queue_size', 1)
+    release = threading.Event()
+    assert ingest_pipeline.submit('block', release.wait)
+    try:
+        assert send(scp, [ct('1.1')]) == [0xA700]
+        # The reservation is released, so the instance can be sent again
+        assert '1.1' not in ingest_writer.pending
+    finally:
+        release.set()
+    assert send(scp, [ct('1.1')]) == [0x0000]
+    assert committed(['1.1'])['1.1'] is not None
@@ -0,0 +1,75 @@
+import sys
+from types import SimpleNamespace
+import pytest
+from services.db_store_handler import IngestSessions
+from conftest import instance
+
+@pytest.fixture
+def writer():
+
+    """ A writer that keeps the submitted records """
+
+    writer = SimpleNamespace(records = [])
+    writer.submit = lambda record, reserved: writer.records.append(record['SOPInstanceUID'])
+    return writer
+
+@pytest.fixture
+def clock(monkeypatch):
+
+    now = {'time': 1000.0}
+    monkeypatch.setattr(sys.modules['services.db_store_handler'], 'time', lambda: now['time'])
+    return now
+
+def test_records_are_held_until_the_series_changes(writer):
+
+    sessions = IngestSessions(writer)
+    sessions.open('assoc')
+    sessions.add('assoc', instance('1.1', series = 'A'))
+    sessions.add('assoc', instance('1.2', series = 'A'))
+    assert writer.records == []
+    sessions.add('assoc', instance('2.1', series = 'B'))
+    assert writer.records == ['1.1', '1.2']
+    assert sessions.get_stats()['held_records'] == 1
+
+def test_close_flushes_the_session(writer):
+
+    sessions = IngestSessions(writer)
+    sessions.add('assoc', instance('1.1'))
+    sessions.add('other', instance('2.1'))
+    sessions.close('assoc')
+    assert writer.records == ['1.1']
+    stats = sessions.get_stats()
+    assert (stats['open'], stats['held_records'], stats['flushes']) == (1, 1, 1)
+
+def test_max_records(writer):
+
+    sessions = IngestSessions(writer, max_records = 2)
+    for idx in range(5):
+        sessions.add('assoc', instance(f'1.{idx}'))
+    assert writer.records == ['1.0', '1.1', '1.2', '1.3']
+    assert sessions.get_stats()['records_per_flush'] == 2
+
+def test_expired_records_are_flushed(writer, clock):
+
+    sessions = IngestSessions(writer, max_age = 5)
+    sessions.add('assoc', instance('1.1'))
+    clock['time'] += 5
+    sessions.flush_expired()
+    assert writer.records == []
+    clock['time'] += 1
+    sessions.flush_expired()
+    assert writer.records == ['1.1']
+    # The age of the session starts again with its next record
+    sessions.add('assoc', instance('1.2'))
+    sessions.flush_expired()
+    assert writer.records == ['1.1']
+
+def test_stop_flushes_all_the_sessions(writer):
+
+    sessions = IngestSessions(writer)
+    sessions.start()
+    sessions.add('assoc', instance('1.1'))
+    sessions.add('other', instance('2.1', series = 'B'))
+    sessions.stop()
+    assert sorted(writer.records) == ['1.1', '2.1']
+    assert sessions.get_stats()['open'] == 0
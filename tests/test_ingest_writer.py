@@ -0,0 +1,96 @@
+import os
+import pytest
+from services.db_store_handler import IngestWriter, worker_dead_letter
+from app_pkg import application, db
+from app_pkg.db_models import Instance
+from conftest import instance
+
+def failing_commit(*args):
+
+    raise RuntimeError('database is locked')
+
+def writer(dead_letter: str, fail: bool = False) -> IngestWriter:
+
+    """ An ingest writer without its thread, whose commits fail if fail is True """
+
+    writer = IngestWriter(max_latency = 0.01, max_retries = 1, dead_letter = dead_letter)
+    if fail:
+        writer._write_batch = failing_commit
+    return writer
+
+def flush(writer: IngestWriter, records: list) -> bool:
+
+    """ Submits records to a writer and commits them in one batch """
+
+    for record in records:
+        writer.submit(record)
+    return writer._flush(writer._next_batch())
+
+def kept(dead_letter: str) -> list:
+
+    """ The SOPInstanceUIDs in a dead letter file """
+
+    if not os.path.exists(dead_letter):
+        return []
+    probe = writer(dead_letter)
+    probe._load_dead_letter()
+    return sorted(r['SOPInstanceUID'] for batch in probe.failed for r in batch)
+
+def stored(uids: list) -> list:
+
+    with application.app_context():
+        return sorted(uid for uid in uids if db.session.get(Instance, uid) is not None)
+
+# Batches that can't be committed are kept
+
+def test_failed_batch_is_kept_and_retried(database, tmp_path):
+
+    dead_letter = str(tmp_path / 'dead_letter.jsonl')
+    w = writer(dead_letter, fail = True)
+    assert not flush(w, [instance('1.1'), instance('1.2')])
+    assert w.get_stats()['failed'] == 2
+    assert {'1.1', '1.2'} <= w.pending
+    assert kept(dead_letter) == ['1.1', '1.2']
+
+    # The database is back
+    del w._write_batch
+    assert w._flush(w.failed.popleft(), retry = True)
+    w._save_dead_letter()
+    assert stored(['1.1', '1.2']) == ['1.1', '1.2']
+    assert not w.pending
+    assert not os.path.exists(dead_letter)
+
+def test_kept_records_are_queued_again_on_start(database, tmp_path):
+
+    dead_letter = str(tmp_path / 'dead_letter.jsonl')
+    assert not flush(writer(dead_letter, fail = True), [instance('1.1')])
+
+    # A new process
+    w = writer(dead_letter)
+    w._load_dead_letter()
+    assert '1.1' in w.pending
+    assert w._flush(w.failed.popleft(), retry = True)
+    assert stored(['1.1']) == ['1.1']
+
+def test_writers_sharing_a_directory_keep_their_own_records(database, tmp_path, monkeypatch):
+
+    # The Store SCP worker processes run in the same directory, each one with its own writer
+    monkeypatch.chdir(tmp_path)
+    first, second = writer(worker_dead_letter(0), fail = True), writer(worker_dead_letter(1), fail = True)
+    assert first.dead_letter != second.dead_letter
+    assert not flush(first, [instance('1.1')])
+    assert not flush(second, [instance('2.1')])
+    assert kept(first.dead_letter) == ['1.1']
+    assert kept(second.dead_letter) == ['2.1']
+
+    # The first writer recovers: the records of the second one are not removed
+    del first._write_batch
+    assert first._flush(first.failed.popleft(), retry = True)
+    first._save_dead_letter()
+    assert kept(first.dead_letter) == []
+    assert kept(second.dead_letter) == ['2.1']
+
+    # Each writer queues again only its own records when it starts
+    restarted = writer(worker_dead_letter(0))
+    restarted._load_dead_letter()
+    assert not restarted.failed
@@ -0,0 +1,20 @@
+from app_pkg.aux_funcs import probe_devices
+from services.interface_registry import shared_interface
+from conftest import free_port
+
+def test_probe_devices(database, find_scp):
+
+    device = find_scp(lambda event: iter([]))
+    unreachable = dict(device, port = free_port())
+    result = probe_devices({'up': device, 'down': unreachable}, timeout = 2)
+    assert result['up']['status'] == 'ok' and result['up']['association_ms'] is not None
+    assert result['down']['status'] == 'unreachable'
+
+def test_probes_dont_change_the_shared_interface(database, find_scp):
+
+    interface = shared_interface.get()
+    timeouts = [interface.acse_timeout, interface.dimse_timeout, interface.network_timeout, interface.connection_timeout]
+    contexts = len(interface.requested_contexts)
+    assert probe_devices({'up': find_scp(lambda event: iter([]))}, timeout = 0.5)['up']['status'] == 'ok'
+    assert [interface.acse_timeout, interface.dimse_timeout, interface.network_timeout, interface.connection_timeout] == timeouts
+    assert len(interface.requested_contexts) == contexts
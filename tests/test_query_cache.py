@@ -0,0 +1,42 @@
+import time
+import pytest
+from conftest import study, query
+
+def cached(interface, device: dict, date: str = '') -> bool:
+
+    return interface.query_cache.lookup(device, query(date)) is not None
+
+# The query cache keeps only complete answers
+
+def test_completed_query_is_cached(find_scp, interface):
+
+    def on_find(event):
+        for idx in range(3):
+            yield 0xFF00, study(idx)
+
+    device = find_scp(on_find)
+    assert len(interface.query_device(device, query())) == 3
+    assert cached(interface, device)
+
+@pytest.mark.parametrize('final', [0xC000, 0xA700], ids = ['0xC000', '0xA700'])
+def test_failed_query_is_not_cached(find_scp, interface, final):
+
+    def on_find(event):
+        for idx in range(2):
+            yield 0xFF00, study(idx)
+        yield final, None
+
+    device = find_scp(on_find)
+    assert len(interface.query_device(device, query())) == 2
+    assert not cached(interface, device)
+
+def test_timed_out_query_is_not_cached(find_scp, interface):
+
+    def on_find(event):
+        yield 0xFF00, study(0)
+        time.sleep(interface.dimse_timeout + 1)
+        yield 0xFF00, study(1)
+
+    device = find_scp(on_find)
+    assert len(interface.query_device(device, query())) == 1
+    assert not cached(interface, device)
@@ -0,0 +1,51 @@
+import time
+from types import SimpleNamespace
+import pytest
+from app_pkg import aux_funcs
+from conftest import study, query
+
+def cached(interface, device: dict, date: str = '') -> bool:
+
+    return interface.query_cache.lookup(device, query(date)) is not None
+
+@pytest.mark.parametrize('final', [0xFE00, 0x0000], ids = ['0xFE00', '0x0000'])
+def test_cancelled_query_is_not_cached(find_scp, interface, final):
+
+    # Many devices answer a C-CANCEL with 0x0000
+    def on_find(event):
+        for idx in range(10):
+            if event.is_cancelled:
+                yield final, None
+                return
+            time.sleep(0.2)
+            yield 0xFF00, study(idx)
+
+    device = find_scp(on_find)
+    assert len(interface.query_device(device, query(), max_results = 2)) >= 2
+    assert not cached(interface, device)
+
+def test_cancelled_query_yields_drained_responses(find_scp, interface):
+
+    # The device sends all the responses before it reads the C-CANCEL
+    def on_find(event):
+        for idx in range(10):
+            yield 0xFF00, study(idx)
+
+    device = find_scp(on_find)
+    uids = [response.StudyInstanceUID for response in interface.query_device(device, query(), max_results = 1)]
+    assert uids == [f'1.2.3.{idx}' for idx in range(len(uids))]
+    assert len(uids) == 10
+
+def test_truncated_devices_are_reported_once(monkeypatch):
+
+    # The queries of the truncated devices may still send a few responses before they are cancelled
+    def iter_query_devices(queries, **kwargs):
+        for name in ['B', 'A', 'C']:
+            for idx in range(5 if name != 'C' else 2):
+                yield name, study(idx)
+            yield name, None
+
+    monkeypatch.setattr(aux_funcs, 'shared_interface', SimpleNamespace(get = lambda: SimpleNamespace(iter_query_devices = iter_query_devices)))
+    devices = [SimpleNamespace(name = name, imgs_study = 'NumberOfStudyRelatedInstances') for name in 'ABC']
+    *_, end = aux_funcs.search_studies_events(devices, {}, timeout = None, max_results = 2)
+    assert end == {'type': 'end', 'timed_out': [], 'truncated': ['A', 'B'], 'max_results': 2}
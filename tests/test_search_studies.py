@@ -0,0 +1,43 @@
+import pytest
+from app_pkg import application, db, routes
+from app_pkg.db_models import Device
+
+@pytest.fixture
+def search(database, monkeypatch):
+
+    """ Posts /search_studies and returns the timeout passed to search_studies_events """
+
+    with application.app_context():
+        for name in ['A', 'B']:
+            db.session.add(Device(name = name, ae_title = name, address = '127.0.0.1', port = 104,
+                                  imgs_study = 'NumberOfStudyRelatedInstances'))
+        db.session.commit()
+    timeouts = []
+
+    def search_studies_events(devices, queries, timeout, *args):
+        timeouts.append(timeout)
+        yield {'type': 'end', 'timed_out': [], 'truncated': [], 'max_results': 0}
+
+    monkeypatch.setattr(routes, 'search_studies_events', search_studies_events)
+    client = application.test_client()
+
+    def post(**kwargs) -> float:
+        query = dict(dateSelector = 'anydate', modalities = [], searchField = 'PatientID', searchValue = '', **kwargs)
+        assert client.post('/search_studies', json = query).status_code == 200
+        return timeouts.pop()
+
+    return post
+
+def test_single_device_waits_the_dimse_timeout(search):
+
+    assert search(device = 'A') is None
+    assert search(devices = ['A']) is None
+
+def test_federated_search_deadline(search):
+
+    assert search(devices = ['A', 'B']) == application.config['FEDERATED_SEARCH_TIMEOUT']
+
+def test_explicit_timeout(search):
+
+    assert search(device = 'A', timeout = 5) == 5
+    assert search(devices = ['A', 'B'], timeout = 0) == 0
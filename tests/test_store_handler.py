@@ -0,0 +1,61 @@
+import os
+from pydicom import dcmread
+from pydicom.uid import ExplicitVRLittleEndian
+from pynetdicom.dsutils import encode
+from app_pkg import application, db
+from app_pkg.db_models import Instance
+from conftest import ct, send, committed, written
+
+def test_raw_write_mode_stores_the_received_bytes(store_scp):
+
+    scp = store_scp(write_mode = 'raw')
+    datasets = [ct('1.1'), ct('1.2', rows = 16)]
+    assert send(scp, datasets) == [0x0000, 0x0000]
+    rows = committed(['1.1', '1.2'])
+    for ds in datasets:
+        row = rows[ds.SOPInstanceUID]
+        assert row.TransferSyntaxUID == ExplicitVRLittleEndian
+        stored = dcmread(row.filename)
+        assert stored.file_meta.MediaStorageSOPInstanceUID == ds.SOPInstanceUID
+        assert stored.PatientID == ds.PatientID and stored.PixelData == ds.PixelData
+        # The dataset is written as received, right after the file meta information
+        with open(row.filename, 'rb') as f:
+            f.seek(row.dataset_offset)
+            assert f.read() == encode(ds, False, True)
+
+def sizes(uid: str) -> tuple:
+
+    """ The size of an instance, and the number of instances and size of its series and study """
+
+    with application.app_context():
+        instance = db.session.get(Instance, uid)
+        return instance.size, [(row.NumberOfInstances, row.size) for row in [instance.series, instance.study]]
+
+def test_reject_duplicates(store_scp):
+
+    scp = store_scp(duplicates = 'reject')
+    assert send(scp, [ct('1.1')]) == [0x0000]
+    committed(['1.1'])
+    assert send(scp, [ct('1.1')]) == [0x0117]
+
+def test_ignore_duplicates(store_scp):
+
+    scp = store_scp(duplicates = 'ignore')
+    assert send(scp, [ct('1.1')]) == [0x0000]
+    committed(['1.1'])
+    size, counters = sizes('1.1')
+    assert send(scp, [ct('1.1', rows = 16)]) == [0x0000]
+    assert written()
+    assert sizes('1.1') == (size, counters)
+
+def test_replace_duplicates_keeps_the_counters(store_scp):
+
+    scp = store_scp(duplicates = 'replace')
+    assert send(scp, [ct('1.1'), ct('1.2')]) == [0x0000, 0x0000]
+    small = committed(['1.1', '1.2'])['1.1']
+    assert send(scp, [ct('1.1', rows = 64)]) == [0x0000]
+    assert written()
+    size, counters = sizes('1.1')
+    assert size == os.path.getsize(small.filename) > small.size
+    # The series and study have the same instances, with the size of the new file
+    assert counters == [(2, small.size + size)] * 2
@@ -0,0 +1,69 @@
+from types import SimpleNamespace
+import pytest
+import pynetdicom.association
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian
+from pynetdicom import AE, evt
+from pynetdicom.dsutils import split_dataset
+from pynetdicom.sop_class import CTImageStorage
+from conftest import ct, free_port
+
+@pytest.fixture
+def store_device():
+
+    """
+
+        Starts a Store SCP that keeps the encoded datasets it receives. The fixture is a function that takes
+        the transfer syntaxes accepted for CT and returns the device dict and the received datasets, as a
+        dict of (transfer syntax, bytes) by SOPInstanceUID.
+
+    """
+
+    servers = []
+
+    def start(transfer_syntaxes: list) -> tuple:
+        received = {}
+        def on_store(event):
+            received[event.request.AffectedSOPInstanceUID] = (event.context.transfer_syntax, event.request.DataSet.getvalue())
+            return 0x0000
+        ae = AE(ae_title = 'REMOTE')
+        ae.add_supported_context(CTImageStorage, transfer_syntaxes)
+        port = free_port()
+        servers.append(ae.start_server(('127.0.0.1', port), block = False, evt_handlers = [(evt.EVT_C_STORE, on_store)]))
+        return {'ae_title': 'REMOTE', 'address': '127.0.0.1', 'port': port}, received
+
+    yield start
+    for server in servers:
+        server.shutdown()
+
+def stored_file(tmp_path, uid: str, offset: bool = True) -> SimpleNamespace:
+
+    """ A CT instance saved to a file, with the attributes of its database Instance """
+
+    filename = str(tmp_path / uid)
+    ct(uid).save_as(filename, write_like_original = False)
+    return SimpleNamespace(filename = filename, SOPClassUID = CTImageStorage, SOPInstanceUID = uid,
+                           TransferSyntaxUID = ExplicitVRLittleEndian,
+                           dataset_offset = split_dataset(filename)[1] if offset else None)
+
+def test_files_are_sent_without_decoding(store_device, interface, tmp_path, monkeypatch):
+
+    def dcmread(*args, **kwargs):
+        raise AssertionError('the file was decoded')
+
+    monkeypatch.setattr(pynetdicom.association, 'dcmread', dcmread)
+    device, received = store_device([ExplicitVRLittleEndian, ImplicitVRLittleEndian])
+    # The offset of the dataset is found from the file meta information if it is unknown
+    instances = [stored_file(tmp_path, '1.1'), stored_file(tmp_path, '1.2', offset = False)]
+    assert interface.store_datasets(device, instances) == [True, True]
+    for instance in instances:
+        with open(instance.filename, 'rb') as f:
+            f.seek(split_dataset(instance.filename)[1])
+            assert received[instance.SOPInstanceUID] == (ExplicitVRLittleEndian, f.read())
+
+def test_files_are_decoded_for_other_transfer_syntaxes(store_device, interface, tmp_path):
+
+    device, received = store_device([ImplicitVRLittleEndian])
+    assert interface.store_datasets(device, [stored_file(tmp_path, '1.1')]) == [True]
+    transfer_syntax, data = received['1.1']
+    assert transfer_syntax == ImplicitVRLittleEndian
+    assert b'Test^Patient' in data